@@ -2,6 +2,9 @@
 """
 Автоматическая проверка истёкших подписок каждые 30 секунд.
 Для тестирования. В продакшене использовать крон.
+
+Можно запускать на нескольких узлах: проверку делает держатель аренды expiry_sweep
+(см. leader.py), остальные ждут, пока она освободится.
 """
 import asyncio
 import logging
@@ -15,16 +18,32 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 async def run_checks():
-    """Запускать проверку каждые 30 секунд"""
+    """Запускать проверку каждые 30 секунд (только на узле-ведущем)"""
     from check_subscriptions import check_and_remove_expired
+    from leader import Lease, LeaseLost
     
     logger.info("Автоматическая проверка запущена (каждые 30 секунд)")
     
+    lease = Lease('expiry_sweep')
+    keeper = None
+    
     while True:
         try:
-            logger.info(f"[{datetime.now().strftime('%H:%M:%S')}] Проверка истёкших подписок...")
-            await check_and_remove_expired()
-            logger.info("Проверка завершена. Следующая через 30 секунд.")
+            if not lease.is_held:
+                if keeper:
+                    keeper.cancel()
+                    keeper = None
+                if await asyncio.to_thread(lease.acquire):
+                    keeper = asyncio.create_task(lease.keep_alive())
+            
+            if lease.is_held:
+                logger.info(f"[{datetime.now().strftime('%H:%M:%S')}] Проверка истёкших подписок...")
+                await check_and_remove_expired(lease)
+                logger.info("Проверка завершена. Следующая через 30 секунд.")
+            else:
+                logger.info("Проверку выполняет другой узел, ждём")
+        except LeaseLost as e:
+            logger.warning(f"Проверка прервана: {e}")
         except Exception as e:
             logger.error(f"Ошибка при проверке: {e}")
         
@@ -33,7 +52,11 @@ async def run_checks():
 def main():
     """Точка входа"""
     import config
+    import database as db
+    import metrics
     config.validate_config()
+    db.init_db()
+    metrics.start_metrics_server(config.AUTOCHECK_METRICS_PORT)
     
     logger.info("="*60)
     logger.info("АВТОПРОВЕРКА ПОДПИСОК")
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+"""
+Резервные копии SQLite без остановки бота и webhook_server.py.
+
+Снимок делается через online backup API SQLite в одной читающей транзакции: копия
+согласована на момент её начала, а в режиме WAL (включается при первом снимке) запись
+в это время не ждёт. Страницы копируются шагами по BACKUP_STEP_PAGES с паузой
+BACKUP_STEP_PAUSE_MS, чтобы копирование не отнимало диск у бота. Копия проверяется
+(PRAGMA quick_check) и сжимается в BACKUP_DIR/snapshots, хранятся BACKUP_KEEP последних.
+
+Непрерывная архивация WAL (BACKUP_WAL_ARCHIVE=1 во всех процессах): архиватор каждые
+BACKUP_WAL_INTERVAL_SECONDS дописывает новые закоммиченные кадры WAL в BACKUP_DIR/wal и
+сам делает checkpoint, когда в WAL набирается BACKUP_WAL_CHECKPOINT_FRAMES кадров
+(процессы бота checkpoint не делают), поэтому WAL не сбрасывается раньше, чем скопирован.
+Поколение - базовый снимок и кадры после него; новое начинается при запуске архиватора,
+раз в BACKUP_WAL_GENERATION_HOURS и при разрыве цепочки (WAL сбросил другой процесс).
+Восстановление на момент времени - с точностью до интервала архивации.
+
+    python backup.py snapshot                       # из крона, например раз в сутки
+    python backup.py archive-wal                    # постоянный процесс (systemd)
+    python backup.py list
+    python backup.py restore --output restored.db   # последний снимок
+    python backup.py restore --at "2026-10-19 12:30" --output restored.db
+
+restore не трогает рабочую БД: остановите процессы бота, удалите старые файлы -wal и -shm
+и замените файл БД восстановленным.
+"""
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import struct
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+import config
+import database as db
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATTERN = 'snapshot-*.db.gz'
+BASE_NAME = 'base.db.gz'
+META_NAME = 'meta.json'
+SEGMENT_PATTERN = '*.wal.gz'
+
+# Формат WAL: https://www.sqlite.org/fileformat.html#the_write_ahead_log
+WAL_MAGIC_LE = 0x377f0682
+WAL_MAGIC_BE = 0x377f0683
+WAL_HEADER_SIZE = 32
+FRAME_HEADER_SIZE = 24
+
+# === СНИМКИ ===
+
+def source_path() -> str:
+    """Файл рабочей БД"""
+    backend = db.BACKEND
+    if backend.name != 'sqlite' or backend.uri:
+        raise RuntimeError("backup.py копирует файл SQLite; для PostgreSQL используйте pg_dump")
+    return backend.path
+
+def _connect(path: str):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA wal_autocheckpoint = 0')
+    return conn
+
+def ensure_wal(conn):
+    """Перевести БД в режим WAL: читатели, в том числе снимок, не блокируют запись"""
+    if conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+        return
+    if conn.execute('PRAGMA journal_mode = WAL').fetchone()[0] != 'wal':
+        raise RuntimeError("не удалось включить режим WAL")
+    logger.info("БД переведена в режим WAL")
+
+def _replace(tmp: str, target: str):
+    """Сбросить файл на диск и атомарно переименовать"""
+    with open(tmp, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, target)
+
+def _remove_db(path: str):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def check_file(path: str, full: bool = False):
+    """PRAGMA quick_check (full - integrity_check) копии; RuntimeError при повреждении"""
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute(f"PRAGMA {'integrity_check' if full else 'quick_check'}").fetchone()[0]
+    finally:
+        conn.close()
+    if result != 'ok':
+        raise RuntimeError(f"{path}: копия повреждена ({result})")
+
+def copy_online(source: str, target: str, pages: int = None, pause_ms: float = None) -> Dict:
+    """
+    Согласованная копия source в несжатый файл target без остановки записи.
+    Вернуть {'pages', 'seconds', 'wal_header'} (заголовок WAL на момент снимка - для архиватора).
+    """
+    pages = pages or config.BACKUP_STEP_PAGES
+    pause = (config.BACKUP_STEP_PAUSE_MS if pause_ms is None else pause_ms) / 1000
+    started = time.perf_counter()
+    copied = 0
+
+    def progress(status, remaining, total):
+        nonlocal copied
+        copied = total
+        if remaining and pause:
+            time.sleep(pause)
+
+    src = _connect(source)
+    dst = sqlite3.connect(target)
+    try:
+        ensure_wal(src)
+        # Снимок держится всё копирование: backup API не начинает заново, когда в БД пишут
+        src.execute('BEGIN')
+        src.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        wal_header = read_wal_header(source + '-wal')
+        src.backup(dst, pages=pages, progress=progress)
+        src.execute('COMMIT')
+    finally:
+        dst.close()
+        src.close()
+    return {'pages': copied, 'seconds': time.perf_counter() - started, 'wal_header': wal_header}
+
+def take_snapshot(source: str, target: str, pages: int = None, pause_ms: float = None) -> Dict:
+    """Копия source, проверка и сжатие в target (.db.gz)"""
+    tmp_db = target + '.db.part'
+    tmp_gz = target + '.part'
+    try:
+        info = copy_online(source, tmp_db, pages, pause_ms)
+        check_file(tmp_db)
+        with open(tmp_db, 'rb') as src, gzip.open(tmp_gz, 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        _replace(tmp_gz, target)
+    finally:
+        _remove_db(tmp_db)
+        if os.path.exists(tmp_gz):
+            os.remove(tmp_gz)
+    info['bytes'] = os.path.getsize(target)
+    logger.info(f"Снимок {target}: {info['pages']} страниц за {info['seconds']:.1f} сек, "
+                f"{info['bytes'] / 1024 / 1024:.1f} МБ")
+    return info
+
+def _prune(paths, keep: int):
+    """Удалить всё, кроме keep последних (paths отсортированы по времени)"""
+    for path in paths[:-keep] if keep else []:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        logger.info(f"Удалена старая копия {path}")
+
+def snapshot(source: str = None, directory: str = None) -> str:
+    """Плановый снимок в BACKUP_DIR/snapshots с очисткой старых"""
+    directory = directory or os.path.join(config.BACKUP_DIR, 'snapshots')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"snapshot-{datetime.now():%Y%m%d-%H%M%S}.db.gz")
+    take_snapshot(source or source_path(), path)
+    _prune(sorted(glob.glob(os.path.join(directory, SNAPSHOT_PATTERN))), config.BACKUP_KEEP)
+    return path
+
+# === WAL ===
+
+def _checksum(data: bytes, s0: int, s1: int, big_endian: bool) -> Tuple[int, int]:
+    """Контрольная сумма WAL (продолжение с s0, s1)"""
+    words = struct.unpack(f"{'>' if big_endian else '<'}{len(data) // 4}I", data)
+    for i in range(0, len(words), 2):
+        s0 = (s0 + words[i] + s1) & 0xFFFFFFFF
+        s1 = (s1 + words[i + 1] + s0) & 0xFFFFFFFF
+    return s0, s1
+
+def read_wal_header(path: str) -> Optional[Dict]:
+    """Заголовок WAL-файла (None - файла нет, он пуст или заголовок не сходится)"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(WAL_HEADER_SIZE)
+    except FileNotFoundError:
+        return None
+    if len(data) < WAL_HEADER_SIZE:
+        return None
+    magic, _, page_size, _, salt1, salt2, sum1, sum2 = struct.unpack('>8I', data)
+    if magic not in (WAL_MAGIC_LE, WAL_MAGIC_BE):
+        return None
+    big_endian = magic == WAL_MAGIC_BE
+    if _checksum(data[:24], 0, 0, big_endian) != (sum1, sum2):
+        return None
+    return {
+        'page_size': 65536 if page_size == 1 else page_size,
+        'salt': [salt1, salt2],
+        'big_endian': big_endian,
+        'checksum': [sum1, sum2]
+    }
+
+def read_frames(path: str, header: Dict, first: int, checksum) -> Tuple[bytes, int, Tuple[int, int]]:
+    """
+    Кадры WAL с номера first (с 1) до последнего коммита, проверенные по соли и
+    контрольным суммам: (кадры подряд, их число, контрольная сумма последнего).
+    Недописанный или незакоммиченный хвост не возвращается.
+    """
+    frame_size = FRAME_HEADER_SIZE + header['page_size']
+    big_endian = header['big_endian']
+    s0, s1 = checksum
+    frames = []
+    committed = (0, s0, s1)
+    with open(path, 'rb') as f:
+        f.seek(WAL_HEADER_SIZE + (first - 1) * frame_size)
+        while True:
+            frame = f.read(frame_size)
+            if len(frame) < frame_size:
+                break
+            _, commit, salt1, salt2, sum1, sum2 = struct.unpack('>6I', frame[:FRAME_HEADER_SIZE])
+            if [salt1, salt2] != header['salt']:
+                break
+            s0, s1 = _checksum(frame[:8], s0, s1, big_endian)
+            s0, s1 = _checksum(frame[FRAME_HEADER_SIZE:], s0, s1, big_endian)
+            if (s0, s1) != (sum1, sum2):
+                break
+            frames.append(frame)
+            if commit:
+                committed = (len(frames), s0, s1)
+    count, s0, s1 = committed
+    return b''.join(frames[:count]), count, (s0, s1)
+
+def apply_frames(f, data: bytes, page_size: int):
+    """Записать страницы кадров в открытый файл БД; кадр коммита задаёт размер БД"""
+    frame_size = FRAME_HEADER_SIZE + page_size
+    for offset in range(0, len(data), frame_size):
+        page, commit = struct.unpack('>II', data[offset:offset + 8])
+        f.seek((page - 1) * page_size)
+        f.write(data[offset + FRAME_HEADER_SIZE:offset + frame_size])
+        if commit:
+            f.truncate(commit * page_size)
+
+class WalArchiver:
+    """
+    Копирует закоммиченные кадры WAL в архив поколения. Пока кадры копируются, открыт
+    снимок reader, и checkpoint не переносит в БД кадры дальше скопированных; WAL
+    начинается заново только после checkpoint, перенёсшего всё, - его делает архиватор.
+    """
+
+    def __init__(self, source: str, directory: str = None):
+        self.source = source
+        self.wal_path = source + '-wal'
+        self.directory = directory or os.path.join(config.BACKUP_DIR, 'wal')
+        # Соединения открыты всё время работы: иначе закрытие последнего соединения
+        # процесса бота сделает checkpoint и удалит WAL
+        self.reader = _connect(source)
+        self.checkpointer = _connect(source)
+        ensure_wal(self.reader)
+        self.page_size = self.reader.execute('PRAGMA page_size').fetchone()[0]
+        self.generation = None
+
+    def close(self):
+        self.reader.close()
+        self.checkpointer.close()
+
+    def _checkpoint(self) -> bool:
+        """PASSIVE checkpoint; True - весь WAL перенесён в файл БД"""
+        _, log_frames, checkpointed = self.checkpointer.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+        return log_frames == checkpointed
+
+    def start_generation(self):
+        """Новое поколение: базовый снимок и кадры текущего WAL с первого"""
+        started = datetime.now()
+        path = os.path.join(self.directory, f"{started:%Y%m%d-%H%M%S}")
+        os.makedirs(path, exist_ok=True)
+
+        before = read_wal_header(self.wal_path)
+        flushed = self._checkpoint()
+        info = take_snapshot(self.source, os.path.join(path, BASE_NAME))
+        header = info['wal_header']
+        with open(os.path.join(path, META_NAME), 'w', encoding='utf-8') as f:
+            json.dump({'started': started.isoformat(), 'page_size': self.page_size}, f)
+
+        self.generation = path
+        self.started = time.time()
+        self.epoch = 1
+        self.salt = header['salt'] if header else None
+        self.next_frame = 1
+        self.checksum = header['checksum'] if header else None
+        # complete - все кадры текущего WAL уже в БД (и в снимке): его сброс не разрывает цепочку
+        self.complete = header is None or (flushed and before is not None and before['salt'] == header['salt'])
+        logger.info(f"Поколение WAL {path}")
+        _prune(sorted(p for p in glob.glob(os.path.join(self.directory, '*')) if os.path.isdir(p)),
+               config.BACKUP_KEEP)
+
+    def _write_segment(self, data: bytes, first: int):
+        name = f"{self.epoch:05d}-{first:08d}-{int(time.time() * 1000)}.wal.gz"
+        target = os.path.join(self.generation, name)
+        with gzip.open(target + '.part', 'wb', compresslevel=6) as f:
+            f.write(data)
+        _replace(target + '.part', target)
+
+    def tick(self) -> bool:
+        """Скопировать новые кадры и при необходимости сделать checkpoint; False - разрыв цепочки"""
+        if not self._archive('BEGIN'):
+            return False
+        if self.next_frame - 1 >= config.BACKUP_WAL_CHECKPOINT_FRAMES and not self.complete:
+            # Под постоянной записью checkpoint за снимком не переносит WAL целиком, и тот растёт:
+            # хвост докопируется и переносится при остановленной на это время записи
+            return self._archive('BEGIN IMMEDIATE')
+        return True
+
+    def _archive(self, begin: str) -> bool:
+        self.reader.execute(begin)
+        try:
+            self.reader.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            header = read_wal_header(self.wal_path)
+            if header is None:
+                return self.complete
+            if header['salt'] != self.salt:
+                if not self.complete:
+                    return False
+                # WAL начат заново после нашего checkpoint - следующая эпоха того же поколения
+                if self.salt is not None:
+                    self.epoch += 1
+                self.salt = header['salt']
+                self.checksum = header['checksum']
+                self.next_frame = 1
+                self.complete = False
+
+            data, count, checksum = read_frames(self.wal_path, header, self.next_frame, self.checksum)
+            if count:
+                self._write_segment(data, self.next_frame)
+                self.next_frame += count
+                self.checksum = checksum
+                self.complete = False
+            if self.next_frame - 1 >= config.BACKUP_WAL_CHECKPOINT_FRAMES and not self.complete:
+                self.complete = self._checkpoint()
+        finally:
+            self.reader.execute('COMMIT')
+        return True
+
+    def run(self):
+        """Архивировать до остановки процесса"""
+        self.start_generation()
+        while True:
+            started = time.monotonic()
+            if not self.tick():
+                logger.warning("WAL сброшен не архиватором (BACKUP_WAL_ARCHIVE выключен в каком-то "
+                               "процессе?) - цепочка прервана, новое поколение")
+                self.start_generation()
+            elif time.time() - self.started >= config.BACKUP_WAL_GENERATION_HOURS * 3600:
+                self.start_generation()
+            time.sleep(max(0.0, config.BACKUP_WAL_INTERVAL_SECONDS - (time.monotonic() - started)))
+
+# === ВОССТАНОВЛЕНИЕ ===
+
+def _segment_time(path: str) -> float:
+    return int(os.path.basename(path).split('-')[2].split('.')[0]) / 1000
+
+def _generations(directory: str):
+    """[(каталог, meta)] поколений WAL по времени начала"""
+    result = []
+    for path in sorted(glob.glob(os.path.join(directory, '*'))):
+        meta_path = os.path.join(path, META_NAME)
+        if os.path.exists(meta_path) and os.path.exists(os.path.join(path, BASE_NAME)):
+            with open(meta_path, encoding='utf-8') as f:
+                result.append((path, json.load(f)))
+    return result
+
+def _unpack(snapshot_path: str, target: str):
+    with gzip.open(snapshot_path, 'rb') as src, open(target, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+def restore(output: str, snapshot_path: str = None, at: datetime = None, directory: str = None) -> str:
+    """
+    Восстановить БД в файл output: из снимка (по умолчанию последнего) или, если задан at,
+    из поколения WAL на этот момент. Вернуть описание восстановленной точки.
+    """
+    directory = directory or config.BACKUP_DIR
+    tmp = output + '.part'
+    _remove_db(tmp)
+    try:
+        if at is None:
+            if snapshot_path is None:
+                snapshots = sorted(glob.glob(os.path.join(directory, 'snapshots', SNAPSHOT_PATTERN)))
+                if not snapshots:
+                    raise RuntimeError(f"в {directory}/snapshots нет снимков")
+                snapshot_path = snapshots[-1]
+            _unpack(snapshot_path, tmp)
+            point = f"снимок {snapshot_path}"
+        else:
+            candidates = [(path, meta) for path, meta in _generations(os.path.join(directory, 'wal'))
+                          if datetime.fromisoformat(meta['started']) <= at]
+            if not candidates:
+                raise RuntimeError(f"нет поколения WAL, начатого до {at}")
+            path, meta = candidates[-1]
+            _unpack(os.path.join(path, BASE_NAME), tmp)
+            applied, last = 0, datetime.fromisoformat(meta['started'])
+            with open(tmp, 'r+b') as f:
+                for segment in sorted(glob.glob(os.path.join(path, SEGMENT_PATTERN))):
+                    if _segment_time(segment) > at.timestamp():
+                        break
+                    with gzip.open(segment, 'rb') as s:
+                        apply_frames(f, s.read(), meta['page_size'])
+                    applied += 1
+                    last = datetime.fromtimestamp(_segment_time(segment))
+            point = f"поколение {path}, сегментов {applied}, состояние на {last:%Y-%m-%d %H:%M:%S}"
+        check_file(tmp, full=True)
+        _replace(tmp, output)
+    finally:
+        _remove_db(tmp)
+    logger.info(f"Восстановлено в {output}: {point}")
+    return point
+
+def print_backups(directory: str = None):
+    directory = directory or config.BACKUP_DIR
+    for path in sorted(glob.glob(os.path.join(directory, 'snapshots', SNAPSHOT_PATTERN))):
+        print(f"снимок    {path} ({os.path.getsize(path) / 1024 / 1024:.1f} МБ)")
+    for path, meta in _generations(os.path.join(directory, 'wal')):
+        segments = sorted(glob.glob(os.path.join(path, SEGMENT_PATTERN)))
+        until = datetime.fromtimestamp(_segment_time(segments[-1])) if segments else \
+            datetime.fromisoformat(meta['started'])
+        print(f"поколение {path}: с {meta['started'][:19]} по {until:%Y-%m-%dT%H:%M:%S}, "
+              f"сегментов {len(segments)}")
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Резервные копии SQLite")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('snapshot', help="Снимок в BACKUP_DIR/snapshots и очистка старых")
+    sub.add_parser('archive-wal', help="Непрерывная архивация WAL (постоянный процесс)")
+    sub.add_parser('list', help="Показать снимки и поколения WAL")
+    restore_parser = sub.add_parser('restore', help="Восстановить БД в новый файл")
+    restore_parser.add_argument('--output', required=True, help="Куда записать восстановленную БД")
+    restore_parser.add_argument('--snapshot', help="Файл снимка (по умолчанию последний)")
+    restore_parser.add_argument('--at', help="Момент времени (YYYY-MM-DD HH:MM[:SS]) - по архиву WAL")
+    restore_parser.add_argument('--force', action='store_true', help="Перезаписать существующий --output")
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        print_backups()
+        return
+
+    if args.command == 'restore':
+        if args.snapshot and args.at:
+            parser.error("укажите --snapshot или --at, не оба")
+        if os.path.exists(args.output):
+            if not args.force:
+                parser.error(f"{args.output} существует (--force, чтобы перезаписать)")
+            _remove_db(args.output)
+        at = datetime.fromisoformat(args.at) if args.at else None
+        print(restore(args.output, args.snapshot, at))
+        return
+
+    config.validate_config()
+    source = source_path()
+    if args.command == 'snapshot':
+        print(snapshot(source))
+        return
+
+    if not config.BACKUP_WAL_ARCHIVE:
+        parser.error("включите BACKUP_WAL_ARCHIVE=1 во всех процессах бота и перезапустите их")
+    archiver = WalArchiver(source)
+    try:
+        archiver.run()
+    except KeyboardInterrupt:
+        logger.info("Архивация WAL остановлена")
+    finally:
+        archiver.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""Общие расчёты для отчётов заглушек, бенчмарков и replay.py"""
+from typing import Sequence
+
+def percentile(values: Sequence[float], p: float) -> float:
+    """Перцентиль p (0-100) по ближайшему рангу; для пустого списка - 0.0"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+"""
+Набор бенчмарков горячих путей на синтетических данных.
+
+Для каждого размера набора (пользователей = подписок = платежей) измеряется:
+- db.get_active_subscription, db.renew_or_create_subscription, запись платежа (pending -> succeeded) - ops/s и задержки
+- webhook.checkout_completed - события в секунду через stripe_webhook
+- sweep.check_and_remove_expired - время проверки для каждого размера очереди истёкших
+- redirect.redirect_payment - задержка редиректа короткой ссылки
+- backup.* - задержки чтения и записи без копирования и во время непрерывных снимков backup.py
+  (шагами по BACKUP_STEP_PAGES и одним шагом)
+
+Stripe и Telegram заменяются заглушками (fake_stripe_api.py, fake_telegram_api.py) в том же
+процессе, лимитер Telegram не ограничивает, логирование до WARNING включительно отключено.
+
+Запуск и сравнение с предыдущим прогоном:
+    python bench_suite.py --sizes 10000,100000 --output bench_results.json
+    python bench_suite.py --sizes 10000 --compare bench_results.json --threshold 15
+
+--data-dir сохраняет засеянные базы и переиспользует их (1M засевается около минуты).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# Окружение задаётся до импорта config: все внешние вызовы идут в заглушки
+WORK_DIR = tempfile.mkdtemp(prefix='bench_')
+TELEGRAM_PORT = _free_port()
+STRIPE_PORT = _free_port()
+os.environ.update({
+    'TELEGRAM_API_URL': f'http://127.0.0.1:{TELEGRAM_PORT}/bot',
+    'STRIPE_API_URL': f'http://127.0.0.1:{STRIPE_PORT}/v1',
+    'RATE_LIMIT_DB': os.path.join(WORK_DIR, 'rate_limit.db'),
+    'TELEGRAM_RATE_GLOBAL': '100000',
+    'TELEGRAM_RATE_PER_CHAT': '100000',
+    'TELEGRAM_RATE_PER_GROUP': '100000',
+    'TRACE_FILE': '',
+    'SLOW_HANDLER_MS': '0'
+})
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '1:bench')
+os.environ.setdefault('CHANNEL_ID', '-1001')
+os.environ.setdefault('ADMIN_IDS', '1')
+
+import config
+import database as db
+import fake_stripe_api
+import fake_telegram_api
+from bench_stats import percentile
+
+PRICE_IDS = list(config.STRIPE_PRICES.values())
+
+logger = logging.getLogger(__name__)
+
+# === ДАННЫЕ ===
+
+def seed(path: str, size: int):
+    """Засеять базу: size пользователей, подписок (70% активных) и платежей"""
+    db.configure(f'sqlite:///{path}')
+    db.init_db()
+
+    now = datetime.now()
+    rng = random.Random(size)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA journal_mode = MEMORY')
+
+    def users():
+        for i in range(size):
+            yield (i + 1, f'user{i}', f'User{i}')
+
+    def subscriptions():
+        for i in range(size):
+            active = rng.random() < 0.7
+            start = now - timedelta(days=rng.randint(0, 360))
+            end = now + timedelta(days=rng.randint(1, 360)) if active else start + timedelta(days=30)
+            if not active and end > now:
+                end = now - timedelta(days=1)
+            yield (i + 1, f'cus_{i}', f'sub_{i}', PRICE_IDS[i % len(PRICE_IDS)],
+                   'active' if active else 'expired', start.isoformat(), end.isoformat())
+
+    def payments():
+        for i in range(size):
+            yield (i + 1, f'pi_seed_{i}', f'cs_seed_{i}', config.PLAN_PRICES_CENTS['1_month'], 'eur', 'succeeded')
+
+    def members():
+        for i in range(size):
+            yield (i + 1, 'member', 1)
+
+    started = time.perf_counter()
+    with conn:
+        conn.executemany('INSERT INTO users (telegram_id, username, first_name) VALUES (?, ?, ?)', users())
+        conn.executemany('''
+            INSERT INTO subscriptions
+            (telegram_id, stripe_customer_id, stripe_subscription_id, stripe_price_id, status, start_date, end_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', subscriptions())
+        conn.executemany('''
+            INSERT INTO payments (telegram_id, stripe_payment_id, stripe_checkout_session_id, amount, currency, status)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', payments())
+        conn.executemany('INSERT INTO channel_members (telegram_id, status, is_member) VALUES (?, ?, ?)', members())
+    conn.execute('ANALYZE')
+    conn.close()
+
+    db.recompute_stats()
+    print(f"  засеяно {size} записей за {time.perf_counter() - started:.1f} сек", file=sys.stderr)
+
+def prepare_dataset(size: int, data_dir: str) -> str:
+    """Рабочая копия засеянной базы (шаблон берётся из data_dir, если есть)"""
+    work_path = os.path.join(WORK_DIR, f'bench_{size}.db')
+    template = os.path.join(data_dir, f'seed_{size}.db') if data_dir else None
+
+    if template and os.path.exists(template):
+        shutil.copyfile(template, work_path)
+    else:
+        seed(work_path, size)
+        if template:
+            os.makedirs(data_dir, exist_ok=True)
+            shutil.copyfile(work_path, template)
+
+    db.configure(f'sqlite:///{work_path}')
+    return work_path
+
+# === ИЗМЕРЕНИЯ ===
+
+def summarize(name: str, size: int, latencies, wall: float, **params) -> dict:
+    """Строка результата: ops/s и перцентили задержки в мс"""
+    latencies_ms = [value * 1000 for value in latencies]
+    return {
+        'name': name,
+        'dataset': size,
+        'params': params,
+        'ops': len(latencies),
+        'wall_s': round(wall, 4),
+        'ops_per_s': round(len(latencies) / wall, 1) if wall else 0.0,
+        'p50_ms': round(percentile(latencies_ms, 50), 3),
+        'p95_ms': round(percentile(latencies_ms, 95), 3),
+        'p99_ms': round(percentile(latencies_ms, 99), 3)
+    }
+
+def timed_calls(func, args_list):
+    """Вызвать func для каждого набора аргументов, вернуть (задержки, общее время)"""
+    latencies = []
+    started = time.perf_counter()
+    for args in args_list:
+        call_started = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - call_started)
+    return latencies, time.perf_counter() - started
+
+def bench_db(size: int, ops: int):
+    rng = random.Random(1)
+    ids = [rng.randint(1, size) for _ in range(ops)]
+
+    latencies, wall = timed_calls(db.get_active_subscription, [(i,) for i in ids])
+    yield summarize('db.get_active_subscription', size, latencies, wall)
+
+    latencies, wall = timed_calls(db.renew_or_create_subscription, [
+        (i, f'cus_{i}', f'sub_renew_{n}', PRICE_IDS[n % len(PRICE_IDS)], 1) for n, i in enumerate(ids)
+    ])
+    yield summarize('db.renew_or_create_subscription', size, latencies, wall)
+
+    run_id = int(time.time() * 1000)
+    sessions = [(i, f'cs_bench_{run_id}_{n}') for n, i in enumerate(ids)]
+    latencies, wall = timed_calls(db.record_payment_pending, [(i, cs, 499, 'eur') for i, cs in sessions])
+    yield summarize('db.record_payment_pending', size, latencies, wall)
+
+    latencies, wall = timed_calls(lambda i, cs, pi: db.set_payment_status(
+        cs, 'succeeded', telegram_id=i, stripe_payment_id=pi, amount=499, currency='eur'
+    ), [(i, cs, f'pi_bench_{run_id}_{n}') for n, (i, cs) in enumerate(sessions)])
+    yield summarize('db.set_payment_status', size, latencies, wall)
+
+def bench_webhook(size: int, events: int, concurrency: int):
+    import webhook_server
+
+    client = webhook_server.app.test_client()
+    rng = random.Random(2)
+    payloads = []
+    for n in range(events):
+        telegram_id = rng.randint(1, size)
+        subscription_id = f'sub_bench_{size}_{n}'
+        fake_stripe_api.SUBSCRIPTIONS[subscription_id] = {
+            'id': subscription_id,
+            'object': 'subscription',
+            'status': 'active',
+            'customer': f'cus_{telegram_id}',
+            'items': {'data': [{'price': fake_stripe_api._price(PRICE_IDS[n % len(PRICE_IDS)])}]}
+        }
+        payloads.append(json.dumps({
+            'id': f'evt_bench_{size}_{n}',
+            'type': 'checkout.session.completed',
+            'data': {'object': {
+                'id': f'cs_bench_{size}_{n}_{time.time_ns()}',
+                'subscription': subscription_id,
+                'customer': f'cus_{telegram_id}',
+                'payment_intent': f'pi_wh_{size}_{n}_{time.time_ns()}',
+                'amount_total': 499,
+                'currency': 'eur',
+                'metadata': {'telegram_id': str(telegram_id)}
+            }}
+        }))
+
+    def post(payload):
+        call_started = time.perf_counter()
+        response = client.post('/webhook', data=payload, content_type='application/json')
+        return time.perf_counter() - call_started, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(post, payloads))
+    wall = time.perf_counter() - started
+
+    errors = sum(1 for _, status in results if status != 200)
+    result = summarize('webhook.checkout_completed', size, [latency for latency, _ in results], wall,
+                       concurrency=concurrency)
+    result['errors'] = errors
+    yield result
+
+def _make_backlog(path: str, backlog: int):
+    """Сделать backlog активных подписок истёкшими: половина к предупреждению, половина к удалению"""
+    now = datetime.now()
+    conn = sqlite3.connect(path)
+    with conn:
+        ids = [row[0] for row in conn.execute(
+            "SELECT id FROM subscriptions WHERE status = 'active' ORDER BY random() LIMIT ?", (backlog,)
+        )]
+        conn.executemany('UPDATE subscriptions SET end_date = ? WHERE id = ?', [
+            ((now - timedelta(hours=30 if n % 2 else 50)).isoformat(), sub_id) for n, sub_id in enumerate(ids)
+        ])
+    conn.close()
+
+def _clear_backlog(path: str):
+    """Закрыть оставшиеся после проверки истёкшие подписки (ветка предупреждения их не трогает)"""
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("UPDATE subscriptions SET status = 'expired' WHERE status = 'active' AND end_date <= ?",
+                     (datetime.now().isoformat(),))
+    conn.close()
+
+def bench_sweep(size: int, path: str, backlogs):
+    from check_subscriptions import check_and_remove_expired
+
+    for backlog in backlogs:
+        _clear_backlog(path)
+        _make_backlog(path, backlog)
+        started = time.perf_counter()
+        asyncio.run(check_and_remove_expired())
+        wall = time.perf_counter() - started
+        yield {
+            'name': 'sweep.check_and_remove_expired',
+            'dataset': size,
+            'params': {'backlog': backlog},
+            'ops': backlog,
+            'wall_s': round(wall, 4),
+            'ops_per_s': round(backlog / wall, 1) if wall else 0.0
+        }
+    _clear_backlog(path)
+
+def bench_redirect(size: int, ops: int):
+    import redirect_server
+
+    redirect_server.SHORT_LINKS.clear()
+    redirect_server.SHORT_LINKS.update({
+        f'c{i:07d}': f'https://checkout.stripe.com/c/pay/cs_test_{i}' for i in range(size)
+    })
+    client = redirect_server.app.test_client()
+    rng = random.Random(3)
+    # 10% запросов - несуществующие коды
+    codes = [f'c{rng.randint(0, size - 1):07d}' if rng.random() < 0.9 else f'missing{n}' for n in range(ops)]
+
+    latencies, wall = timed_calls(lambda code: client.get(f'/{code}'), [(code,) for code in codes])
+    yield summarize('redirect.redirect_payment', size, latencies, wall, miss_share=0.1)
+
+def bench_backup(size: int, path: str, ops: int):
+    import backup
+
+    conn = sqlite3.connect(path)
+    backup.ensure_wal(conn)
+    conn.close()
+    target = os.path.join(WORK_DIR, 'backup_copy.db')
+    rng = random.Random(4)
+    ids = [rng.randint(1, size) for _ in range(ops)]
+    run_id = int(time.time() * 1000)
+
+    # None - без копирования; -1 - вся БД за один шаг без пауз
+    for during, pages in (('idle', None), ('stepped', config.BACKUP_STEP_PAGES), ('single_step', -1)):
+        stop = threading.Event()
+
+        def copy_loop():
+            while not stop.is_set():
+                backup.copy_online(path, target, pages, 0 if pages == -1 else None)
+                os.remove(target)
+
+        copier = threading.Thread(target=copy_loop, daemon=True) if pages else None
+        if copier:
+            copier.start()
+        try:
+            latencies, wall = timed_calls(db.get_active_subscription, [(i,) for i in ids])
+            yield summarize('backup.get_active_subscription', size, latencies, wall, during=during)
+            latencies, wall = timed_calls(db.record_payment_pending, [
+                (i, f'cs_backup_{run_id}_{during}_{n}', 499, 'eur') for n, i in enumerate(ids)
+            ])
+            yield summarize('backup.record_payment_pending', size, latencies, wall, during=during)
+        finally:
+            stop.set()
+            if copier:
+                copier.join()
+
+# === ВЫВОД И СРАВНЕНИЕ ===
+
+def result_key(result: dict) -> str:
+    params = ','.join(f'{k}={v}' for k, v in sorted(result['params'].items()))
+    return f"{result['name']}[{result['dataset']}]{'(' + params + ')' if params else ''}"
+
+def print_results(results):
+    for result in results:
+        latency = f"p50 {result['p50_ms']:.3f} мс, p99 {result['p99_ms']:.3f} мс" if 'p50_ms' in result else \
+            f"{result['wall_s']:.3f} сек"
+        print(f"{result_key(result):70s} {result['ops_per_s']:>12.1f} ops/s  {latency}")
+
+def compare(results, baseline_path: str, threshold: float) -> int:
+    """Сравнить ops/s с прошлым прогоном, вернуть количество регрессий"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {result_key(r): r for r in json.load(f)['results']}
+
+    regressions = 0
+    print(f"\nСравнение с {baseline_path} (порог {threshold}%):")
+    for result in results:
+        old = baseline.get(result_key(result))
+        if not old or not old['ops_per_s']:
+            continue
+        change = (result['ops_per_s'] - old['ops_per_s']) / old['ops_per_s'] * 100
+        mark = ''
+        if change < -threshold:
+            mark = '  ❌ регрессия'
+            regressions += 1
+        elif change > threshold:
+            mark = '  ✅ ускорение'
+        print(f"{result_key(result):70s} {old['ops_per_s']:>10.1f} -> {result['ops_per_s']:>10.1f} ({change:+.1f}%){mark}")
+    return regressions
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Бенчмарки горячих путей (БД, webhook, проверка, редирект)")
+    parser.add_argument('--sizes', default='10000,100000,1000000', help="Размеры наборов данных через запятую")
+    parser.add_argument('--only', default='db,webhook,sweep,redirect,backup', help="Какие группы запускать")
+    parser.add_argument('--ops', type=int, default=5000, help="Вызовов на бенчмарк БД и редиректа")
+    parser.add_argument('--webhook-events', type=int, default=1000)
+    parser.add_argument('--webhook-concurrency', type=int, default=8)
+    parser.add_argument('--backlogs', default='100,1000', help="Размеры очереди истёкших для проверки")
+    parser.add_argument('--data-dir', default='', help="Каталог для переиспользования засеянных баз")
+    parser.add_argument('--output', default='bench_results.json', help="Файл результатов (JSON)")
+    parser.add_argument('--compare', default='', help="Сравнить с прошлым файлом результатов")
+    parser.add_argument('--threshold', type=float, default=10.0, help="Порог регрессии ops/s, %%")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    groups = set(args.only.split(','))
+    backlogs = [int(backlog) for backlog in args.backlogs.split(',')]
+
+    logging.disable(logging.WARNING)
+    telegram_server = fake_telegram_api.start_server('127.0.0.1', TELEGRAM_PORT)
+    stripe_server = fake_stripe_api.start_server('127.0.0.1', STRIPE_PORT)
+
+    results = []
+    try:
+        for size in sizes:
+            print(f"Набор {size}:", file=sys.stderr)
+            path = prepare_dataset(size, args.data_dir)
+            runs = []
+            if 'db' in groups:
+                runs.append(bench_db(size, args.ops))
+            if 'webhook' in groups:
+                runs.append(bench_webhook(size, args.webhook_events, args.webhook_concurrency))
+            if 'sweep' in groups:
+                runs.append(bench_sweep(size, path, [b for b in backlogs if b <= size]))
+            if 'redirect' in groups:
+                runs.append(bench_redirect(size, args.ops))
+            if 'backup' in groups:
+                runs.append(bench_backup(size, path, args.ops))
+            for run in runs:
+                for result in run:
+                    results.append(result)
+                    print_results([result])
+            os.remove(path)
+    finally:
+        telegram_server.shutdown()
+        stripe_server.shutdown()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'args': vars(args)
+        },
+        'results': results
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}", file=sys.stderr)
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк обработки пачки обновлений: последовательно vs PerUserUpdateProcessor.
+
+Обновления берутся из JSONL-файла (по одному Update в строке, например из getUpdates).
+Обработчики имитируются задержками: оплата ждёт Stripe, "Obtener enlace" ждёт Bot API,
+остальное - быстрые ответы.
+
+Сгенерировать синтетическую пачку:
+    python bench_updates.py --generate burst.jsonl --users 300 --updates 3000
+
+Запустить бенчмарк:
+    python bench_updates.py burst.jsonl --concurrency 16 --stripe-latency 0.4
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from telegram import Update
+from telegram.ext import SimpleUpdateProcessor
+
+from bench_stats import percentile
+from update_processor import PerUserUpdateProcessor
+
+ADMIN_ID = 1
+
+TEXTS = [
+    ('/start', 0.45),
+    ('🚀 Comprar suscripción', 0.15),
+    ('📅 1 mes - 4.99 EUR', 0.15),
+    ('📱 Obtener enlace', 0.15),
+    ('📋 Mi suscripción', 0.10),
+]
+
+def generate(path: str, users: int, updates: int, admin_share: float):
+    """Записать синтетическую пачку обновлений"""
+    texts, weights = zip(*TEXTS)
+    with open(path, 'w', encoding='utf-8') as f:
+        for update_id in range(1, updates + 1):
+            if random.random() < admin_share:
+                user_id, text = ADMIN_ID, '💳 Suscripciones activas'
+            else:
+                user_id, text = random.randint(1000, 1000 + users - 1), random.choices(texts, weights)[0]
+            update = {
+                'update_id': update_id,
+                'message': {
+                    'message_id': update_id,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+                    'text': text
+                }
+            }
+            f.write(json.dumps(update, ensure_ascii=False) + '\n')
+    print(f"Записано {updates} обновлений в {path}")
+
+def load(path: str):
+    """Прочитать обновления из JSONL"""
+    with open(path, encoding='utf-8') as f:
+        return [Update.de_json(json.loads(line), None) for line in f if line.strip()]
+
+def handler_cost(update: Update, args) -> float:
+    """Имитируемое время работы обработчика"""
+    text = update.message.text if update.message else ''
+    if 'EUR' in text:
+        return args.stripe_latency + args.api_latency
+    if text == '📱 Obtener enlace':
+        return 2 * args.api_latency
+    return args.api_latency
+
+async def replay(updates, processor, args):
+    """Прогнать пачку через процессор, вернуть метрики"""
+    finished = []
+    latencies = []
+    admin_latencies = []
+
+    async def handle(update, started):
+        await asyncio.sleep(handler_cost(update, args))
+        elapsed = time.perf_counter() - started
+        finished.append(update)
+        if update.effective_user.id == ADMIN_ID:
+            admin_latencies.append(elapsed)
+        else:
+            latencies.append(elapsed)
+
+    async with processor:
+        started = time.perf_counter()
+        tasks = [
+            asyncio.create_task(processor.process_update(u, handle(u, started)))
+            for u in updates
+        ]
+        await asyncio.gather(*tasks)
+        total = time.perf_counter() - started
+
+    # Проверяем порядок: у каждого юзера update_id должны идти по возрастанию
+    last_seen = {}
+    violations = 0
+    for update in finished:
+        key = update.effective_user.id
+        if last_seen.get(key, 0) > update.update_id:
+            violations += 1
+        last_seen[key] = update.update_id
+
+    return {
+        'updates': len(updates),
+        'elapsed_s': round(total, 3),
+        'throughput_ups': round(len(updates) / total, 1),
+        'latency_ms_p50': round(percentile(latencies, 50) * 1000, 1),
+        'latency_ms_p99': round(percentile(latencies, 99) * 1000, 1),
+        'admin_latency_ms_p99': round(percentile(admin_latencies, 99) * 1000, 1),
+        'order_violations': violations
+    }
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Бенчмарк параллельной обработки обновлений")
+    parser.add_argument('input', nargs='?', help="JSONL с обновлениями")
+    parser.add_argument('--generate', metavar='PATH', help="Сгенерировать синтетическую пачку")
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--updates', type=int, default=3000)
+    parser.add_argument('--admin-share', type=float, default=0.01)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--stripe-latency', type=float, default=0.4, help="сек")
+    parser.add_argument('--api-latency', type=float, default=0.03, help="сек")
+    parser.add_argument('--skip-sequential', action='store_true')
+    args = parser.parse_args()
+
+    if args.generate:
+        generate(args.generate, args.users, args.updates, args.admin_share)
+        return
+
+    if not args.input:
+        parser.error("укажите файл с обновлениями или --generate")
+
+    updates = load(args.input)
+    results = {}
+
+    if not args.skip_sequential:
+        results['sequential'] = asyncio.run(replay(updates, SimpleUpdateProcessor(1), args))
+
+    results[f'per_user_x{args.concurrency}'] = asyncio.run(
+        replay(updates, PerUserUpdateProcessor(args.concurrency, [ADMIN_ID]), args)
+    )
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,29 @@ import logging
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ContextTypes, filters
+    ChatMemberHandler, ChatJoinRequestHandler, ContextTypes, filters
 )
+from telegram.error import BadRequest
 from datetime import datetime, timedelta
+import asyncio
+import signal
 import requests
 
 import config
 import database as db
 from stripe_integration import create_checkout_session, get_price_info
+from update_processor import PerUserUpdateProcessor
+from invite_links import get_or_create_invite_link
+from join_requests import create_batcher
+from channel_members import save_member, member_is_in_chat
+from stats import format_stats
+from rate_limiter import create_rate_limiter, tenant_scope
+from broadcast import run_broadcast, format_progress
+import metrics
+import profiling
+import tenants
+import user_profiles
+import cache_bus
 
 # Настройка логирования
 logging.basicConfig(
@@ -19,6 +34,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Типы обновлений, которые реально обрабатываются (остальные Telegram не присылает)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER, Update.CHAT_JOIN_REQUEST]
+
+def tenant_of(context: ContextTypes.DEFAULT_TYPE) -> tenants.Tenant:
+    """Тенант бота, получившего обновление (у каждого тенанта своё Application)"""
+    return context.bot_data['tenant']
+
 def get_main_keyboard(is_subscribed=False):
     """Клавиатура главного меню"""
     if is_subscribed:
@@ -32,14 +54,10 @@ def get_main_keyboard(is_subscribed=False):
         ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
-def get_plans_keyboard():
-    """Клавиатура выбора тарифа"""
-    keyboard = [
-        [KeyboardButton("📅 1 mes - 4.99 EUR")],
-        [KeyboardButton("📅 3 meses - 24.99 EUR (1 mes gratis)")],
-        [KeyboardButton("📅 12 meses - 44.99 EUR (3 meses gratis)")],
-        [KeyboardButton("« Atrás")]
-    ]
+def get_plans_keyboard(tenant):
+    """Клавиатура выбора тарифа (кнопки из каталога тенанта)"""
+    keyboard = [[KeyboardButton(info['label'])] for info in tenant.plans.values()]
+    keyboard.append([KeyboardButton("« Atrás")])
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 def get_admin_keyboard():
@@ -50,41 +68,46 @@ def get_admin_keyboard():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+@metrics.track_handler
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user = update.effective_user
+    tenant = tenant_of(context)
     
-    # Сохраняем пользователя в БД
-    db.add_or_update_user(
+    # Сохраняем пользователя в БД (только изменившийся профиль, пачкой)
+    await user_profiles.WRITER.save(
         telegram_id=user.id,
         username=user.username,
         first_name=user.first_name,
-        last_name=user.last_name
+        last_name=user.last_name,
+        tenant_id=tenant.id
     )
     
     # Проверяем активную подписку
-    subscription = db.get_active_subscription(user.id)
+    subscription = db.get_active_subscription(user.id, tenant.id)
     
     keyboard = get_main_keyboard(is_subscribed=bool(subscription))
     
     if subscription:
         expiry_date = datetime.fromisoformat(subscription['end_date']).strftime('%d.%m.%Y')
-        message = f"{config.MESSAGES['welcome']}\n\n✅ Tu suscripción está activa hasta {expiry_date}"
+        message = f"{tenant.messages['welcome']}\n\n✅ Tu suscripción está activa hasta {expiry_date}"
     else:
-        message = config.MESSAGES['welcome']
+        message = tenant.messages['welcome']
     
     await update.message.reply_text(message, reply_markup=keyboard)
 
+@metrics.track_handler
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Админ-панель"""
     user = update.effective_user
+    tenant = tenant_of(context)
     
-    if user.id not in config.ADMIN_IDS:
+    if user.id not in tenant.admin_ids:
         await update.message.reply_text("❌ No tienes acceso al panel de administración")
         return
     
     keyboard = get_admin_keyboard()
-    await update.message.reply_text(config.MESSAGES['admin_menu'], reply_markup=keyboard)
+    await update.message.reply_text(tenant.messages['admin_menu'], reply_markup=keyboard)
 
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений (кнопок)"""
@@ -105,7 +128,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await start_command(update, context)
     
     # Выбор тарифа
-    elif "mes" in text.lower() and "EUR" in text:
+    elif tenant_of(context).plan_for_label(text):
         await plan_selected(update, context, text)
     
     # Админ-панель
@@ -115,50 +138,49 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("Selecciona una opción del menú 👇")
 
+@metrics.track_handler
 async def show_plans(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать тарифные планы"""
-    keyboard = get_plans_keyboard()
-    await update.message.reply_text(config.MESSAGES['choose_plan'], reply_markup=keyboard)
+    tenant = tenant_of(context)
+    keyboard = get_plans_keyboard(tenant)
+    await update.message.reply_text(tenant.messages['choose_plan'], reply_markup=keyboard)
 
+@metrics.track_handler
 async def plan_selected(update: Update, context: ContextTypes.DEFAULT_TYPE, plan_text: str):
     """Обработка выбора тарифа"""
     user = update.effective_user
+    tenant = tenant_of(context)
     
-    # Определяем price_id по тексту (смотрим на начало строки, чтобы избежать ошибок с описанием)
-    if plan_text.startswith("📅 1 mes"):
-        price_id = config.STRIPE_PRICES['1_month']
-        plan = '1_month'
-    elif plan_text.startswith("📅 3 meses"):
-        price_id = config.STRIPE_PRICES['6_months']
-        plan = '6_months'
-    elif plan_text.startswith("📅 12 meses"):
-        price_id = config.STRIPE_PRICES['12_months']
-        plan = '12_months'
-    else:
+    # Определяем тариф по тексту кнопки из каталога тенанта
+    plan = tenant.plan_for_label(plan_text)
+    if not plan:
         await update.message.reply_text("❌ Plan no válido")
         return
+    price_id = tenant.plans[plan]['price_id']
     
     try:
-        # Создаём Checkout Session в Stripe
-        session = create_checkout_session(
+        # Создаём Checkout Session в Stripe (в отдельном потоке, чтобы не блокировать других юзеров)
+        session = await asyncio.to_thread(
+            create_checkout_session,
             price_id=price_id,
             customer_email=f"{user.id}@telegram.user",
             metadata={
                 'telegram_id': user.id,
                 'telegram_username': user.username or '',
-                'plan': plan
-            }
+                'plan': plan,
+                'tenant_id': tenant.id
+            },
+            stripe_account=tenant.stripe_account
         )
         
         if session and 'url' in session:
             # Сохраняем информацию о начале платежа
-            db.add_payment(
+            db.record_payment_pending(
                 telegram_id=user.id,
-                stripe_payment_id='',
                 stripe_checkout_session_id=session['id'],
                 amount=session.get('amount_total', 0),
                 currency=session.get('currency', 'eur'),
-                status='pending'
+                tenant_id=tenant.id
             )
             
             message = """✅ ¡El enlace de pago ha sido creado!
@@ -184,12 +206,14 @@ Después de completar el pago, recibirás automáticamente acceso al canal.
         logger.error(f"Ошибка создания Checkout Session: {e}")
         await update.message.reply_text("❌ Error al crear sesión de pago. Inténtalo de nuevo.")
 
+@metrics.track_handler
 async def get_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получить ссылку на канал"""
     user = update.effective_user
+    tenant = tenant_of(context)
     
     # Проверяем активную подписку
-    subscription = db.get_active_subscription(user.id)
+    subscription = db.get_active_subscription(user.id, tenant.id)
     
     if not subscription:
         message = "❌ No tienes una suscripción activa.\n\nCompra una suscripción para obtener acceso."
@@ -198,21 +222,21 @@ async def get_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        # Создаём одноразовую инвайт-ссылку
-        invite_link = await context.bot.create_chat_invite_link(
-            chat_id=config.CHANNEL_ID,
-            member_limit=1,
-            name=f"User_{user.id}",
-            expire_date=datetime.now() + timedelta(hours=24)
-        )
+        # Берём действующую ссылку из кэша или создаём одноразовую
+        invite_link = await get_or_create_invite_link(context.bot, tenant, user.id)
+        # В режиме заявок ссылка общая: доступ даёт одобрение заявки, а не сама ссылка
+        if config.CHANNEL_ACCESS_MODE == 'join_request':
+            note = "Envía la solicitud para unirte: se aprobará automáticamente mientras tu suscripción esté activa."
+        else:
+            note = "Este enlace es personal y válido solo para ti."
         
         message = f"""✅ ¡Tu suscripción está activa!
 
 Accede al canal privado a través del siguiente enlace:
 
-{invite_link.invite_link}
+{invite_link}
 
-Este enlace es personal y válido solo para ti."""
+{note}"""
         
         keyboard = get_main_keyboard(is_subscribed=True)
         await update.message.reply_text(message, reply_markup=keyboard, disable_web_page_preview=True)
@@ -221,10 +245,11 @@ Este enlace es personal y válido solo para ti."""
         logger.error(f"Ошибка создания invite link: {e}")
         await update.message.reply_text("❌ Error al crear el enlace. Inténtalo de nuevo.")
 
+@metrics.track_handler
 async def show_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать информацию о подписке"""
     user = update.effective_user
-    subscription = db.get_active_subscription(user.id)
+    subscription = db.get_active_subscription(user.id, tenant_of(context).id)
     
     if not subscription:
         message = "❌ No tienes una suscripción activa."
@@ -249,49 +274,349 @@ Tu acceso al canal privado está garantizado hasta la fecha de finalización."""
     
     await update.message.reply_text(message, reply_markup=keyboard)
 
+@metrics.track_handler
+async def channel_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Изменение участников канала: локальная таблица участников и использованные инвайт-ссылки"""
+    member_update = update.chat_member
+    tenant = tenant_of(context)
+    
+    if member_update.chat.id != tenant.channel_id:
+        return
+    
+    save_member(member_update.new_chat_member, tenant.id)
+    
+    if member_update.invite_link and member_is_in_chat(member_update.new_chat_member):
+        db.mark_invite_link_used(member_update.invite_link.invite_link, tenant.id)
+        logger.info(f"Пользователь {member_update.new_chat_member.user.id} вступил по инвайт-ссылке")
+
+@metrics.track_handler
+async def channel_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Заявка на вступление в канал (режим join_request)"""
+    join_request = update.chat_join_request
+    
+    if join_request.chat.id != tenant_of(context).channel_id:
+        return
+    
+    await context.bot_data['join_requests'].add(join_request)
+
 # === АДМИНСКИЕ ФУНКЦИИ ===
 
-async def admin_active_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Активные подписки"""
+@metrics.track_handler
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Статистика подписок (/stats)"""
+    user = update.effective_user
+    tenant = tenant_of(context)
+    if user.id not in tenant.admin_ids:
+        return
+    
+    await update.message.reply_text(format_stats(db.get_stats(tenant_id=tenant.id), tenant))
+
+@metrics.track_handler
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка всем активным подписчикам (/broadcast <текст>)"""
+    user = update.effective_user
+    tenant = tenant_of(context)
+    if user.id not in tenant.admin_ids:
+        return
+    
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await update.message.reply_text("Uso: /broadcast <texto del mensaje>")
+        return
+    
+    broadcast_id = db.create_broadcast(parts[1], user.id, tenant.id)
+    progress = await update.message.reply_text(format_progress(db.get_broadcast(broadcast_id)))
+    db.set_broadcast_progress_message(broadcast_id, progress.chat_id, progress.message_id)
+    
+    # Рассылка идёт в фоне, чтобы не держать очередь обновлений админа
+    context.application.create_task(run_broadcast(context.bot, broadcast_id))
+
+@metrics.track_handler
+async def broadcast_cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Остановить рассылку (/broadcast_cancel <id>)"""
     user = update.effective_user
-    if user.id not in config.ADMIN_IDS:
+    tenant = tenant_of(context)
+    if user.id not in tenant.admin_ids:
+        return
+    
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Uso: /broadcast_cancel <id>")
         return
     
-    from datetime import datetime
-    
-    with db.get_db() as conn:
-        cursor = conn.cursor()
-        current_time = datetime.now().isoformat()
-        cursor.execute("""
-            SELECT u.telegram_id, u.username, u.first_name,
-                   s.start_date, s.end_date
-            FROM subscriptions s
-            JOIN users u ON s.telegram_id = u.telegram_id
-            WHERE s.status = 'active' AND s.end_date > ?
-            ORDER BY s.end_date ASC
-        """, (current_time,))
-        subs = cursor.fetchall()
-    
-    if not subs:
-        await update.message.reply_text("📭 No hay suscripciones activas")
+    broadcast_id = int(context.args[0])
+    # Рассылки других тенантов для админа не существуют
+    broadcast = db.get_broadcast(broadcast_id)
+    if broadcast and broadcast['tenant_id'] == tenant.id and db.set_broadcast_status(broadcast_id, 'cancelled'):
+        await update.message.reply_text(f"⛔ Difusión #{broadcast_id} detenida")
+    else:
+        await update.message.reply_text(f"❌ Difusión #{broadcast_id} no encontrada o ya finalizada")
+
+@metrics.track_handler
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Профилирование бота (/profile [секунды] [sample|cprofile])"""
+    user = update.effective_user
+    if user.id not in tenant_of(context).admin_ids:
         return
     
-    message = f"💳 Suscripciones activas ({len(subs)}):\n\n"
+    seconds = None
+    mode = 'sample'
+    for arg in context.args or []:
+        if arg.isdigit():
+            seconds = int(arg)
+        elif arg in profiling.MODES:
+            mode = arg
+        else:
+            await update.message.reply_text("Uso: /profile [segundos] [sample|cprofile]")
+            return
     
-    for idx, s in enumerate(subs, 1):
-        user_id = s['telegram_id']
-        username = f"@{s['username']}" if s['username'] else "sin username"
-        name = s['first_name'] or "Sin nombre"
-        start = datetime.fromisoformat(s['start_date']).strftime('%d.%m.%Y %H:%M')
-        end = datetime.fromisoformat(s['end_date']).strftime('%d.%m.%Y %H:%M')
+    try:
+        session = profiling.start_profile(mode, seconds, 'bot')
+    except profiling.ProfilerBusy:
+        await update.message.reply_text("⏳ Ya hay un perfilado en curso")
+        return
+    
+    await update.message.reply_text(f"⏱ Perfilando el bot ({mode}, {session.seconds:.0f} s)...")
+    # Ждём в фоне, чтобы не держать очередь обновлений админа
+    context.application.create_task(send_profile(context.bot, update.effective_chat.id, session))
+
+async def send_profile(bot, chat_id: int, session):
+    """Отправить админу файл профиля после окончания сессии"""
+    await session.wait()
+    try:
+        with open(session.path, 'rb') as f:
+            await bot.send_document(chat_id=chat_id, document=f, caption=f"📊 Perfil: {session.path}")
+    except Exception as e:
+        logger.error(f"Не удалось отправить профиль {session.path}: {e}")
+        await bot.send_message(chat_id=chat_id, text=f"📊 Perfil guardado en el servidor: {session.path}")
+
+async def flush_user_profiles(application: Application):
+    """Остановка бота: записать профили из буфера"""
+    await user_profiles.WRITER.close()
+
+async def resume_broadcasts(application: Application):
+    """Продолжить рассылки тенанта, прерванные перезапуском бота"""
+    for broadcast in db.get_running_broadcasts(application.bot_data['tenant'].id):
+        logger.info(f"Продолжаем рассылку {broadcast['id']}")
+        application.create_task(run_broadcast(application.bot, broadcast['id']))
+
+async def on_startup(application: Application):
+    """Запуск бота: опрос шины кэшей (один на процесс) и прерванные рассылки"""
+    global _cache_bus_started
+    if not _cache_bus_started:
+        _cache_bus_started = True
+        application.create_task(cache_bus.BUS.run(config.CACHE_BUS_POLL_MS / 1000))
+    await resume_broadcasts(application)
+
+_cache_bus_started = False
+
+# Лимит Telegram на длину сообщения
+MESSAGE_LIMIT = 4096
+
+# Фильтры списка подписок: кнопка -> дней до окончания (None - все)
+SUBSCRIPTION_FILTERS = [("Todas", None), ("≤ 3 días", 3), ("≤ 7 días", 7), ("≤ 30 días", 30)]
+
+def render_subscriptions_page(tenant_id, days=None, direction='next', cursor=None):
+    """Текст и кнопки одной страницы активных подписок тенанта"""
+    rows, has_more = db.get_active_subscriptions_page(
+        limit=config.ADMIN_PAGE_SIZE,
+        cursor=cursor,
+        direction=direction,
+        expiring_within_days=days,
+        tenant_id=tenant_id
+    )
+    
+    if direction == 'next':
+        has_prev, has_next = cursor is not None, has_more
+    else:
+        has_prev, has_next = has_more, True
+    
+    title = "💳 Suscripciones activas" if days is None else f"💳 Suscripciones que finalizan en ≤ {days} días"
+    
+    if not rows:
+        lines = [title, "", "📭 No hay suscripciones activas"]
+    else:
+        records = []
+        for s in rows:
+            username = f"@{s['username']}" if s['username'] else "sin username"
+            name = s['first_name'] or "Sin nombre"
+            start = datetime.fromisoformat(s['start_date']).strftime('%d.%m.%Y %H:%M')
+            end = datetime.fromisoformat(s['end_date']).strftime('%d.%m.%Y %H:%M')
+            
+            records.append((s, "\n".join([
+                f"👤 User ID: {s['telegram_id']}",
+                f"📝 Cuenta: {name} ({username})",
+                f"📅 Activación: {start}",
+                f"⏰ Finalización: {end}",
+                f"{'─' * 30}\n",
+            ])))
+        
+        # Записи, не поместившиеся в сообщение, уходят на соседнюю страницу: набираем от
+        # курсора, чтобы кнопка вела к первой непоказанной записи
+        if direction != 'next':
+            records.reverse()
+        length = len(title) + 1
+        shown = []
+        for record in records:
+            if shown and length + len(record[1]) + 1 > MESSAGE_LIMIT:
+                if direction == 'next':
+                    has_next = True
+                else:
+                    has_prev = True
+                break
+            length += len(record[1]) + 1
+            shown.append(record)
+        if direction != 'next':
+            shown.reverse()
         
-        message += f"👤 User ID: {user_id}\n"
-        message += f"📝 Cuenta: {name} ({username})\n"
-        message += f"📅 Activación: {start}\n"
-        message += f"⏰ Finalización: {end}\n"
-        message += f"{'─' * 30}\n\n"
+        rows = [record[0] for record in shown]
+        lines = [title, ""] + [record[1] for record in shown]
+    
+    message = "\n".join(lines)
+    
+    # callback_data: subs:<дни>:<направление>:<end_date>:<id>
+    days_key = '' if days is None else str(days)
+    nav = []
+    if rows and has_prev:
+        first = rows[0]
+        nav.append(InlineKeyboardButton("« Anterior", callback_data=f"subs:{days_key}:prev:{first['end_date']}:{first['id']}"))
+    if rows and has_next:
+        last = rows[-1]
+        nav.append(InlineKeyboardButton("Siguiente »", callback_data=f"subs:{days_key}:next:{last['end_date']}:{last['id']}"))
+    
+    filters_row = [
+        InlineKeyboardButton(("• " if value == days else "") + label, callback_data=f"subs:{'' if value is None else value}:next::")
+        for label, value in SUBSCRIPTION_FILTERS
+    ]
     
-    await update.message.reply_text(message)
+    keyboard = [nav, filters_row] if nav else [filters_row]
+    return message, InlineKeyboardMarkup(keyboard)
+
+@metrics.track_handler
+async def admin_active_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Активные подписки (первая страница)"""
+    user = update.effective_user
+    tenant = tenant_of(context)
+    if user.id not in tenant.admin_ids:
+        return
+    
+    message, markup = render_subscriptions_page(tenant.id)
+    await update.message.reply_text(message, reply_markup=markup)
+
+@metrics.track_handler
+async def admin_subscriptions_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Переключение страниц и фильтров списка подписок (inline-кнопки)"""
+    query = update.callback_query
+    tenant = tenant_of(context)
+    
+    if query.from_user.id not in tenant.admin_ids:
+        await query.answer()
+        return
+    
+    _, days_key, direction, rest = query.data.split(':', 3)
+    end_date, sub_id = rest.rsplit(':', 1)
+    days = int(days_key) if days_key else None
+    cursor = (end_date, int(sub_id)) if sub_id else None
+    
+    message, markup = render_subscriptions_page(tenant.id, days, direction, cursor)
+    await query.answer()
+    
+    try:
+        await query.edit_message_text(message, reply_markup=markup)
+    except BadRequest as e:
+        # Повторное нажатие той же кнопки - текст не изменился
+        if "not modified" not in str(e).lower():
+            raise
+
+def build_application(tenant) -> Application:
+    """Application бота тенанта со всеми обработчиками"""
+    application = (
+        Application.builder()
+        .token(tenant.bot_token)
+        .base_url(config.TELEGRAM_API_URL)
+        .concurrent_updates(PerUserUpdateProcessor(config.TELEGRAM_CONCURRENT_UPDATES, tenant.admin_ids))
+        .rate_limiter(create_rate_limiter(tenant_scope(tenant)))
+        .post_init(on_startup)
+        .post_shutdown(flush_user_profiles)
+        .build()
+    )
+    application.bot_data['tenant'] = tenant
+    
+    # Регистрация обработчиков команд
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("admin", admin_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    
+    # Обработчик текстовых сообщений (кнопок)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    
+    # Страницы списка подписок в админ-панели
+    application.add_handler(CallbackQueryHandler(admin_subscriptions_page, pattern=r'^subs:'))
+    
+    # Изменения участников канала (таблица участников, кэш инвайт-ссылок)
+    application.add_handler(ChatMemberHandler(channel_member_update, ChatMemberHandler.CHAT_MEMBER))
+    
+    # Заявки на вступление (режим join_request)
+    if config.CHANNEL_ACCESS_MODE == 'join_request':
+        application.bot_data['join_requests'] = create_batcher(application.bot, tenant)
+        application.add_handler(ChatJoinRequestHandler(channel_join_request))
+    
+    return application
+
+def webhook_settings(tenant, index: int) -> dict:
+    """
+    Параметры webhook бота тенанта. Тенант 'default' - прежние TELEGRAM_WEBHOOK_*,
+    остальные слушают TELEGRAM_WEBHOOK_PORT + index с путём /<tenant_id>.
+    """
+    if tenant.id == tenants.DEFAULT_ID:
+        port, url_path, webhook_url = config.TELEGRAM_WEBHOOK_PORT, config.TELEGRAM_WEBHOOK_PATH, config.TELEGRAM_WEBHOOK_URL
+    else:
+        port = config.TELEGRAM_WEBHOOK_PORT + index
+        url_path = f"{config.TELEGRAM_WEBHOOK_PATH}/{tenant.id}"
+        webhook_url = f"{config.TELEGRAM_WEBHOOK_URL.rstrip('/')}/{tenant.id}"
+    return {
+        'listen': config.TELEGRAM_WEBHOOK_LISTEN,
+        'port': port,
+        'url_path': url_path,
+        'webhook_url': webhook_url,
+        'secret_token': config.TELEGRAM_WEBHOOK_SECRET,
+        'allowed_updates': ALLOWED_UPDATES,
+        'max_connections': config.TELEGRAM_WEBHOOK_MAX_CONNECTIONS
+    }
+
+async def run_applications(applications):
+    """Несколько ботов в одном процессе: общий event loop, свой updater у каждого"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    started = []
+    try:
+        for index, application in enumerate(applications):
+            await application.initialize()
+            started.append(application)
+            await application.post_init(application)
+            if config.TELEGRAM_UPDATE_MODE == 'webhook':
+                settings = webhook_settings(application.bot_data['tenant'], index)
+                await application.updater.start_webhook(**settings)
+                logger.info(f"Бот {application.bot_data['tenant'].id} запущен (webhook, порт {settings['port']})")
+            else:
+                await application.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+                logger.info(f"Бот {application.bot_data['tenant'].id} запущен (polling)")
+            await application.start()
+        await stop.wait()
+    finally:
+        # Останавливаем в обратном порядке; профили из общего буфера пишутся при каждой остановке
+        for application in reversed(started):
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+            await application.post_shutdown(application)
 
 def main():
     """Запуск бота"""
@@ -301,19 +626,25 @@ def main():
     # Инициализация БД
     db.init_db()
     
-    # Создание приложения
-    application = Application.builder().token(config.TELEGRAM_BOT_TOKEN).build()
+    # Своё Application на каждого тенанта (tenants.py)
+    applications = [build_application(tenant) for tenant in tenants.all_tenants()]
     
-    # Регистрация обработчиков команд
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("admin", admin_command))
+    # Метрики на отдельном порту
+    metrics.start_metrics_server(config.BOT_METRICS_PORT)
     
-    # Обработчик текстовых сообщений (кнопок)
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    if len(applications) > 1:
+        asyncio.run(run_applications(applications))
+        return
     
     # Запуск бота
-    logger.info("Бот запущен")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application = applications[0]
+    if config.TELEGRAM_UPDATE_MODE == 'webhook':
+        settings = webhook_settings(application.bot_data['tenant'], 0)
+        logger.info(f"Бот запущен (webhook, порт {settings['port']})")
+        application.run_webhook(**settings)
+    else:
+        logger.info("Бот запущен (polling)")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
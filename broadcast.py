@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Массовая рассылка всем активным подписчикам (админская команда /broadcast).
+
+Получатели выбираются из БД пачками (keyset по telegram_id) и попадают в outbox,
+где хранится состояние доставки каждому. Отправка идёт с ограниченной
+параллельностью через общий лимитер (приоритет bulk). Если процесс упал,
+рассылка продолжается с места остановки: получатели, которым сообщение
+уже могло уйти (статус sending), помечаются unknown и повторно не получают.
+
+Рассылку ведёт один процесс - держатель аренды broadcast:<id> (leader.py). Если бот
+и broadcast.py resume запущены для одной рассылки, второй запуск пропускается, а
+бывший держатель, потерявший аренду, не возьмёт следующую пачку (fencing-токен).
+
+Продолжить рассылку вручную (например, если бот не запущен):
+    python broadcast.py resume <id>
+"""
+import argparse
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden
+
+import config
+import database as db
+from leader import run_exclusive
+from rate_limiter import create_bot, PRIORITY_BULK
+import tenants
+import user_profiles
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+BULK = {'priority': PRIORITY_BULK}
+
+def format_progress(broadcast: dict) -> str:
+    """Текст сообщения с прогрессом рассылки"""
+    icons = {'running': '⏳', 'done': '✅', 'cancelled': '⛔'}
+    done = broadcast['sent'] + broadcast['failed'] + broadcast['blocked']
+    total = f"{broadcast['total']}" if broadcast['enqueued_all'] else f"{broadcast['total']}+"
+    return (
+        f"{icons.get(broadcast['status'], '📣')} Difusión #{broadcast['id']} ({broadcast['status']})\n\n"
+        f"Procesados: {done} / {total}\n"
+        f"✅ Enviados: {broadcast['sent']}\n"
+        f"🚫 Bloqueados: {broadcast['blocked']}\n"
+        f"❌ Errores: {broadcast['failed']}"
+    )
+
+async def _deliver(bot: Bot, tenant_id: str, telegram_id: int, text: str, semaphore: asyncio.Semaphore):
+    """Отправить сообщение одному получателю, вернуть (telegram_id, status, error)"""
+    async with semaphore:
+        try:
+            await bot.send_message(chat_id=telegram_id, text=text, rate_limit_args=BULK)
+            return telegram_id, 'sent', None
+        except Forbidden as e:
+            db.mark_user_blocked(telegram_id, tenant_id)
+            user_profiles.WRITER.forget(telegram_id, tenant_id)
+            return telegram_id, 'blocked', str(e)
+        except BadRequest as e:
+            return telegram_id, 'failed', str(e)
+        except Exception as e:
+            logger.error(f"Ошибка рассылки пользователю {telegram_id}: {e}")
+            return telegram_id, 'failed', str(e)
+
+async def _update_progress(bot: Bot, broadcast: dict):
+    """Обновить сообщение с прогрессом у админа"""
+    if not broadcast['progress_chat_id']:
+        return
+    try:
+        await bot.edit_message_text(
+            chat_id=broadcast['progress_chat_id'],
+            message_id=broadcast['progress_message_id'],
+            text=format_progress(broadcast)
+        )
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            logger.warning(f"Не удалось обновить прогресс рассылки {broadcast['id']}: {e}")
+    except Exception as e:
+        logger.warning(f"Не удалось обновить прогресс рассылки {broadcast['id']}: {e}")
+
+async def run_broadcast(bot: Bot, broadcast_id: int, concurrency: Optional[int] = None):
+    """
+    Выполнить (или продолжить) рассылку до конца (bot - бот тенанта рассылки).
+    Если рассылку уже ведёт другой процесс - вернуть её текущее состояние.
+    """
+    result = await run_exclusive(
+        f'broadcast:{broadcast_id}',
+        lambda lease: _run_broadcast(bot, broadcast_id, concurrency, lease),
+        cooldown=0
+    )
+    return result or db.get_broadcast(broadcast_id)
+
+async def _run_broadcast(bot: Bot, broadcast_id: int, concurrency: Optional[int], lease):
+    """Рассылка под арендой lease"""
+    concurrency = concurrency or config.BROADCAST_CONCURRENCY
+    semaphore = asyncio.Semaphore(concurrency)
+
+    stale = db.release_stale_broadcast_claims(broadcast_id, fence=lease.fence)
+    if stale:
+        logger.warning(f"Рассылка {broadcast_id}: {stale} получателей в неизвестном состоянии, пропускаем")
+
+    broadcast = db.get_broadcast(broadcast_id)
+    logger.info(f"Рассылка {broadcast_id} запущена")
+    last_progress = 0.0
+
+    while broadcast['status'] == 'running':
+        lease.check()
+        recipients = db.claim_broadcast_recipients(broadcast_id, concurrency, fence=lease.fence)
+
+        if not recipients:
+            # Outbox пуст: добавляем следующую пачку получателей или завершаем
+            if broadcast['enqueued_all']:
+                db.set_broadcast_status(broadcast_id, 'done')
+            else:
+                db.enqueue_broadcast_chunk(broadcast_id, config.BROADCAST_CHUNK_SIZE)
+            broadcast = db.get_broadcast(broadcast_id)
+            continue
+
+        results = await asyncio.gather(*[
+            _deliver(bot, broadcast['tenant_id'], telegram_id, broadcast['text'], semaphore)
+            for telegram_id in recipients
+        ])
+        db.record_broadcast_results(broadcast_id, results)
+
+        # Статус перечитываем каждую пачку - так работает отмена из другого обработчика
+        broadcast = db.get_broadcast(broadcast_id)
+        if time.monotonic() - last_progress >= config.BROADCAST_PROGRESS_INTERVAL:
+            await _update_progress(bot, broadcast)
+            last_progress = time.monotonic()
+
+    await _update_progress(bot, broadcast)
+    logger.info(
+        f"Рассылка {broadcast_id} завершена ({broadcast['status']}): "
+        f"отправлено {broadcast['sent']}, заблокировали {broadcast['blocked']}, ошибок {broadcast['failed']}"
+    )
+    return broadcast
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Массовая рассылка подписчикам")
+    sub = parser.add_subparsers(dest='command', required=True)
+    resume = sub.add_parser('resume', help="Продолжить рассылку")
+    resume.add_argument('broadcast_id', type=int)
+    status = sub.add_parser('status', help="Показать прогресс рассылки")
+    status.add_argument('broadcast_id', type=int)
+    args = parser.parse_args()
+
+    db.init_db()
+    broadcast = db.get_broadcast(args.broadcast_id)
+    if not broadcast:
+        parser.error(f"рассылка {args.broadcast_id} не найдена")
+
+    if args.command == 'resume':
+        config.validate_config()
+
+        async def run():
+            async with create_bot(tenants.get(broadcast['tenant_id'])) as bot:
+                await run_broadcast(bot, args.broadcast_id)
+
+        asyncio.run(run())
+        broadcast = db.get_broadcast(args.broadcast_id)
+
+    print(format_progress(broadcast))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Шина инвалидации кэшей между процессами (бот, webhook-сервер, проверка подписок).
+
+Сообщение - (entity, key, version): «строка entity с ключом key изменилась, версия
+version». database.py публикует его после коммита изменения, процессы с кэшами
+подписываются и выбрасывают/перечитывают ключ. Журнал сообщений - общий SQLite-файл
+CACHE_BUS_DB (как у rate_limiter.py); подписчик опрашивает PRAGMA data_version, так что
+пока ничего не менялось, опрос не читает таблицу. Если подписчик отстал дальше, чем
+хранится журнал, он получает key=None - «сбросить всё».
+
+Благодаря шине кэши могут жить долго (JOIN_REQUEST_CACHE_TTL), не отдавая устаревшее
+состояние подписки после оплаты.
+"""
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+class CacheBus:
+    """Журнал инвалидаций в SQLite-файле, общий для нескольких процессов"""
+
+    def __init__(self, path: str, retention_seconds: float):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self._conn = None
+        self._reader = None
+        self._lock = threading.Lock()
+        self._published = 0
+        self._last_seq = None
+        self._data_version = None
+        self._handlers: Dict[str, List[Callable]] = defaultdict(list)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = self._open()
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS invalidations (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    entity TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    version REAL NOT NULL,
+                    created REAL NOT NULL
+                )
+            ''')
+        return self._conn
+
+    def _connect_reader(self):
+        # data_version не меняется от коммитов своего же соединения, поэтому
+        # опрос идёт отдельным - так доходят и сообщения этого процесса
+        if self._reader is None:
+            self._connect()
+            self._reader = self._open()
+        return self._reader
+
+    def publish(self, entity: str, key, version: Optional[float] = None):
+        """Сообщить об изменении; ошибки шины не должны ломать запись в БД"""
+        if not self.path:
+            return
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute('INSERT INTO invalidations (entity, key, version, created) VALUES (?, ?, ?, ?)',
+                             (entity, str(key), version if version is not None else now, now))
+                # Изредка чистим журнал
+                self._published += 1
+                if self._published % 500 == 0:
+                    conn.execute('DELETE FROM invalidations WHERE created < ?', (now - self.retention_seconds,))
+        except sqlite3.Error as e:
+            logger.warning(f"Не удалось опубликовать инвалидацию {entity}:{key}: {e}")
+
+    def subscribe(self, entity: str, handler: Callable):
+        """handler(key, version) на каждое сообщение entity; key=None - сбросить всё"""
+        self._handlers[entity].append(handler)
+
+    def poll(self) -> int:
+        """Доставить новые сообщения подписчикам, вернуть их количество"""
+        if not self.path:
+            return 0
+        with self._lock:
+            conn = self._connect_reader()
+            data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+            if self._last_seq is not None and data_version == self._data_version:
+                return 0
+            self._data_version = data_version
+
+            if self._last_seq is None:
+                # Первый опрос: история до запуска не нужна, кэши ещё пусты
+                self._last_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM invalidations').fetchone()[0]
+                return 0
+
+            oldest = conn.execute('SELECT MIN(seq) FROM invalidations').fetchone()[0]
+            rows = conn.execute('''
+                SELECT seq, entity, key, version FROM invalidations WHERE seq > ? ORDER BY seq
+            ''', (self._last_seq,)).fetchall()
+            gap = oldest is not None and oldest > self._last_seq + 1
+            if rows:
+                self._last_seq = rows[-1][0]
+
+        if gap:
+            logger.warning("Шина кэшей: часть сообщений уже удалена из журнала, кэши сбрасываются")
+            for entity in list(self._handlers):
+                self._dispatch(entity, None, None)
+            return len(rows)
+
+        for _, entity, key, version in rows:
+            self._dispatch(entity, key, version)
+        return len(rows)
+
+    def _dispatch(self, entity, key, version):
+        for handler in self._handlers.get(entity, ()):
+            try:
+                handler(key, version)
+            except Exception as e:
+                logger.error(f"Ошибка обработки инвалидации {entity}:{key}: {e}")
+
+    async def run(self, interval: float):
+        """Фоновый опрос шины в event loop процесса"""
+        if not self.path:
+            return
+        self.poll()
+        logger.info(f"Шина кэшей: опрос каждые {interval * 1000:.0f} мс")
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.poll()
+            except sqlite3.Error as e:
+                logger.warning(f"Ошибка опроса шины кэшей: {e}")
+
+BUS = CacheBus(config.CACHE_BUS_DB, config.CACHE_BUS_RETENTION_SECONDS)
+
+def publish(entity: str, key, version: Optional[float] = None):
+    """Опубликовать инвалидацию в общую шину"""
+    BUS.publish(entity, key, version)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Локальная таблица участников канала.
+
+Бот обновляет её по chat_member, поэтому продление и удаление по истечению
+подписки не спрашивают Telegram, состоит ли пользователь в канале.
+
+Разовое заполнение для уже существующих подписчиков (всех тенантов или одного):
+    python channel_members.py backfill [--tenant ID]
+"""
+import argparse
+import asyncio
+import logging
+
+from telegram import Bot, ChatMember
+from telegram.error import RetryAfter
+
+import config
+import database as db
+from rate_limiter import create_bot, PRIORITY_BULK
+import tenants
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+def member_is_in_chat(member: ChatMember) -> bool:
+    """Находится ли пользователь в канале по объекту ChatMember"""
+    if member.status in (ChatMember.OWNER, ChatMember.ADMINISTRATOR, ChatMember.MEMBER):
+        return True
+    if member.status == ChatMember.RESTRICTED:
+        return bool(getattr(member, 'is_member', False))
+    return False
+
+def save_member(member: ChatMember, tenant_id: str = tenants.DEFAULT_ID):
+    """Записать статус ChatMember в локальную таблицу"""
+    db.set_channel_member_status(member.user.id, member.status, member_is_in_chat(member), tenant_id)
+
+async def backfill(bot: Bot, tenant, batch_size: int = 100, delay: float = 0.05):
+    """Запросить статус всех известных пользователей тенанта и сохранить пачками"""
+    telegram_ids = db.get_known_telegram_ids(tenant.id)
+    logger.info(f"Заполнение таблицы участников {tenant.id}: {len(telegram_ids)} пользователей")
+
+    batch = []
+    done = 0
+    for telegram_id in telegram_ids:
+        while True:
+            try:
+                member = await bot.get_chat_member(
+                    tenant.channel_id, telegram_id, rate_limit_args={'priority': PRIORITY_BULK}
+                )
+                batch.append((telegram_id, member.status, member_is_in_chat(member)))
+                break
+            except RetryAfter as e:
+                logger.warning(f"Лимит Telegram, пауза {e.retry_after} сек")
+                await asyncio.sleep(float(e.retry_after))
+            except Exception as e:
+                logger.error(f"Ошибка получения статуса {telegram_id}: {e}")
+                break
+
+        if len(batch) >= batch_size:
+            db.set_channel_member_statuses(batch, tenant.id)
+            done += len(batch)
+            batch = []
+            logger.info(f"Сохранено: {done}/{len(telegram_ids)}")
+
+        await asyncio.sleep(delay)
+
+    if batch:
+        db.set_channel_member_statuses(batch, tenant.id)
+        done += len(batch)
+
+    logger.info(f"Заполнение завершено: {done}")
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Таблица участников канала")
+    sub = parser.add_subparsers(dest='command', required=True)
+    fill = sub.add_parser('backfill', help="Разово заполнить таблицу через getChatMember")
+    fill.add_argument('--delay', type=float, default=0.05, help="Пауза между запросами, сек")
+    fill.add_argument('--tenant', help="Только этот тенант (по умолчанию все)")
+    args = parser.parse_args()
+
+    config.validate_config()
+    db.init_db()
+
+    async def run():
+        for tenant in [tenants.get(args.tenant)] if args.tenant else tenants.all_tenants():
+            async with create_bot(tenant) as bot:
+                await backfill(bot, tenant, delay=args.delay)
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    main()
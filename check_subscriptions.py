@@ -2,14 +2,24 @@
 """
 Скрипт для проверки истёкших подписок и удаления пользователей из канала.
 Запускать как крон-задачу каждые 6-12 часов.
+Проверяются подписки всех тенантов (tenants.py), каждый - своим ботом и каналом.
 """
 import logging
 import asyncio
-from telegram import Bot
+import time
+import telegram
 from datetime import datetime, timedelta
 
 import config
 import database as db
+from invite_links import revoke_superseded_invite_links
+from rate_limiter import create_bot, PRIORITY_BULK
+from leader import run_exclusive
+import metrics
+import tenants
+
+# Проверка - массовая рассылка, она не должна вытеснять сообщения после оплаты
+BULK = {'priority': PRIORITY_BULK}
 
 # Настройка логирования
 logging.basicConfig(
@@ -18,15 +28,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-async def check_and_remove_expired():
+async def check_and_remove_expired(lease=None):
     """
     Проверить истёкшие подписки:
     - Через 24 часа после истечения → отправить предупреждение
     - Через 48 часов после истечения → удалить из канала
+    
+    lease - аренда leader.py: перед каждым пользователем проверяется, что она не потеряна,
+    а подписки помечаются expired только с её fencing-токеном.
     """
+    fence = lease.fence if lease else None
     logger.info("Начало проверки истёкших подписок")
+    sweep_started = time.perf_counter()
+    
+    # Боты тенантов создаются по мере надобности
+    bots = {}
     
-    bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
+    def bot_for(tenant):
+        if tenant.id not in bots:
+            bots[tenant.id] = create_bot(tenant)
+        return bots[tenant.id]
     
     # Получаем истёкшие подписки
     expired = db.get_expired_subscriptions()
@@ -39,46 +60,55 @@ async def check_and_remove_expired():
     # 1. Прошло 24-48 часов → отправить предупреждение
     # 2. Прошло 48+ часов → удалить из канала
     
+    # Ключ - (tenant_id, telegram_id): у одного юзера могут быть подписки в разных каналах
     users_to_warn = {}      # Через 24ч - предупреждение
     users_to_remove = {}    # Через 48ч - удаление
+    unknown_tenants = set()
     
     for sub in expired:
         end_date = datetime.fromisoformat(sub['end_date'])
         time_elapsed = now - end_date
         telegram_id = sub['telegram_id']
+        key = (sub['tenant_id'], telegram_id)
+        
+        if sub['tenant_id'] not in tenants.TENANTS:
+            # Тенант убран из конфигурации - его бот и канал неизвестны
+            unknown_tenants.add(sub['tenant_id'])
+            continue
         
         if time_elapsed >= grace_period_48h:
             # Прошло 48+ часов - удаляем
-            if telegram_id not in users_to_remove:
-                users_to_remove[telegram_id] = []
-            users_to_remove[telegram_id].append(sub)
+            if key not in users_to_remove:
+                users_to_remove[key] = []
+            users_to_remove[key].append(sub)
         elif time_elapsed >= grace_period_24h:
             # Прошло 24-48 часов - предупреждаем
-            if telegram_id not in users_to_warn:
-                users_to_warn[telegram_id] = []
-            users_to_warn[telegram_id].append(sub)
+            if key not in users_to_warn:
+                users_to_warn[key] = []
+            users_to_warn[key].append(sub)
         else:
             # Прошло < 24 часов - ничего не делаем (ждём)
             logger.info(f"⏳ Юзер {telegram_id} в первом льготном периоде (истекло {end_date.strftime('%d.%m %H:%M')})")
     
+    for tenant_id in unknown_tenants:
+        logger.warning(f"Пропуск истёкших подписок тенанта {tenant_id}: нет в конфигурации")
     logger.info(f"К предупреждению (24ч): {len(users_to_warn)}, к удалению (48ч): {len(users_to_remove)}")
+    metrics.SWEEP_SIZE.labels(kind='expired').set(len(expired))
+    metrics.SWEEP_SIZE.labels(kind='warn').set(len(users_to_warn))
+    metrics.SWEEP_SIZE.labels(kind='remove').set(len(users_to_remove))
     
     # === ПРЕДУПРЕЖДАЕМ (прошло 24ч) ===
-    for telegram_id, subs in users_to_warn.items():
+    for (tenant_id, telegram_id), subs in users_to_warn.items():
+        if lease:
+            lease.check()
+        tenant = tenants.get(tenant_id)
         # Проверяем, есть ли ДРУГИЕ активные подписки
-        active_sub = db.get_active_subscription(telegram_id)
+        active_sub = db.get_active_subscription(telegram_id, tenant_id)
         
         if active_sub:
             logger.info(f"⏭️ Пропуск предупреждения {telegram_id}: есть активная подписка до {active_sub['end_date']}")
             # Помечаем старые как expired
-            with db.get_db() as conn:
-                cursor = conn.cursor()
-                for sub in subs:
-                    cursor.execute('''
-                        UPDATE subscriptions
-                        SET status = 'expired', updated_at = ?
-                        WHERE id = ?
-                    ''', (datetime.now().isoformat(), sub['id']))
+            db.expire_subscriptions([sub['id'] for sub in subs], fence=fence)
             continue
         
         # Нет активных - отправляем ПРЕДУПРЕЖДЕНИЕ
@@ -89,69 +119,67 @@ Tienes 24 horas para renovarla antes de perder el acceso al canal.
 
 Para renovar, selecciona un plan en el bot."""
             
-            await bot.send_message(chat_id=telegram_id, text=warning_message)
+            await bot_for(tenant).send_message(chat_id=telegram_id, text=warning_message, rate_limit_args=BULK)
             logger.info(f"⚠️ Предупреждение отправлено {telegram_id}")
         except Exception as e:
             logger.error(f"Ошибка отправки предупреждения {telegram_id}: {e}")
     
     # === УДАЛЯЕМ (прошло 48ч) ===
-    for telegram_id, subs in users_to_remove.items():
+    for (tenant_id, telegram_id), subs in users_to_remove.items():
+        if lease:
+            lease.check()
+        tenant = tenants.get(tenant_id)
+        bot = bot_for(tenant)
         
         try:
             # ВАЖНО: Проверяем, есть ли у юзера ДРУГИЕ активные подписки
-            active_sub = db.get_active_subscription(telegram_id)
+            active_sub = db.get_active_subscription(telegram_id, tenant_id)
             
             if active_sub:
                 logger.info(f"⏭️ Пропуск удаления {telegram_id}: есть активная подписка до {active_sub['end_date']}")
                 
                 # Старые истёкшие помечаем как expired, но пользователя НЕ удаляем
-                with db.get_db() as conn:
-                    cursor = conn.cursor()
-                    for sub in subs:
-                        cursor.execute('''
-                            UPDATE subscriptions
-                            SET status = 'expired', updated_at = ?
-                            WHERE id = ?
-                        ''', (datetime.now().isoformat(), sub['id']))
+                db.expire_subscriptions([sub['id'] for sub in subs], fence=fence)
                 
                 logger.info(f"Старые подписки помечены как expired, но юзер {telegram_id} остаётся в канале")
                 continue
             
             # Нет активных подписок - УДАЛЯЕМ из канала
-            logger.info(f"❌ Удаляем {telegram_id} из канала (прошло 48ч, нет активных подписок)")
+            # (если по локальной таблице юзер точно не в канале - банить некого)
+            was_member = db.is_channel_member(telegram_id, tenant_id) is not False
             
-            # Удаляем пользователя из канала
-            await bot.ban_chat_member(chat_id=config.CHANNEL_ID, user_id=telegram_id)
-            await bot.unban_chat_member(chat_id=config.CHANNEL_ID, user_id=telegram_id)
+            if was_member:
+                logger.info(f"❌ Удаляем {telegram_id} из канала (прошло 48ч, нет активных подписок)")
+                
+                # Удаляем пользователя из канала
+                await bot.ban_chat_member(chat_id=tenant.channel_id, user_id=telegram_id, rate_limit_args=BULK)
+                await bot.unban_chat_member(chat_id=tenant.channel_id, user_id=telegram_id, rate_limit_args=BULK)
+                db.set_channel_member_status(telegram_id, 'left', False, tenant_id)
+                
+                logger.info(f"✅ Пользователь {telegram_id} удалён из канала")
+            else:
+                logger.info(f"⏭️ Юзер {telegram_id} не в канале, удаление пропущено")
             
-            logger.info(f"✅ Пользователь {telegram_id} удалён из канала")
+            # Неиспользованную ссылку отзываем в конце проверки
+            db.supersede_invite_links(telegram_id, tenant_id)
             
             # Обновляем статус ВСЕХ его подписок на 'expired'
-            with db.get_db() as conn:
-                cursor = conn.cursor()
-                for sub in subs:
-                    cursor.execute('''
-                        UPDATE subscriptions
-                        SET status = 'expired', updated_at = ?
-                        WHERE id = ?
-                    ''', (datetime.now().isoformat(), sub['id']))
+            db.expire_subscriptions([sub['id'] for sub in subs], fence=fence)
             
             # Уведомляем админов (получаем имя пользователя)
-            with db.get_db() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT username, first_name FROM users WHERE telegram_id = ?", (telegram_id,))
-                user_info = cursor.fetchone()
+            user_info = db.get_user_by_telegram_id(telegram_id, tenant_id)
             
+            removed_text = "Usuario eliminado del canal." if was_member else "El usuario no estaba en el canal."
             if user_info:
                 username = f"@{user_info['username']}" if user_info['username'] else "sin username"
                 name = user_info['first_name'] or "Sin nombre"
-                admin_message = f"⚠️ Suscripción expirada: {name} ({username}). Usuario eliminado del canal."
+                admin_message = f"⚠️ Suscripción expirada: {name} ({username}). {removed_text}"
             else:
-                admin_message = f"⚠️ Suscripción expirada. Usuario eliminado del canal."
+                admin_message = f"⚠️ Suscripción expirada. {removed_text}"
             
-            for admin_id in config.ADMIN_IDS:
+            for admin_id in tenant.admin_ids:
                 try:
-                    await bot.send_message(chat_id=admin_id, text=admin_message)
+                    await bot.send_message(chat_id=admin_id, text=admin_message, rate_limit_args=BULK)
                 except Exception as ex:
                     logger.error(f"Ошибка уведомления админа {admin_id}: {ex}")
         
@@ -163,15 +191,28 @@ Para renovar, selecciona un plan en el bot."""
             else:
                 logger.error(f"❌ Ошибка Telegram для {telegram_id}: {e}")
         
+        except db.LeaseLost:
+            raise
+        
         except Exception as e:
             logger.error(f"Ошибка при удалении пользователя {telegram_id}: {e}")
     
+    # === ОТЗЫВАЕМ НЕНУЖНЫЕ ИНВАЙТ-ССЫЛКИ ===
+    for tenant in tenants.all_tenants():
+        try:
+            await revoke_superseded_invite_links(bot_for(tenant), tenant)
+        except Exception as e:
+            logger.error(f"Ошибка отзыва инвайт-ссылок {tenant.id}: {e}")
+    
+    metrics.SWEEP_SECONDS.observe(time.perf_counter() - sweep_started)
     logger.info("Проверка завершена")
 
 def main():
     """Точка входа"""
     config.validate_config()
-    asyncio.run(check_and_remove_expired())
+    db.init_db()
+    # На нескольких узлах проверку выполняет один (см. leader.py)
+    asyncio.run(run_exclusive('expiry_sweep', check_and_remove_expired))
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,16 +10,131 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 CHANNEL_ID = int(os.getenv('CHANNEL_ID', 0))
 ADMIN_IDS = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
 
+# Дополнительные боты-каналы (JSON, см. tenants.py); переменные выше - тенант 'default'
+TENANTS_FILE = os.getenv('TENANTS_FILE', '')
+
+# Bot API (можно указать локальную заглушку, см. fake_telegram_api.py)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+
+# Режим получения обновлений: polling или webhook
+TELEGRAM_UPDATE_MODE = os.getenv('TELEGRAM_UPDATE_MODE', 'polling').lower()
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL', '')
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')
+TELEGRAM_WEBHOOK_LISTEN = os.getenv('TELEGRAM_WEBHOOK_LISTEN', '127.0.0.1')
+TELEGRAM_WEBHOOK_PORT = int(os.getenv('TELEGRAM_WEBHOOK_PORT', 8443))
+TELEGRAM_WEBHOOK_PATH = os.getenv('TELEGRAM_WEBHOOK_PATH', 'telegram')
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = int(os.getenv('TELEGRAM_WEBHOOK_MAX_CONNECTIONS', 40))
+
+# Сколько обновлений обрабатывается одновременно (обновления одного юзера - всегда по очереди)
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv('TELEGRAM_CONCURRENT_UPDATES', 16))
+
+# Инвайт-ссылки: срок жизни и минимальный остаток, при котором ссылка выдаётся повторно
+INVITE_LINK_TTL_HOURS = int(os.getenv('INVITE_LINK_TTL_HOURS', 24))
+INVITE_LINK_MIN_REMAINING_MINUTES = int(os.getenv('INVITE_LINK_MIN_REMAINING_MINUTES', 60))
+
+# Доступ в канал: invite_link (персональные ссылки) или join_request (одна ссылка с заявками)
+CHANNEL_ACCESS_MODE = os.getenv('CHANNEL_ACCESS_MODE', 'invite_link').lower()
+CHANNEL_JOIN_LINK = os.getenv('CHANNEL_JOIN_LINK', '')
+JOIN_REQUEST_CACHE_TTL = int(os.getenv('JOIN_REQUEST_CACHE_TTL', 3600))
+JOIN_REQUEST_BATCH_INTERVAL_MS = int(os.getenv('JOIN_REQUEST_BATCH_INTERVAL_MS', 500))
+JOIN_REQUEST_BATCH_SIZE = int(os.getenv('JOIN_REQUEST_BATCH_SIZE', 50))
+
+# Отложенная запись профилей на /start (см. user_profiles.py)
+USER_WRITE_INTERVAL_MS = int(os.getenv('USER_WRITE_INTERVAL_MS', 500))
+USER_WRITE_BATCH_SIZE = int(os.getenv('USER_WRITE_BATCH_SIZE', 100))
+USER_FINGERPRINT_CACHE_SIZE = int(os.getenv('USER_FINGERPRINT_CACHE_SIZE', 200000))
+
+# Межпроцессная шина инвалидации кэшей (см. cache_bus.py); пустой путь - отключена
+CACHE_BUS_DB = os.getenv('CACHE_BUS_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache_bus.db'))
+CACHE_BUS_POLL_MS = int(os.getenv('CACHE_BUS_POLL_MS', 200))
+CACHE_BUS_RETENTION_SECONDS = int(os.getenv('CACHE_BUS_RETENTION_SECONDS', 3600))
+
+# Плановые задачи на нескольких узлах (см. leader.py): срок аренды и пауза после разового запуска
+LEADER_LEASE_SECONDS = float(os.getenv('LEADER_LEASE_SECONDS', 60))
+LEADER_JOB_COOLDOWN_SECONDS = float(os.getenv('LEADER_JOB_COOLDOWN_SECONDS', 600))
+
+# Админ-панель: подписок на странице
+ADMIN_PAGE_SIZE = int(os.getenv('ADMIN_PAGE_SIZE', 10))
+
+# Массовые рассылки (/broadcast)
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 8))
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', 500))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', 3))
+
+# Сводка для админов: больше N сообщений - отправляется CSV-файлом
+DIGEST_MAX_MESSAGES = int(os.getenv('DIGEST_MAX_MESSAGES', 3))
+
 # Stripe Configuration
 STRIPE_API_KEY = os.getenv('STRIPE_API_KEY')
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET', '')
+# Stripe API (можно указать локальную заглушку, см. fake_stripe_api.py)
+STRIPE_API_URL = os.getenv('STRIPE_API_URL', 'https://api.stripe.com/v1').rstrip('/')
 
 # Server Configuration
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', 'http://localhost:8080/webhook')
 PORT = int(os.getenv('PORT', 8080))
 
+# Метрики Prometheus (0 - не поднимать отдельный порт)
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+BOT_METRICS_PORT = int(os.getenv('BOT_METRICS_PORT', 9101))
+AUTOCHECK_METRICS_PORT = int(os.getenv('AUTOCHECK_METRICS_PORT', 9102))
+
+# Профилирование по запросу (/profile, POST /debug/profile) и лог медленных обработчиков
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PROFILE_DEFAULT_SECONDS = int(os.getenv('PROFILE_DEFAULT_SECONDS', 30))
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', 300))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', 5))
+SLOW_HANDLER_MS = float(os.getenv('SLOW_HANDLER_MS', 1000))
+
+# Трассировка событий Stripe (JSONL, пустое значение - отключено), см. tracing.py
+TRACE_FILE = os.getenv('TRACE_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces.jsonl'))
+TRACE_MAX_MB = float(os.getenv('TRACE_MAX_MB', 50))
+
+# Журнал сырых событий Stripe для replay.py (пустое значение - отключён)
+WEBHOOK_CAPTURE_DIR = os.getenv('WEBHOOK_CAPTURE_DIR', '')
+WEBHOOK_CAPTURE_ROTATE_MB = float(os.getenv('WEBHOOK_CAPTURE_ROTATE_MB', 64))
+WEBHOOK_CAPTURE_KEEP_DAYS = int(os.getenv('WEBHOOK_CAPTURE_KEEP_DAYS', 30))
+
 # Database Configuration
+# sqlite:///bot_database.db (путь относительно кода), sqlite:///:memory: или postgresql://...
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///bot_database.db')
+# Соединений в пуле PostgreSQL на процесс
+DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', 10))
+
+# Архивация старых строк (см. retention.py; 0 дней - политика отключена)
+RETENTION_SUBSCRIPTION_DAYS = int(os.getenv('RETENTION_SUBSCRIPTION_DAYS', 180))
+RETENTION_PAYMENT_DAYS = int(os.getenv('RETENTION_PAYMENT_DAYS', 30))
+RETENTION_ARCHIVE_DB = os.getenv('RETENTION_ARCHIVE_DB', '')
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 500))
+RETENTION_BATCH_PAUSE_MS = float(os.getenv('RETENTION_BATCH_PAUSE_MS', 50))
+RETENTION_VACUUM_PAGES = int(os.getenv('RETENTION_VACUUM_PAGES', 1000))
+
+# Резервные копии SQLite (см. backup.py): каталог, сколько снимков хранить,
+# страниц за шаг копирования и пауза между шагами
+BACKUP_DIR = os.getenv('BACKUP_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backups')
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', 7))
+BACKUP_STEP_PAGES = int(os.getenv('BACKUP_STEP_PAGES', 256))
+BACKUP_STEP_PAUSE_MS = float(os.getenv('BACKUP_STEP_PAUSE_MS', 20))
+# Непрерывная архивация WAL (python backup.py archive-wal). Включать во всех процессах:
+# checkpoint тогда делает только архиватор
+BACKUP_WAL_ARCHIVE = os.getenv('BACKUP_WAL_ARCHIVE', '').lower() in ('1', 'true', 'yes')
+BACKUP_WAL_INTERVAL_SECONDS = float(os.getenv('BACKUP_WAL_INTERVAL_SECONDS', 10))
+BACKUP_WAL_CHECKPOINT_FRAMES = int(os.getenv('BACKUP_WAL_CHECKPOINT_FRAMES', 1000))
+BACKUP_WAL_GENERATION_HOURS = float(os.getenv('BACKUP_WAL_GENERATION_HOURS', 24))
+
+# Сверка со Stripe (reconcile.py): размер пачки и окно Checkout Sessions в днях
+RECONCILE_CHUNK_SIZE = int(os.getenv('RECONCILE_CHUNK_SIZE', 500))
+RECONCILE_SESSION_DAYS = int(os.getenv('RECONCILE_SESSION_DAYS', 7))
+
+# Общий лимит запросов к Telegram для всех процессов (см. rate_limiter.py)
+RATE_LIMIT_DB = os.getenv('RATE_LIMIT_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rate_limit.db'))
+TELEGRAM_RATE_GLOBAL = float(os.getenv('TELEGRAM_RATE_GLOBAL', 25))
+TELEGRAM_RATE_PER_CHAT = float(os.getenv('TELEGRAM_RATE_PER_CHAT', 1))
+TELEGRAM_RATE_PER_GROUP = float(os.getenv('TELEGRAM_RATE_PER_GROUP', 0.33))
+TELEGRAM_RATE_CHAT_BURST = float(os.getenv('TELEGRAM_RATE_CHAT_BURST', 3))
+TELEGRAM_RATE_BULK_RESERVE = float(os.getenv('TELEGRAM_RATE_BULK_RESERVE', 0.3))
 
 # Stripe Price IDs (автоматически подтягиваются из API)
 STRIPE_PRICES = {
@@ -27,6 +143,24 @@ STRIPE_PRICES = {
     '12_months': 'price_1SrktMAQcjmHJH4y55By2JLp'  # 44.99 EUR/12 месяцев
 }
 
+# Стоимость тарифов в центах и длительность в месяцах (для расчёта MRR в /stats)
+PLAN_PRICES_CENTS = {
+    '1_month': 499,
+    '6_months': 2499,
+    '12_months': 4499
+}
+PLAN_MONTHS = {
+    '1_month': 1,
+    '6_months': 6,
+    '12_months': 12
+}
+# Кнопки выбора тарифа
+PLAN_LABELS = {
+    '1_month': "📅 1 mes - 4.99 EUR",
+    '6_months': "📅 3 meses - 24.99 EUR (1 mes gratis)",
+    '12_months': "📅 12 meses - 44.99 EUR (3 meses gratis)"
+}
+
 # Тексты бота (испанский)
 MESSAGES = {
     'welcome': """👋🏻 Bienvenido a ENGUERRADOS
@@ -77,7 +211,11 @@ Selecciona una opción:""",
     
     'admin_menu': """👨‍💼 Admin Panel
 
-Comandos disponibles:"""
+Comandos disponibles:
+/stats - estadísticas de suscripciones
+/broadcast <texto> - enviar un mensaje a todos los suscriptores activos
+/broadcast_cancel <id> - detener una difusión
+/profile [segundos] [sample|cprofile] - perfilar el bot"""
 }
 
 # Validación de configuración
@@ -85,18 +223,79 @@ def validate_config():
     """Проверка обязательных параметров конфигурации"""
     errors = []
     
-    if not TELEGRAM_BOT_TOKEN:
+    # С TENANTS_FILE тенант из окружения необязателен, но если задан токен - нужен и канал
+    if not TELEGRAM_BOT_TOKEN and not TENANTS_FILE:
         errors.append("TELEGRAM_BOT_TOKEN не установлен")
     
-    if not CHANNEL_ID:
-        errors.append("CHANNEL_ID не установлен")
+    if TELEGRAM_BOT_TOKEN or not TENANTS_FILE:
+        if not CHANNEL_ID:
+            errors.append("CHANNEL_ID не установлен")
+        if not ADMIN_IDS:
+            errors.append("ADMIN_IDS не установлены")
     
-    if not ADMIN_IDS:
-        errors.append("ADMIN_IDS не установлены")
+    if TENANTS_FILE and not os.path.isfile(TENANTS_FILE):
+        errors.append(f"TENANTS_FILE не найден: {TENANTS_FILE}")
     
     if not STRIPE_API_KEY:
         errors.append("STRIPE_API_KEY не установлен")
     
+    if TELEGRAM_UPDATE_MODE not in ('polling', 'webhook'):
+        errors.append("TELEGRAM_UPDATE_MODE должен быть polling или webhook")
+    
+    if TELEGRAM_UPDATE_MODE == 'webhook':
+        if not TELEGRAM_WEBHOOK_URL:
+            errors.append("TELEGRAM_WEBHOOK_URL не установлен (режим webhook)")
+        if not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', TELEGRAM_WEBHOOK_SECRET):
+            errors.append("TELEGRAM_WEBHOOK_SECRET не установлен или содержит недопустимые символы")
+        if not 1 <= TELEGRAM_WEBHOOK_MAX_CONNECTIONS <= 100:
+            errors.append("TELEGRAM_WEBHOOK_MAX_CONNECTIONS должен быть от 1 до 100")
+    
+    if CHANNEL_ACCESS_MODE not in ('invite_link', 'join_request'):
+        errors.append("CHANNEL_ACCESS_MODE должен быть invite_link или join_request")
+    
+    if CHANNEL_ACCESS_MODE == 'join_request' and TELEGRAM_BOT_TOKEN and not CHANNEL_JOIN_LINK:
+        errors.append("CHANNEL_JOIN_LINK не установлен (режим join_request)")
+    
+    if TELEGRAM_CONCURRENT_UPDATES < 1:
+        errors.append("TELEGRAM_CONCURRENT_UPDATES должен быть >= 1")
+    
+    if PROFILE_SAMPLE_INTERVAL_MS <= 0 or PROFILE_MAX_SECONDS < 1:
+        errors.append("PROFILE_SAMPLE_INTERVAL_MS и PROFILE_MAX_SECONDS должны быть > 0")
+    
+    if USER_WRITE_INTERVAL_MS < 0 or USER_WRITE_BATCH_SIZE < 1 or USER_FINGERPRINT_CACHE_SIZE < 1:
+        errors.append("USER_WRITE_INTERVAL_MS должен быть >= 0, USER_WRITE_BATCH_SIZE и USER_FINGERPRINT_CACHE_SIZE >= 1")
+    
+    if CACHE_BUS_POLL_MS < 1 or CACHE_BUS_RETENTION_SECONDS < 1:
+        errors.append("CACHE_BUS_POLL_MS и CACHE_BUS_RETENTION_SECONDS должны быть >= 1")
+    
+    if DATABASE_URL.partition('://')[0] not in ('sqlite', 'postgresql', 'postgres'):
+        errors.append("DATABASE_URL должен начинаться с sqlite:// или postgresql://")
+    
+    if DATABASE_POOL_SIZE < 1:
+        errors.append("DATABASE_POOL_SIZE должен быть >= 1")
+    
+    if RETENTION_SUBSCRIPTION_DAYS < 0 or RETENTION_PAYMENT_DAYS < 0:
+        errors.append("RETENTION_SUBSCRIPTION_DAYS и RETENTION_PAYMENT_DAYS должны быть >= 0")
+    
+    if RETENTION_BATCH_SIZE < 1 or RETENTION_VACUUM_PAGES < 1:
+        errors.append("RETENTION_BATCH_SIZE и RETENTION_VACUUM_PAGES должны быть >= 1")
+    
+    if WEBHOOK_CAPTURE_ROTATE_MB <= 0 or WEBHOOK_CAPTURE_KEEP_DAYS < 0:
+        errors.append("WEBHOOK_CAPTURE_ROTATE_MB должен быть > 0, WEBHOOK_CAPTURE_KEEP_DAYS >= 0")
+    
+    if LEADER_LEASE_SECONDS < 3 or LEADER_JOB_COOLDOWN_SECONDS < 0:
+        errors.append("LEADER_LEASE_SECONDS должен быть >= 3, LEADER_JOB_COOLDOWN_SECONDS >= 0")
+    
+    if RECONCILE_CHUNK_SIZE < 1 or RECONCILE_SESSION_DAYS < 0:
+        errors.append("RECONCILE_CHUNK_SIZE должен быть >= 1, RECONCILE_SESSION_DAYS >= 0")
+    
+    if BACKUP_KEEP < 1 or BACKUP_STEP_PAGES < 1 or BACKUP_STEP_PAUSE_MS < 0:
+        errors.append("BACKUP_KEEP и BACKUP_STEP_PAGES должны быть >= 1, BACKUP_STEP_PAUSE_MS >= 0")
+    
+    if BACKUP_WAL_INTERVAL_SECONDS <= 0 or BACKUP_WAL_CHECKPOINT_FRAMES < 1 or BACKUP_WAL_GENERATION_HOURS <= 0:
+        errors.append("BACKUP_WAL_INTERVAL_SECONDS и BACKUP_WAL_GENERATION_HOURS должны быть > 0, "
+                      "BACKUP_WAL_CHECKPOINT_FRAMES >= 1")
+    
     if errors:
         raise ValueError("Ошибки конфигурации:\n" + "\n".join(f"- {e}" for e in errors))
     
@@ -1,20 +1,37 @@
 # -*- coding: utf-8 -*-
-import sqlite3
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from contextlib import contextmanager
 import logging
+import time
+
+import cache_bus
+import config
+import db_backends
+from metrics import timed_db
+from tenants import DEFAULT_ID as DEFAULT_TENANT
 
 logger = logging.getLogger(__name__)
 
-import os
-DATABASE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot_database.db')
-print(f"[DATABASE] Using file: {DATABASE_FILE}")
+# Хранилище по DATABASE_URL (SQLite или PostgreSQL), см. db_backends.py
+BACKEND = db_backends.from_url(config.DATABASE_URL, config.DATABASE_POOL_SIZE, not config.BACKUP_WAL_ARCHIVE)
+logger.info(f"Хранилище: {BACKEND.describe()}")
+
+def _invalidate(entity, keys):
+    """Сообщить другим процессам об изменении (вызывать после коммита)"""
+    for key in set(keys):
+        cache_bus.publish(entity, key)
+
+def configure(database_url):
+    """Переключиться на другое хранилище (бенчмарки, проверки на БД в памяти)"""
+    global BACKEND
+    BACKEND.close()
+    BACKEND = db_backends.from_url(database_url, config.DATABASE_POOL_SIZE, not config.BACKUP_WAL_ARCHIVE)
+    return BACKEND
 
 @contextmanager
 def get_db():
     """Контекстный менеджер для работы с БД"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = BACKEND.connect()
     try:
         yield conn
         conn.commit()
@@ -24,27 +41,67 @@ def get_db():
     finally:
         conn.close()
 
+def _add_column_if_missing(cursor, table, column, definition):
+    """Добавить колонку в существующую таблицу (миграция старых БД)"""
+    if column not in BACKEND.columns(cursor, table):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def _is_tenant_keyed(cursor, table):
+    """Первичный ключ (кроме суррогатного id) и внешние ключи таблицы начинаются с tenant_id"""
+    if 'tenant_id' not in BACKEND.columns(cursor, table):
+        return False
+    keys = BACKEND.foreign_keys(cursor, table)
+    primary_key = BACKEND.primary_key(cursor, table)
+    if primary_key != ['id']:
+        keys.append(primary_key)
+    return all(key[0] == 'tenant_id' for key in keys)
+
+def _create_tenant_table(cursor, table, ddl):
+    """
+    Создать таблицу, ключи которой начинаются с tenant_id (ddl с {table}).
+    Таблица старой схемы (без tenant_id или с ключом без него - например, внешним ключом
+    на users (telegram_id)) пересоздаётся, строки без тенанта достаются тенанту 'default'.
+    """
+    if BACKEND.table_exists(cursor, table) and not _is_tenant_keyed(cursor, table):
+        columns = ', '.join(BACKEND.columns(cursor, table))
+        cursor.execute(ddl.format(table=f'{table}_new'))
+        cursor.execute(f'INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}')
+        cursor.execute(f'DROP TABLE {table}')
+        cursor.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+        BACKEND.sync_id_sequence(cursor, table)
+        logger.info(f"Таблица {table} переведена на ключ с tenant_id")
+    else:
+        cursor.execute(ddl.format(table=table))
+
 def init_db():
     """Инициализация базы данных"""
     with get_db() as conn:
         cursor = conn.cursor()
+        if BACKEND.name == 'sqlite':
+            # Действует только для новой БД (до создания таблиц), существующую переводит
+            # python retention.py --enable-incremental-vacuum
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
         
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_id INTEGER PRIMARY KEY,
+        # Таблица пользователей (у каждого бота-тенанта свои: is_blocked - на бота)
+        _create_tenant_table(cursor, 'users', '''
+            CREATE TABLE IF NOT EXISTS {table} (
+                tenant_id TEXT NOT NULL DEFAULT 'default',
+                telegram_id INTEGER NOT NULL,
                 username TEXT,
                 first_name TEXT,
                 last_name TEXT,
+                is_blocked INTEGER NOT NULL DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (tenant_id, telegram_id)
             )
         ''')
         
         # Таблица подписок
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS subscriptions (
+        _create_tenant_table(cursor, 'subscriptions', '''
+            CREATE TABLE IF NOT EXISTS {table} (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tenant_id TEXT NOT NULL DEFAULT 'default',
                 telegram_id INTEGER NOT NULL,
                 stripe_customer_id TEXT,
                 stripe_subscription_id TEXT,
@@ -54,14 +111,15 @@ def init_db():
                 end_date TIMESTAMP NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (telegram_id) REFERENCES users (telegram_id)
+                FOREIGN KEY (tenant_id, telegram_id) REFERENCES users (tenant_id, telegram_id)
             )
         ''')
         
         # Таблица платежей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
+        _create_tenant_table(cursor, 'payments', '''
+            CREATE TABLE IF NOT EXISTS {table} (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tenant_id TEXT NOT NULL DEFAULT 'default',
                 telegram_id INTEGER NOT NULL,
                 stripe_payment_id TEXT UNIQUE,
                 stripe_checkout_session_id TEXT UNIQUE,
@@ -69,66 +127,259 @@ def init_db():
                 currency TEXT NOT NULL,
                 status TEXT NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (telegram_id) REFERENCES users (telegram_id)
+                FOREIGN KEY (tenant_id, telegram_id) REFERENCES users (tenant_id, telegram_id)
+            )
+        ''')
+        
+        # Таблица инвайт-ссылок (одна активная ссылка на пользователя в канале тенанта)
+        _create_tenant_table(cursor, 'invite_links', '''
+            CREATE TABLE IF NOT EXISTS {table} (
+                tenant_id TEXT NOT NULL DEFAULT 'default',
+                invite_link TEXT NOT NULL,
+                telegram_id INTEGER NOT NULL,
+                expire_date TIMESTAMP NOT NULL,
+                status TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (tenant_id, invite_link)
+            )
+        ''')
+        
+        # Таблица участников канала тенанта (по обновлениям chat_member)
+        _create_tenant_table(cursor, 'channel_members', '''
+            CREATE TABLE IF NOT EXISTS {table} (
+                tenant_id TEXT NOT NULL DEFAULT 'default',
+                telegram_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                is_member INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (tenant_id, telegram_id)
+            )
+        ''')
+        
+        # Агрегаты для /stats по тенантам (обновляются инкрементально вместе с исходными таблицами)
+        _create_tenant_table(cursor, 'stats_plan_active', '''
+            CREATE TABLE IF NOT EXISTS {table} (
+                tenant_id TEXT NOT NULL DEFAULT 'default',
+                stripe_price_id TEXT NOT NULL,
+                active_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (tenant_id, stripe_price_id)
+            )
+        ''')
+        _create_tenant_table(cursor, 'stats_daily', '''
+            CREATE TABLE IF NOT EXISTS {table} (
+                tenant_id TEXT NOT NULL DEFAULT 'default',
+                day TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (tenant_id, day, metric)
+            )
+        ''')
+        _create_tenant_table(cursor, 'stats_revenue', '''
+            CREATE TABLE IF NOT EXISTS {table} (
+                tenant_id TEXT NOT NULL DEFAULT 'default',
+                currency TEXT NOT NULL,
+                amount INTEGER NOT NULL DEFAULT 0,
+                payments_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (tenant_id, currency)
+            )
+        ''')
+        
+        # Массовые рассылки и их outbox (состояние доставки каждому получателю)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tenant_id TEXT NOT NULL DEFAULT 'default',
+                text TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_by INTEGER,
+                progress_chat_id INTEGER,
+                progress_message_id INTEGER,
+                cursor_telegram_id INTEGER NOT NULL DEFAULT 0,
+                enqueued_all INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_outbox (
+                broadcast_id INTEGER NOT NULL,
+                telegram_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (broadcast_id, telegram_id)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS job_leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                token INTEGER NOT NULL,
+                expires_at INTEGER NOT NULL
             )
         ''')
         
-        # Индексы для быстрого поиска
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_telegram_id ON subscriptions(telegram_id)')
+        # Рассылки, созданные до появления тенантов, принадлежат тенанту 'default'
+        _add_column_if_missing(cursor, 'broadcasts', 'tenant_id', "TEXT NOT NULL DEFAULT 'default'")
+        
+        # Старые pending-платежи писались с пустым stripe_payment_id
+        cursor.execute("UPDATE payments SET stripe_payment_id = NULL WHERE stripe_payment_id = ''")
+        
+        # Индексы для быстрого поиска: запросы бота и админки - в пределах тенанта,
+        # проверка истёкших подписок и архивация - по всем тенантам
+        for index in ('idx_subscriptions_telegram_id', 'idx_payments_telegram_id', 'idx_invite_links_telegram_id'):
+            cursor.execute(f'DROP INDEX IF EXISTS {index}')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_tenant_user ON subscriptions(tenant_id, telegram_id, status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_tenant_end_date ON subscriptions(tenant_id, status, end_date, id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_status ON subscriptions(status)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_telegram_id ON payments(telegram_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_status_end_date ON subscriptions(status, end_date, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_stripe_id ON subscriptions(stripe_subscription_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_tenant_user ON payments(tenant_id, telegram_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_tenant_status ON payments(tenant_id, status, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_broadcast_outbox_status ON broadcast_outbox(broadcast_id, status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_invite_links_tenant_user ON invite_links(tenant_id, telegram_id, status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_invite_links_status ON invite_links(status, expire_date)')
         
-        logger.info("База данных инициализирована")
+        backfill_stats = _stats_need_backfill(cursor)
+    
+    if backfill_stats:
+        # Обновление старой установки: агрегаты только что созданы пустыми, а подписки уже есть -
+        # без пересчёта первые истечения увели бы счётчики в минус
+        logger.info("Агрегаты статистики пусты при наличии данных - пересчёт")
+        recompute_stats()
+    
+    logger.info("База данных инициализирована")
 
-def add_or_update_user(telegram_id, username=None, first_name=None, last_name=None):
+def _stats_need_backfill(cursor):
+    """Агрегаты /stats ни разу не заполнялись, а подписки или платежи уже есть"""
+    for table in ('stats_plan_active', 'stats_daily', 'stats_revenue'):
+        cursor.execute(f'SELECT 1 FROM {table} LIMIT 1')
+        if cursor.fetchone():
+            return False
+    for table in ('subscriptions', 'payments'):
+        cursor.execute(f'SELECT 1 FROM {table} LIMIT 1')
+        if cursor.fetchone():
+            return True
+    return False
+
+def _bump_plan_active(cursor, tenant_id, stripe_price_id, delta):
+    """Изменить счётчик активных подписок тарифа"""
+    cursor.execute('''
+        INSERT INTO stats_plan_active (tenant_id, stripe_price_id, active_count) VALUES (?, ?, ?)
+        ON CONFLICT(tenant_id, stripe_price_id) DO UPDATE SET
+            active_count = stats_plan_active.active_count + excluded.active_count
+    ''', (tenant_id, stripe_price_id or '', delta))
+
+def _bump_daily(cursor, tenant_id, metric, day, delta=1):
+    """
+    Увеличить дневной счётчик (new / renewed / expired / cancelled).
+    day - ISO-строка даты из строки подписки (локальное время, как пишутся start_date и end_date):
+    день берётся так же, как date() в recompute_stats, поэтому пересчёт не переносит счётчики.
+    """
+    cursor.execute('''
+        INSERT INTO stats_daily (tenant_id, day, metric, count) VALUES (?, ?, ?, ?)
+        ON CONFLICT(tenant_id, day, metric) DO UPDATE SET count = stats_daily.count + excluded.count
+    ''', (tenant_id, day[:10], metric, delta))
+
+def _bump_revenue(cursor, stripe_checkout_session_id):
+    """Учесть успешный платёж в выручке по валюте"""
+    cursor.execute('''
+        INSERT INTO stats_revenue (tenant_id, currency, amount, payments_count)
+        SELECT tenant_id, LOWER(currency), amount, 1 FROM payments WHERE stripe_checkout_session_id = ?
+        ON CONFLICT(tenant_id, currency) DO UPDATE SET
+            amount = stats_revenue.amount + excluded.amount,
+            payments_count = stats_revenue.payments_count + 1
+    ''', (stripe_checkout_session_id,))
+
+def _track_status_change(cursor, tenant_id, old_status, new_status, stripe_price_id, end_date, updated_at):
+    """
+    Обновить агрегаты при смене статуса подписки.
+    Истечение считается в день end_date, отмена - в день updated_at (записанный в строку).
+    """
+    if old_status == new_status:
+        return
+    if old_status == 'active':
+        _bump_plan_active(cursor, tenant_id, stripe_price_id, -1)
+    if new_status == 'active':
+        _bump_plan_active(cursor, tenant_id, stripe_price_id, 1)
+    if new_status == 'expired':
+        _bump_daily(cursor, tenant_id, 'expired', end_date)
+    elif new_status in ('cancelled', 'canceled'):
+        _bump_daily(cursor, tenant_id, 'cancelled', updated_at)
+
+@timed_db
+def add_or_update_user(telegram_id, username=None, first_name=None, last_name=None, tenant_id=DEFAULT_TENANT):
     """Добавить или обновить пользователя"""
+    upsert_users([(telegram_id, username, first_name, last_name)], tenant_id)
+    logger.info(f"Пользователь {telegram_id} добавлен/обновлён")
+
+@timed_db
+def upsert_users(users, tenant_id=DEFAULT_TENANT):
+    """
+    Добавить/обновить пачку профилей тенанта [(telegram_id, username, first_name, last_name), ...]
+    одной транзакцией. Неизменённые строки не перезаписываются (updated_at не трогается).
+    """
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO users (telegram_id, username, first_name, last_name)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(telegram_id) DO UPDATE SET
+        cursor.executemany('''
+            INSERT INTO users (tenant_id, telegram_id, username, first_name, last_name)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(tenant_id, telegram_id) DO UPDATE SET
                 username = excluded.username,
                 first_name = excluded.first_name,
                 last_name = excluded.last_name,
+                is_blocked = 0,
                 updated_at = CURRENT_TIMESTAMP
-        ''', (telegram_id, username, first_name, last_name))
-        logger.info(f"Пользователь {telegram_id} добавлен/обновлён")
+            WHERE users.is_blocked != 0
+            OR COALESCE(users.username, '') != COALESCE(excluded.username, '')
+            OR COALESCE(users.first_name, '') != COALESCE(excluded.first_name, '')
+            OR COALESCE(users.last_name, '') != COALESCE(excluded.last_name, '')
+        ''', [(tenant_id, *user) for user in users])
 
+@timed_db
 def create_subscription(telegram_id, stripe_customer_id, stripe_subscription_id, 
-                       stripe_price_id, duration_months):
+                       stripe_price_id, duration_months, tenant_id=DEFAULT_TENANT):
     """Создать новую подписку"""
     start_date = datetime.now()
     end_date = start_date + timedelta(days=30 * duration_months)
     
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
+        subscription_id = BACKEND.insert_id(cursor, '''
             INSERT INTO subscriptions 
-            (telegram_id, stripe_customer_id, stripe_subscription_id, stripe_price_id, 
+            (tenant_id, telegram_id, stripe_customer_id, stripe_subscription_id, stripe_price_id, 
              status, start_date, end_date)
-            VALUES (?, ?, ?, ?, 'active', ?, ?)
-        ''', (telegram_id, stripe_customer_id, stripe_subscription_id, stripe_price_id,
-              start_date, end_date))
-        
-        subscription_id = cursor.lastrowid
+            VALUES (?, ?, ?, ?, ?, 'active', ?, ?)
+        ''', (tenant_id, telegram_id, stripe_customer_id, stripe_subscription_id, stripe_price_id,
+              start_date.isoformat(), end_date.isoformat()))
+        _bump_plan_active(cursor, tenant_id, stripe_price_id, 1)
+        _bump_daily(cursor, tenant_id, 'new', start_date.isoformat())
         logger.info(f"Создана подписка {subscription_id} для пользователя {telegram_id}")
-        return subscription_id
+    _invalidate('subscription', [telegram_id])
+    return subscription_id
 
+@timed_db
 def renew_or_create_subscription(telegram_id, stripe_customer_id, stripe_subscription_id, 
-                                  stripe_price_id, duration_months):
-    """Продлить существующую подписку или создать новую"""
+                                  stripe_price_id, duration_months, tenant_id=DEFAULT_TENANT):
+    """Продлить существующую подписку пользователя в тенанте или создать новую"""
     with get_db() as conn:
         cursor = conn.cursor()
         
         # Проверяем, есть ли активная подписка
         cursor.execute('''
             SELECT * FROM subscriptions
-            WHERE telegram_id = ? 
+            WHERE tenant_id = ?
+            AND telegram_id = ? 
             AND status = 'active'
             ORDER BY end_date DESC
             LIMIT 1
-        ''', (telegram_id,))
+        ''', (tenant_id, telegram_id))
         
         existing = cursor.fetchone()
         
@@ -152,87 +403,232 @@ def renew_or_create_subscription(telegram_id, stripe_customer_id, stripe_subscri
             ''', (new_end_date.isoformat(), stripe_subscription_id, stripe_price_id, 
                   datetime.now().isoformat(), existing['id']))
             
+            if existing['stripe_price_id'] != stripe_price_id:
+                _bump_plan_active(cursor, tenant_id, existing['stripe_price_id'], -1)
+                _bump_plan_active(cursor, tenant_id, stripe_price_id, 1)
+            _bump_daily(cursor, tenant_id, 'renewed', current_time.isoformat())
+            
             logger.info(f"✅ Подписка {existing['id']} продлена до {new_end_date} для юзера {telegram_id}")
-            return existing['id']
+            subscription_id = existing['id']
         else:
             # Нет активной подписки - СОЗДАЁМ НОВУЮ
             start_date = datetime.now()
             end_date = start_date + timedelta(days=30 * duration_months)
             
-            cursor.execute('''
+            subscription_id = BACKEND.insert_id(cursor, '''
                 INSERT INTO subscriptions 
-                (telegram_id, stripe_customer_id, stripe_subscription_id, stripe_price_id, 
+                (tenant_id, telegram_id, stripe_customer_id, stripe_subscription_id, stripe_price_id, 
                  status, start_date, end_date)
-                VALUES (?, ?, ?, ?, 'active', ?, ?)
-            ''', (telegram_id, stripe_customer_id, stripe_subscription_id, stripe_price_id,
+                VALUES (?, ?, ?, ?, ?, 'active', ?, ?)
+            ''', (tenant_id, telegram_id, stripe_customer_id, stripe_subscription_id, stripe_price_id,
                   start_date.isoformat(), end_date.isoformat()))
-            
-            subscription_id = cursor.lastrowid
+            _bump_plan_active(cursor, tenant_id, stripe_price_id, 1)
+            _bump_daily(cursor, tenant_id, 'new', start_date.isoformat())
             logger.info(f"🆕 Создана новая подписка {subscription_id} для юзера {telegram_id}")
-            return subscription_id
+    _invalidate('subscription', [telegram_id])
+    return subscription_id
 
-def get_active_subscription(telegram_id):
-    """Получить активную подписку пользователя"""
+@timed_db
+def get_active_subscription(telegram_id, tenant_id=DEFAULT_TENANT):
+    """Получить активную подписку пользователя в тенанте"""
     current_time = datetime.now().isoformat()
     
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             SELECT * FROM subscriptions
-            WHERE telegram_id = ? 
+            WHERE tenant_id = ?
+            AND telegram_id = ? 
             AND status = 'active'
             AND end_date > ?
             ORDER BY end_date DESC
             LIMIT 1
-        ''', (telegram_id, current_time))
+        ''', (tenant_id, telegram_id, current_time))
         
         row = cursor.fetchone()
         return dict(row) if row else None
 
+@timed_db
 def update_subscription_status(stripe_subscription_id, status):
     """Обновить статус подписки"""
+    now = datetime.now().isoformat()
     with get_db() as conn:
         cursor = conn.cursor()
+        cursor.execute('''
+            SELECT tenant_id, telegram_id, status, stripe_price_id, end_date FROM subscriptions
+            WHERE stripe_subscription_id = ? AND status != ?
+        ''', (stripe_subscription_id, status))
+        previous = cursor.fetchall()
+        
+        # Повтор того же статуса не трогает updated_at - по нему считается день отмены
         cursor.execute('''
             UPDATE subscriptions
-            SET status = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE stripe_subscription_id = ?
-        ''', (status, stripe_subscription_id))
+            SET status = ?, updated_at = ?
+            WHERE stripe_subscription_id = ? AND status != ?
+        ''', (status, now, stripe_subscription_id, status))
+        
+        for row in previous:
+            _track_status_change(cursor, row['tenant_id'], row['status'], status, row['stripe_price_id'],
+                                 row['end_date'], now)
         logger.info(f"Подписка {stripe_subscription_id} обновлена: {status}")
+    _invalidate('subscription', [row['telegram_id'] for row in previous])
 
+@timed_db
+def expire_subscriptions(subscription_ids, fence=None):
+    """
+    Пометить подписки как expired (только те, что ещё active).
+    fence - (имя задачи, токен) аренды leader.py: без действующей аренды - LeaseLost.
+    """
+    if not subscription_ids:
+        return 0
+    
+    now = datetime.now().isoformat()
+    placeholders = ','.join('?' * len(subscription_ids))
+    with get_db() as conn:
+        cursor = conn.cursor()
+        if fence:
+            _check_fence(cursor, fence)
+        cursor.execute(f'''
+            SELECT id, tenant_id, telegram_id, stripe_price_id, end_date FROM subscriptions
+            WHERE id IN ({placeholders}) AND status = 'active'
+        ''', list(subscription_ids))
+        rows = cursor.fetchall()
+        
+        cursor.executemany('''
+            UPDATE subscriptions
+            SET status = 'expired', updated_at = ?
+            WHERE id = ?
+        ''', [(now, row['id']) for row in rows])
+        
+        for row in rows:
+            _track_status_change(cursor, row['tenant_id'], 'active', 'expired', row['stripe_price_id'],
+                                 row['end_date'], now)
+    _invalidate('subscription', [row['telegram_id'] for row in rows])
+    return len(rows)
+
+@timed_db
 def extend_subscription(stripe_subscription_id, months):
     """Продлить подписку"""
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
+            SELECT id, telegram_id, end_date FROM subscriptions WHERE stripe_subscription_id = ?
+        ''', (stripe_subscription_id,))
+        rows = cursor.fetchall()
+        # Месяц - 30 дней, как при создании и продлении подписки
+        cursor.executemany('''
             UPDATE subscriptions
-            SET end_date = datetime(end_date, '+' || ? || ' months'),
-                updated_at = CURRENT_TIMESTAMP
-            WHERE stripe_subscription_id = ?
-        ''', (months, stripe_subscription_id))
+            SET end_date = ?, updated_at = ?
+            WHERE id = ?
+        ''', [((datetime.fromisoformat(row['end_date']) + timedelta(days=30 * months)).isoformat(),
+               datetime.now().isoformat(), row['id'])
+              for row in rows])
         logger.info(f"Подписка {stripe_subscription_id} продлена на {months} месяцев")
+    _invalidate('subscription', [row['telegram_id'] for row in rows])
+
+# Переходы статусов платежа: pending - единственный нетерминальный статус
+PAYMENT_TRANSITIONS = {
+    'pending': ('succeeded', 'failed', 'expired'),
+}
+PAYMENT_STATUSES = ('pending', 'succeeded', 'failed', 'expired')
+
+@timed_db
+def record_payment_pending(telegram_id, stripe_checkout_session_id, amount, currency, tenant_id=DEFAULT_TENANT):
+    """Записать созданную Checkout Session как платёж в статусе pending"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO payments
+            (tenant_id, telegram_id, stripe_payment_id, stripe_checkout_session_id, amount, currency, status)
+            VALUES (?, ?, NULL, ?, ?, ?, 'pending')
+            ON CONFLICT(stripe_checkout_session_id) DO NOTHING
+        ''', (tenant_id, telegram_id, stripe_checkout_session_id, amount or 0, currency))
+        return cursor.rowcount > 0
+
+def _transition_payment(cursor, stripe_checkout_session_id, status, telegram_id=None,
+                        stripe_payment_id=None, amount=None, currency=None, tenant_id=DEFAULT_TENANT):
+    """
+    Перевести платёж из pending в status одной записью по уникальному индексу.
+    С telegram_id - upsert (строки может не быть, если pending не записался;
+    новая строка достаётся tenant_id), без него - только UPDATE. Сумма и валюта
+    без значения (None) не затирают записанные при pending.
+    Повторный переход (дубликат события) ничего не меняет.
+    """
+    sources = [old for old, targets in PAYMENT_TRANSITIONS.items() if status in targets]
+    if not sources:
+        raise ValueError(f"Недопустимый статус платежа: {status}")
+    # Пустые ID из Stripe храним как NULL: '' конфликтует в UNIQUE
+    stripe_payment_id = stripe_payment_id or None
+    placeholders = ', '.join('?' * len(sources))
+
+    if telegram_id is None:
+        cursor.execute(f'''
+            UPDATE payments
+            SET status = ?,
+                stripe_payment_id = COALESCE(?, stripe_payment_id),
+                amount = COALESCE(?, amount),
+                currency = COALESCE(?, currency)
+            WHERE stripe_checkout_session_id = ? AND status IN ({placeholders})
+        ''', (status, stripe_payment_id, amount, currency, stripe_checkout_session_id, *sources))
+    else:
+        cursor.execute(f'''
+            INSERT INTO payments
+            (tenant_id, telegram_id, stripe_payment_id, stripe_checkout_session_id, amount, currency, status)
+            VALUES (?, ?, ?, ?, COALESCE(?, 0), COALESCE(?, 'eur'), ?)
+            ON CONFLICT(stripe_checkout_session_id) DO UPDATE SET
+                status = excluded.status,
+                stripe_payment_id = COALESCE(excluded.stripe_payment_id, payments.stripe_payment_id),
+                amount = COALESCE(?, payments.amount),
+                currency = COALESCE(?, payments.currency)
+            WHERE payments.status IN ({placeholders})
+        ''', (tenant_id, telegram_id, stripe_payment_id, stripe_checkout_session_id, amount, currency, status,
+              amount, currency, *sources))
 
-def add_payment(telegram_id, stripe_payment_id, stripe_checkout_session_id, 
-                amount, currency, status='succeeded'):
-    """Добавить запись о платеже"""
+    if cursor.rowcount == 0:
+        return False
+    if status == 'succeeded':
+        _bump_revenue(cursor, stripe_checkout_session_id)
+    return True
+
+@timed_db
+def set_payment_status(stripe_checkout_session_id, status, telegram_id=None,
+                       stripe_payment_id=None, amount=None, currency=None, tenant_id=DEFAULT_TENANT):
+    """Перевести платёж в succeeded / failed / expired; False - переход уже был или недопустим"""
     with get_db() as conn:
         cursor = conn.cursor()
         try:
-            cursor.execute('''
-                INSERT INTO payments 
-                (telegram_id, stripe_payment_id, stripe_checkout_session_id, 
-                 amount, currency, status)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (telegram_id, stripe_payment_id, stripe_checkout_session_id,
-                  amount, currency, status))
-            
-            payment_id = cursor.lastrowid
-            logger.info(f"Добавлен платёж {payment_id} для пользователя {telegram_id}")
-            return payment_id
-        except sqlite3.IntegrityError:
+            changed = _transition_payment(cursor, stripe_checkout_session_id, status, telegram_id,
+                                          stripe_payment_id, amount, currency, tenant_id)
+        except BACKEND.IntegrityError:
+            # stripe_payment_id уже записан у другой сессии
             logger.warning(f"Платёж {stripe_payment_id} уже существует")
-            return None
+            return False
+        if changed:
+            logger.info(f"Платёж {stripe_checkout_session_id}: {status}")
+        return changed
 
+@timed_db
+def set_payment_statuses(updates):
+    """
+    Пакетная смена статусов (сверка со Stripe) в одной транзакции.
+    updates - словари с ключами stripe_checkout_session_id, status и, опционально,
+    telegram_id и tenant_id (создать недостающую строку) / stripe_payment_id / amount / currency.
+    Возвращает число применённых переходов.
+    """
+    changed = 0
+    with get_db() as conn:
+        cursor = conn.cursor()
+        for update in updates:
+            if _transition_payment(cursor, update['stripe_checkout_session_id'], update['status'],
+                                   telegram_id=update.get('telegram_id'),
+                                   stripe_payment_id=update.get('stripe_payment_id'),
+                                   amount=update.get('amount'), currency=update.get('currency'),
+                                   tenant_id=update.get('tenant_id') or DEFAULT_TENANT):
+                changed += 1
+    logger.info(f"Статусы платежей обновлены: {changed}")
+    return changed
+
+@timed_db
 def get_expired_subscriptions():
     """Получить истёкшие подписки"""
     from datetime import datetime
@@ -250,14 +646,117 @@ def get_expired_subscriptions():
         logger.info(f"SQL: Проверка подписок с end_date <= {current_time}, найдено: {len(rows)}")
         return [dict(row) for row in rows]
 
-def get_user_by_telegram_id(telegram_id):
-    """Получить пользователя по Telegram ID"""
+@timed_db
+def get_active_subscriber_end_dates(tenant_id=DEFAULT_TENANT):
+    """Получить {telegram_id: end_date} всех пользователей тенанта с активной подпиской"""
+    current_time = datetime.now().isoformat()
+    
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
+        cursor.execute('''
+            SELECT telegram_id, MAX(end_date) AS end_date FROM subscriptions
+            WHERE tenant_id = ?
+            AND status = 'active'
+            AND end_date > ?
+            GROUP BY telegram_id
+        ''', (tenant_id, current_time))
+        return {row['telegram_id']: row['end_date'] for row in cursor.fetchall()}
+
+@timed_db
+def get_active_subscriptions_page(limit, cursor=None, direction='next', expiring_within_days=None,
+                                  tenant_id=DEFAULT_TENANT):
+    """
+    Страница активных подписок тенанта с данными пользователя (keyset по end_date, id)
+    
+    Args:
+        limit: Размер страницы
+        cursor: (end_date, id) граничной записи соседней страницы или None для первой
+        direction: 'next' - записи после cursor, 'prev' - записи перед cursor
+        expiring_within_days: Только подписки, истекающие в ближайшие N дней
+    
+    Returns:
+        (rows, has_more) - записи по возрастанию end_date и есть ли ещё записи в направлении direction
+    """
+    now = datetime.now()
+    conditions = ["s.tenant_id = ?", "s.status = 'active'", "s.end_date > ?"]
+    params = [tenant_id, now.isoformat()]
+    
+    if expiring_within_days is not None:
+        conditions.append("s.end_date <= ?")
+        params.append((now + timedelta(days=expiring_within_days)).isoformat())
+    
+    if cursor:
+        conditions.append(f"(s.end_date, s.id) {'>' if direction == 'next' else '<'} (?, ?)")
+        params.extend(cursor)
+    
+    order = 'ASC' if direction == 'next' else 'DESC'
+    params.append(limit + 1)
+    
+    with get_db() as conn:
+        cursor_db = conn.cursor()
+        cursor_db.execute(f'''
+            SELECT s.id, u.telegram_id, u.username, u.first_name,
+                   s.start_date, s.end_date
+            FROM subscriptions s
+            JOIN users u ON u.tenant_id = s.tenant_id AND u.telegram_id = s.telegram_id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY s.end_date {order}, s.id {order}
+            LIMIT ?
+        ''', params)
+        rows = [dict(row) for row in cursor_db.fetchall()]
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'prev':
+        rows.reverse()
+    return rows, has_more
+
+def iter_subscriptions_ending_between(start, end, batch_size=500):
+    """
+    Активные подписки всех тенантов (с username/first_name), истекающие в интервале [start, end].
+    
+    Генератор: читает пачками по keyset (end_date, id), не держа все записи в памяти.
+    """
+    last = None
+    while True:
+        params = [start.isoformat(), end.isoformat()]
+        keyset = ''
+        if last:
+            keyset = 'AND (s.end_date, s.id) > (?, ?)'
+            params.extend(last)
+        params.append(batch_size)
+        
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT s.*, u.username, u.first_name
+                FROM subscriptions s
+                JOIN users u ON u.tenant_id = s.tenant_id AND u.telegram_id = s.telegram_id
+                WHERE s.status = 'active'
+                AND s.end_date >= ?
+                AND s.end_date <= ?
+                {keyset}
+                ORDER BY s.end_date, s.id
+                LIMIT ?
+            ''', params)
+            rows = [dict(row) for row in cursor.fetchall()]
+        
+        yield from rows
+        
+        if len(rows) < batch_size:
+            return
+        last = (rows[-1]['end_date'], rows[-1]['id'])
+
+@timed_db
+def get_user_by_telegram_id(telegram_id, tenant_id=DEFAULT_TENANT):
+    """Получить пользователя тенанта по Telegram ID"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM users WHERE tenant_id = ? AND telegram_id = ?', (tenant_id, telegram_id))
         row = cursor.fetchone()
         return dict(row) if row else None
 
+@timed_db
 def get_subscription_by_stripe_id(stripe_subscription_id):
     """Получить подписку по Stripe Subscription ID"""
     with get_db() as conn:
@@ -269,6 +768,7 @@ def get_subscription_by_stripe_id(stripe_subscription_id):
         row = cursor.fetchone()
         return dict(row) if row else None
 
+@timed_db
 def get_subscription_by_checkout_session(checkout_session_id):
     """Получить Telegram ID по Checkout Session ID"""
     with get_db() as conn:
@@ -279,3 +779,652 @@ def get_subscription_by_checkout_session(checkout_session_id):
         ''', (checkout_session_id,))
         row = cursor.fetchone()
         return row['telegram_id'] if row else None
+
+@timed_db
+def get_active_invite_link(telegram_id, valid_until, tenant_id=DEFAULT_TENANT):
+    """Получить активную (не использованную) инвайт-ссылку, действующую хотя бы до valid_until"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM invite_links
+            WHERE tenant_id = ?
+            AND telegram_id = ?
+            AND status = 'active'
+            AND expire_date > ?
+            ORDER BY expire_date DESC
+            LIMIT 1
+        ''', (tenant_id, telegram_id, valid_until.isoformat()))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+@timed_db
+def save_invite_link(telegram_id, invite_link, expire_date, tenant_id=DEFAULT_TENANT):
+    """Сохранить новую инвайт-ссылку, предыдущие активные помечаются как superseded"""
+    now = datetime.now().isoformat()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE invite_links
+            SET status = 'superseded', updated_at = ?
+            WHERE tenant_id = ? AND telegram_id = ? AND status = 'active'
+        ''', (now, tenant_id, telegram_id))
+        cursor.execute('''
+            INSERT INTO invite_links (invite_link, tenant_id, telegram_id, expire_date, status, created_at, updated_at)
+            VALUES (?, ?, ?, ?, 'active', ?, ?)
+        ''', (invite_link, tenant_id, telegram_id, expire_date.isoformat(), now, now))
+        logger.info(f"Сохранена инвайт-ссылка для пользователя {telegram_id}")
+
+@timed_db
+def mark_invite_link_used(invite_link, tenant_id=DEFAULT_TENANT):
+    """Пометить инвайт-ссылку как использованную"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE invite_links
+            SET status = 'used', updated_at = ?
+            WHERE tenant_id = ? AND invite_link = ? AND status IN ('active', 'superseded')
+        ''', (datetime.now().isoformat(), tenant_id, invite_link))
+        return cursor.rowcount > 0
+
+@timed_db
+def supersede_invite_links(telegram_id, tenant_id=DEFAULT_TENANT):
+    """Пометить активные ссылки пользователя на отзыв (например, при удалении из канала)"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE invite_links
+            SET status = 'superseded', updated_at = ?
+            WHERE tenant_id = ? AND telegram_id = ? AND status = 'active'
+        ''', (datetime.now().isoformat(), tenant_id, telegram_id))
+
+@timed_db
+def get_superseded_invite_links(limit=100, tenant_id=DEFAULT_TENANT):
+    """Получить ссылки канала тенанта, которые нужно отозвать (ещё не истекли)"""
+    now = datetime.now().isoformat()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        # Истёкшие ссылки отзывать не нужно - Telegram их уже не примет
+        cursor.execute('''
+            UPDATE invite_links
+            SET status = 'expired', updated_at = ?
+            WHERE status IN ('active', 'superseded') AND expire_date <= ?
+        ''', (now, now))
+        cursor.execute('''
+            SELECT * FROM invite_links
+            WHERE status = 'superseded' AND tenant_id = ?
+            ORDER BY expire_date ASC
+            LIMIT ?
+        ''', (tenant_id, limit))
+        return [dict(row) for row in cursor.fetchall()]
+
+@timed_db
+def mark_invite_links_revoked(invite_links, tenant_id=DEFAULT_TENANT):
+    """Пометить пачку ссылок канала тенанта как отозванные"""
+    now = datetime.now().isoformat()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            UPDATE invite_links
+            SET status = 'revoked', updated_at = ?
+            WHERE tenant_id = ? AND invite_link = ?
+        ''', [(now, tenant_id, link) for link in invite_links])
+
+@timed_db
+def set_channel_member_status(telegram_id, status, is_member, tenant_id=DEFAULT_TENANT):
+    """Сохранить статус пользователя в канале тенанта"""
+    set_channel_member_statuses([(telegram_id, status, is_member)], tenant_id)
+
+@timed_db
+def set_channel_member_statuses(members, tenant_id=DEFAULT_TENANT):
+    """Сохранить статусы пачкой: [(telegram_id, status, is_member), ...]"""
+    now = datetime.now().isoformat()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO channel_members (tenant_id, telegram_id, status, is_member, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(tenant_id, telegram_id) DO UPDATE SET
+                status = excluded.status,
+                is_member = excluded.is_member,
+                updated_at = excluded.updated_at
+        ''', [(tenant_id, telegram_id, status, int(bool(is_member)), now)
+              for telegram_id, status, is_member in members])
+
+@timed_db
+def is_channel_member(telegram_id, tenant_id=DEFAULT_TENANT):
+    """Состоит ли пользователь в канале тенанта: True/False, None - неизвестно"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT is_member FROM channel_members WHERE tenant_id = ? AND telegram_id = ?',
+                       (tenant_id, telegram_id))
+        row = cursor.fetchone()
+        return bool(row['is_member']) if row else None
+
+@timed_db
+def get_known_telegram_ids(tenant_id=DEFAULT_TENANT):
+    """Все telegram_id тенанта, у которых когда-либо была подписка"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT DISTINCT telegram_id FROM subscriptions WHERE tenant_id = ?', (tenant_id,))
+        return [row['telegram_id'] for row in cursor.fetchall()]
+
+@timed_db
+def get_stats(days=7, tenant_id=DEFAULT_TENANT):
+    """Агрегаты тенанта для /stats: активные по тарифам, дневные счётчики, выручка по валютам"""
+    since = (datetime.now().date() - timedelta(days=days - 1)).isoformat()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT stripe_price_id, active_count FROM stats_plan_active
+            WHERE tenant_id = ? AND active_count != 0
+        ''', (tenant_id,))
+        plans = {row['stripe_price_id']: row['active_count'] for row in cursor.fetchall()}
+        
+        cursor.execute('''
+            SELECT day, metric, count FROM stats_daily
+            WHERE tenant_id = ? AND day >= ?
+            ORDER BY day DESC
+        ''', (tenant_id, since))
+        daily = {}
+        for row in cursor.fetchall():
+            daily.setdefault(row['day'], {})[row['metric']] = row['count']
+        
+        cursor.execute('''
+            SELECT currency, amount, payments_count FROM stats_revenue
+            WHERE tenant_id = ?
+            ORDER BY currency
+        ''', (tenant_id,))
+        revenue = [dict(row) for row in cursor.fetchall()]
+    
+    return {'plans': plans, 'daily': daily, 'revenue': revenue}
+
+@timed_db
+def recompute_stats():
+    """
+    Пересчитать агрегаты /stats из исходных таблиц (инструмент восстановления).
+    
+    Продления (renewed) не восстанавливаются - история продлений не хранится,
+    поэтому существующие значения сохраняются.
+    """
+    with get_db() as conn:
+        schema = _attach_archive(conn)
+        cursor = conn.cursor()
+        # Перенесённые в архив подписки и платежи тоже входят в историю
+        # Строки, архивированные до появления тенантов, - тенант 'default'
+        all_subscriptions = _with_archive(cursor, schema, 'subscriptions',
+                                          'tenant_id, start_date, end_date, updated_at, status')
+        all_payments = _with_archive(cursor, schema, 'payments', 'tenant_id, currency, amount, status')
+        
+        cursor.execute('DELETE FROM stats_plan_active')
+        cursor.execute('''
+            INSERT INTO stats_plan_active (tenant_id, stripe_price_id, active_count)
+            SELECT tenant_id, COALESCE(stripe_price_id, ''), COUNT(*) FROM subscriptions
+            WHERE status = 'active'
+            GROUP BY tenant_id, COALESCE(stripe_price_id, '')
+        ''')
+        
+        cursor.execute("DELETE FROM stats_daily WHERE metric != 'renewed'")
+        cursor.execute(f'''
+            INSERT INTO stats_daily (tenant_id, day, metric, count)
+            SELECT COALESCE(tenant_id, 'default'), date(start_date), 'new', COUNT(*) FROM {all_subscriptions}
+            GROUP BY COALESCE(tenant_id, 'default'), date(start_date)
+        ''')
+        # Дни - как у _track_status_change: истечение по end_date, отмена по updated_at
+        cursor.execute(f'''
+            INSERT INTO stats_daily (tenant_id, day, metric, count)
+            SELECT COALESCE(tenant_id, 'default'), date(end_date), 'expired', COUNT(*) FROM {all_subscriptions}
+            WHERE status = 'expired'
+            GROUP BY COALESCE(tenant_id, 'default'), date(end_date)
+        ''')
+        cursor.execute(f'''
+            INSERT INTO stats_daily (tenant_id, day, metric, count)
+            SELECT COALESCE(tenant_id, 'default'), date(updated_at), 'cancelled', COUNT(*) FROM {all_subscriptions}
+            WHERE status IN ('cancelled', 'canceled')
+            GROUP BY COALESCE(tenant_id, 'default'), date(updated_at)
+        ''')
+        
+        cursor.execute('DELETE FROM stats_revenue')
+        cursor.execute(f'''
+            INSERT INTO stats_revenue (tenant_id, currency, amount, payments_count)
+            SELECT COALESCE(tenant_id, 'default'), LOWER(currency), SUM(amount), COUNT(*) FROM {all_payments}
+            WHERE status = 'succeeded'
+            GROUP BY COALESCE(tenant_id, 'default'), LOWER(currency)
+        ''')
+        logger.info("Агрегаты статистики пересчитаны")
+
+@timed_db
+def mark_user_blocked(telegram_id, tenant_id=DEFAULT_TENANT):
+    """Пометить пользователя, заблокировавшего бота тенанта (снимается при следующем /start)"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE users SET is_blocked = 1, updated_at = CURRENT_TIMESTAMP
+            WHERE tenant_id = ? AND telegram_id = ?
+        ''', (tenant_id, telegram_id))
+    _invalidate('user', [telegram_id])
+
+@timed_db
+def create_broadcast(text, created_by, tenant_id=DEFAULT_TENANT):
+    """Создать рассылку всем активным подписчикам тенанта"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        broadcast_id = BACKEND.insert_id(cursor, '''
+            INSERT INTO broadcasts (tenant_id, text, status, created_by)
+            VALUES (?, ?, 'running', ?)
+        ''', (tenant_id, text, created_by))
+        logger.info(f"Создана рассылка {broadcast_id}")
+        return broadcast_id
+
+@timed_db
+def get_broadcast(broadcast_id):
+    """Получить рассылку по ID"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+@timed_db
+def get_running_broadcasts(tenant_id=DEFAULT_TENANT):
+    """Рассылки тенанта, которые нужно продолжить (например, после падения процесса)"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM broadcasts WHERE tenant_id = ? AND status = 'running' ORDER BY id", (tenant_id,))
+        return [dict(row) for row in cursor.fetchall()]
+
+@timed_db
+def set_broadcast_status(broadcast_id, status):
+    """Завершить рассылку (done / cancelled), если она ещё выполняется"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE broadcasts SET status = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'running'
+        ''', (status, broadcast_id))
+        return cursor.rowcount > 0
+
+@timed_db
+def set_broadcast_progress_message(broadcast_id, chat_id, message_id):
+    """Запомнить сообщение, в котором показывается прогресс рассылки"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE broadcasts SET progress_chat_id = ?, progress_message_id = ?
+            WHERE id = ?
+        ''', (chat_id, message_id, broadcast_id))
+
+@timed_db
+def enqueue_broadcast_chunk(broadcast_id, limit):
+    """
+    Добавить в outbox следующую пачку получателей (keyset по telegram_id).
+    
+    Returns:
+        Количество добавленных получателей (0 - все получатели уже в outbox)
+    """
+    current_time = datetime.now().isoformat()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT tenant_id, cursor_telegram_id FROM broadcasts WHERE id = ?', (broadcast_id,))
+        broadcast = cursor.fetchone()
+        
+        cursor.execute('''
+            SELECT DISTINCT s.telegram_id FROM subscriptions s
+            LEFT JOIN users u ON u.tenant_id = s.tenant_id AND u.telegram_id = s.telegram_id
+            WHERE s.tenant_id = ?
+            AND s.status = 'active'
+            AND s.end_date > ?
+            AND s.telegram_id > ?
+            AND COALESCE(u.is_blocked, 0) = 0
+            ORDER BY s.telegram_id
+            LIMIT ?
+        ''', (broadcast['tenant_id'], current_time, broadcast['cursor_telegram_id'], limit))
+        recipients = [row['telegram_id'] for row in cursor.fetchall()]
+        
+        if not recipients:
+            cursor.execute('''
+                UPDATE broadcasts SET enqueued_all = 1, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (broadcast_id,))
+            return 0
+        
+        cursor.executemany('''
+            INSERT INTO broadcast_outbox (broadcast_id, telegram_id, status)
+            VALUES (?, ?, 'pending')
+            ON CONFLICT DO NOTHING
+        ''', [(broadcast_id, telegram_id) for telegram_id in recipients])
+        cursor.execute('''
+            UPDATE broadcasts
+            SET cursor_telegram_id = ?, total = total + ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (recipients[-1], len(recipients), broadcast_id))
+        return len(recipients)
+
+@timed_db
+def claim_broadcast_recipients(broadcast_id, limit, fence=None):
+    """
+    Взять пачку pending-получателей и пометить их как sending.
+    fence - (имя, токен) аренды рассылки: без действующей аренды - LeaseLost.
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        if fence:
+            _check_fence(cursor, fence)
+        cursor.execute('''
+            SELECT telegram_id FROM broadcast_outbox
+            WHERE broadcast_id = ? AND status = 'pending'
+            ORDER BY telegram_id
+            LIMIT ?
+        ''', (broadcast_id, limit))
+        claimed = []
+        # Условный UPDATE: если получателя уже взял другой процесс, rowcount будет 0
+        for row in cursor.fetchall():
+            cursor.execute('''
+                UPDATE broadcast_outbox SET status = 'sending', updated_at = CURRENT_TIMESTAMP
+                WHERE broadcast_id = ? AND telegram_id = ? AND status = 'pending'
+            ''', (broadcast_id, row['telegram_id']))
+            if cursor.rowcount:
+                claimed.append(row['telegram_id'])
+        return claimed
+
+@timed_db
+def record_broadcast_results(broadcast_id, results):
+    """Сохранить результаты доставки: [(telegram_id, status, error), ...]"""
+    counts = {'sent': 0, 'failed': 0, 'blocked': 0}
+    for _, status, _ in results:
+        counts[status] = counts.get(status, 0) + 1
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            UPDATE broadcast_outbox SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE broadcast_id = ? AND telegram_id = ?
+        ''', [(status, error, broadcast_id, telegram_id) for telegram_id, status, error in results])
+        cursor.execute('''
+            UPDATE broadcasts
+            SET sent = sent + ?, failed = failed + ?, blocked = blocked + ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (counts['sent'], counts['failed'], counts['blocked'], broadcast_id))
+
+@timed_db
+def release_stale_broadcast_claims(broadcast_id, fence=None):
+    """
+    После падения: получатели в статусе sending могли уже получить сообщение,
+    поэтому они помечаются unknown и повторно не отправляются.
+    Вызывать только держателю аренды рассылки (fence): иначе в unknown уйдут
+    получатели, которых сейчас отправляет другой процесс.
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        if fence:
+            _check_fence(cursor, fence)
+        cursor.execute('''
+            UPDATE broadcast_outbox SET status = 'unknown', updated_at = CURRENT_TIMESTAMP
+            WHERE broadcast_id = ? AND status = 'sending'
+        ''', (broadcast_id,))
+        return cursor.rowcount
+
+# === АРЕНДА ПЛАНОВЫХ ЗАДАЧ (см. leader.py) ===
+
+class LeaseLost(Exception):
+    """Аренда задачи истекла или перешла к другому процессу"""
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+def _check_fence(cursor, fence):
+    """
+    Проверить fencing-токен (name, token) в транзакции записи. UPDATE, а не SELECT:
+    строка аренды блокируется до коммита, и смена владельца не проскочит между проверкой и записью.
+    """
+    name, token = fence
+    cursor.execute('''
+        UPDATE job_leases SET holder = holder
+        WHERE name = ? AND token = ? AND expires_at >= ?
+    ''', (name, token, _now_ms()))
+    if cursor.rowcount == 0:
+        raise LeaseLost(f"Аренда {name} (токен {token}) больше не действует")
+
+@timed_db
+def acquire_lease(name, holder, ttl):
+    """Взять аренду, если она свободна или истекла; вернуть новый fencing-токен или None"""
+    now = _now_ms()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO job_leases (name, holder, token, expires_at)
+            VALUES (?, ?, 1, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                holder = excluded.holder,
+                token = job_leases.token + 1,
+                expires_at = excluded.expires_at
+            WHERE job_leases.expires_at < ?
+        ''', (name, holder, now + int(ttl * 1000), now))
+        if cursor.rowcount == 0:
+            return None
+        cursor.execute('SELECT token FROM job_leases WHERE name = ?', (name,))
+        return cursor.fetchone()['token']
+
+@timed_db
+def renew_lease(name, holder, token, ttl):
+    """Продлить свою действующую аренду"""
+    now = _now_ms()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE job_leases SET expires_at = ?
+            WHERE name = ? AND holder = ? AND token = ? AND expires_at >= ?
+        ''', (now + int(ttl * 1000), name, holder, token, now))
+        return cursor.rowcount > 0
+
+@timed_db
+def release_lease(name, holder, token, hold=0):
+    """Отпустить аренду; hold сек - не отдавать ещё столько, чтобы задачу не повторили сразу"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE job_leases SET expires_at = ?
+            WHERE name = ? AND holder = ? AND token = ?
+        ''', (_now_ms() + int(hold * 1000), name, holder, token))
+
+@timed_db
+def get_leases():
+    """Все аренды задач"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM job_leases ORDER BY name')
+        return [dict(row) for row in cursor.fetchall()]
+
+# === СВЕРКА СО STRIPE ===
+
+@timed_db
+def get_subscriptions_by_stripe_ids(stripe_subscription_ids):
+    """{stripe_subscription_id: последняя по end_date локальная подписка} для пачки сверки"""
+    if not stripe_subscription_ids:
+        return {}
+    
+    placeholders = ','.join('?' * len(stripe_subscription_ids))
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT id, tenant_id, telegram_id, stripe_subscription_id, stripe_price_id, status, end_date
+            FROM subscriptions
+            WHERE stripe_subscription_id IN ({placeholders})
+            ORDER BY end_date
+        ''', list(stripe_subscription_ids))
+        return {row['stripe_subscription_id']: dict(row) for row in cursor.fetchall()}
+
+@timed_db
+def get_payment_statuses(stripe_checkout_session_ids):
+    """{stripe_checkout_session_id: status} для пачки сверки"""
+    if not stripe_checkout_session_ids:
+        return {}
+    
+    placeholders = ','.join('?' * len(stripe_checkout_session_ids))
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT stripe_checkout_session_id, status FROM payments
+            WHERE stripe_checkout_session_id IN ({placeholders})
+        ''', list(stripe_checkout_session_ids))
+        return {row['stripe_checkout_session_id']: row['status'] for row in cursor.fetchall()}
+
+@timed_db
+def apply_subscription_corrections(corrections):
+    """
+    Исправления подписок по данным Stripe одной транзакцией.
+    
+    corrections - словари: id (None - создать подписку), tenant_id, telegram_id, stripe_subscription_id,
+    stripe_customer_id, stripe_price_id, status, start_date, end_date, а для существующих -
+    прочитанные при сверке old_status / old_end_date: строку, которую webhook успел изменить
+    после чтения, сверка не трогает. Возвращает число применённых исправлений.
+    """
+    now = datetime.now().isoformat()
+    changed = []
+    with get_db() as conn:
+        cursor = conn.cursor()
+        for correction in corrections:
+            if correction.get('id') is None:
+                cursor.execute('''
+                    INSERT INTO subscriptions
+                    (tenant_id, telegram_id, stripe_customer_id, stripe_subscription_id, stripe_price_id,
+                     status, start_date, end_date, updated_at)
+                    SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?
+                    WHERE NOT EXISTS (SELECT 1 FROM subscriptions WHERE stripe_subscription_id = ?)
+                ''', (correction['tenant_id'], correction['telegram_id'], correction.get('stripe_customer_id'),
+                      correction['stripe_subscription_id'], correction['stripe_price_id'],
+                      correction['status'], correction['start_date'], correction['end_date'], now,
+                      correction['stripe_subscription_id']))
+                if cursor.rowcount > 0:
+                    _track_status_change(cursor, correction['tenant_id'], None, correction['status'],
+                                         correction['stripe_price_id'], correction['end_date'], now)
+                    # Подписка, пропущенная webhook'ом, - новая в день своего начала, а не сверки
+                    _bump_daily(cursor, correction['tenant_id'], 'new', correction['start_date'])
+            else:
+                cursor.execute('''
+                    UPDATE subscriptions
+                    SET status = ?, end_date = ?, updated_at = ?
+                    WHERE id = ? AND status = ? AND end_date = ?
+                ''', (correction['status'], correction['end_date'], now,
+                      correction['id'], correction['old_status'], correction['old_end_date']))
+                if cursor.rowcount > 0:
+                    _track_status_change(cursor, correction['tenant_id'], correction['old_status'],
+                                         correction['status'], correction['stripe_price_id'],
+                                         correction['end_date'], now)
+            if cursor.rowcount > 0:
+                changed.append(correction['telegram_id'])
+    _invalidate('subscription', changed)
+    logger.info(f"Сверка: исправлено подписок {len(changed)}")
+    return len(changed)
+
+# === АРХИВАЦИЯ ===
+
+# Какие строки переносятся в архив: таблица -> условие (граница по времени - из _archive_cutoffs).
+# Условия совпадают с индексами idx_subscriptions_status_end_date и idx_payments_status.
+ARCHIVE_POLICIES = {
+    'subscriptions': "status IN ('expired', 'cancelled', 'canceled') AND end_date < :cutoff "
+                     "AND COALESCE(updated_at, end_date) < :cutoff",
+    'payments': "status IN ('pending', 'failed', 'expired') AND created_at < :created_cutoff",
+}
+
+def _archive_cutoffs(cutoff):
+    """
+    Граница архивации в формате сравниваемых колонок (сравнение строк): end_date и updated_at
+    подписок - локальный isoformat() с 'T', created_at платежей - CURRENT_TIMESTAMP (UTC, через пробел)
+    """
+    return {
+        'cutoff': cutoff.isoformat(),
+        'created_cutoff': cutoff.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+def _attach_archive(conn):
+    """Подключить архивную БД (RETENTION_ARCHIVE_DB), вернуть схему архивных таблиц"""
+    return BACKEND.attach_archive(conn, config.RETENTION_ARCHIVE_DB)
+
+def _with_archive(cursor, schema, table, columns):
+    """Подзапрос: строки table вместе с {table}_archive (если архив уже есть)"""
+    if not BACKEND.table_exists(cursor, f'{table}_archive', schema):
+        return table
+    # Колонки, которых в архиве ещё нет (добавлены миграциями позже), - NULL
+    archived = BACKEND.columns(cursor, f'{table}_archive', schema)
+    archive_columns = ', '.join(column if column in archived else f'NULL AS {column}'
+                                for column in columns.split(', '))
+    return (f'(SELECT {columns} FROM {table} '
+            f'UNION ALL SELECT {archive_columns} FROM {schema}.{table}_archive) AS history')
+
+def _ensure_archive_table(cursor, schema, table):
+    """Создать {table}_archive с колонками исходной таблицы и archived_at, вернуть общие колонки"""
+    archive = f'{table}_archive'
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS {schema}.{archive} AS SELECT * FROM {table} WHERE 1 = 0')
+    existing = BACKEND.columns(cursor, archive, schema)
+    columns = BACKEND.columns(cursor, table)
+    # Колонки, добавленные в исходную таблицу миграциями после создания архива
+    for column in columns + ['archived_at']:
+        if column not in existing:
+            cursor.execute(f'ALTER TABLE {schema}.{archive} ADD COLUMN {column} TEXT')
+    return columns
+
+@timed_db
+def count_archive_candidates(table, cutoff):
+    """Сколько строк table старше cutoff подходит под политику архивации"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT COUNT(*) FROM {table} WHERE {ARCHIVE_POLICIES[table]}', _archive_cutoffs(cutoff))
+        return cursor.fetchone()[0]
+
+@timed_db
+def archive_batch(table, cutoff, batch_size):
+    """
+    Перенести до batch_size строк table, подходящих под политику, в {table}_archive.
+    Одна короткая транзакция на пачку. Возвращает число перенесённых строк.
+    """
+    with get_db() as conn:
+        schema = _attach_archive(conn)
+        cursor = conn.cursor()
+        columns = ', '.join(_ensure_archive_table(cursor, schema, table))
+        cursor.execute(f'SELECT id FROM {table} WHERE {ARCHIVE_POLICIES[table]} LIMIT :limit',
+                       dict(_archive_cutoffs(cutoff), limit=batch_size))
+        ids = [row['id'] for row in cursor.fetchall()]
+        if not ids:
+            return 0
+        
+        placeholders = ','.join('?' * len(ids))
+        cursor.execute(f'''
+            INSERT INTO {schema}.{table}_archive ({columns}, archived_at)
+            SELECT {columns}, CURRENT_TIMESTAMP FROM {table} WHERE id IN ({placeholders})
+        ''', ids)
+        cursor.execute(f'DELETE FROM {table} WHERE id IN ({placeholders})', ids)
+        return len(ids)
+
+@timed_db
+def incremental_vacuum(pages):
+    """
+    Вернуть до pages свободных страниц файлу БД (нужен auto_vacuum = INCREMENTAL).
+    Возвращает (освобождено страниц, осталось свободных) или None, если режим не включён.
+    В PostgreSQL место возвращает autovacuum: (0, 0).
+    """
+    if BACKEND.name != 'sqlite':
+        return 0, 0
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] != 2:
+            return None
+        cursor.execute('PRAGMA freelist_count')
+        before = cursor.fetchone()[0]
+        # execute() делает один шаг прагмы (одна страница), executescript - до конца
+        conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+        cursor.execute('PRAGMA freelist_count')
+        after = cursor.fetchone()[0]
+        return before - after, after
+
+def enable_incremental_vacuum():
+    """Перевести существующую БД в auto_vacuum = INCREMENTAL (полный VACUUM, блокирует БД)"""
+    if BACKEND.name != 'sqlite':
+        raise RuntimeError("auto_vacuum есть только у SQLite")
+    conn = BACKEND.connect()
+    conn.isolation_level = None
+    try:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Задержки и сбои для локальных заглушек (fake_telegram_api.py, fake_stripe_api.py).
+
+Параметры задаются флагами при запуске заглушки или на лету:
+    curl -X POST http://127.0.0.1:8081/_fake/faults -H 'Content-Type: application/json' \\
+        -d '{"latency_ms": 50, "error_rate": 0.01, "throttle_rate": 0.05}'
+"""
+import random
+import threading
+import time
+from typing import Optional
+
+class FaultInjector:
+    """Задержка ответа, доля ошибок 5xx и доля ответов 429"""
+
+    FIELDS = ('latency_ms', 'jitter_ms', 'error_rate', 'throttle_rate', 'retry_after')
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, retry_after: int = 1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self.injected = {'errors': 0, 'throttled': 0}
+
+    def update(self, values: dict) -> dict:
+        """Изменить параметры (неизвестные ключи игнорируются), вернуть текущие"""
+        for field in self.FIELDS:
+            if field in values:
+                setattr(self, field, type(getattr(self, field))(values[field]))
+        return self.as_dict()
+
+    def as_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def apply(self) -> Optional[str]:
+        """Выдержать задержку и решить исход запроса: None, 'error' или 'throttle'"""
+        delay = self.latency_ms + (random.uniform(0, self.jitter_ms) if self.jitter_ms else 0)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        roll = random.random()
+        if roll < self.throttle_rate:
+            outcome = 'throttle'
+        elif roll < self.throttle_rate + self.error_rate:
+            outcome = 'error'
+        else:
+            return None
+
+        with self._lock:
+            self.injected['throttled' if outcome == 'throttle' else 'errors'] += 1
+        return outcome
+
+def add_arguments(parser):
+    """Общие флаги заглушек"""
+    parser.add_argument('--latency-ms', type=float, default=0, help="Задержка каждого ответа, мс")
+    parser.add_argument('--jitter-ms', type=float, default=0, help="Случайная добавка к задержке, мс")
+    parser.add_argument('--error-rate', type=float, default=0, help="Доля ответов 5xx (0..1)")
+    parser.add_argument('--throttle-rate', type=float, default=0, help="Доля ответов 429 (0..1)")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в ответах 429, сек")
+
+def configure(faults: FaultInjector, args):
+    """Применить флаги командной строки"""
+    faults.update({
+        'latency_ms': args.latency_ms,
+        'jitter_ms': args.jitter_ms,
+        'error_rate': args.error_rate,
+        'throttle_rate': args.throttle_rate,
+        'retry_after': args.retry_after
+    })
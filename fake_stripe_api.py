@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+Локальная заглушка Stripe API для нагрузочного тестирования без реального Stripe.
+
+Запуск заглушки:
+    python fake_stripe_api.py serve --port 8082 --webhook http://127.0.0.1:8080/webhook \\
+        [--latency-ms 150 --error-rate 0.01 --throttle-rate 0.02]
+
+Бот и webhook-сервер подключаются к ней через STRIPE_API_URL=http://127.0.0.1:8082/v1.
+Реализовано то, что использует stripe_integration.py: checkout sessions, subscriptions,
+prices, customers, списки сессий и подписок (для reconcile.py). Оплата имитируется запросом на /pay/<session_id> (ссылка из session.url):
+заглушка создаёт подписку и отправляет checkout.session.completed на webhook.
+Продление - POST /_fake/renew/<subscription_id> (событие invoice.paid).
+Заголовок Stripe-Account (тенанты на Stripe Connect) запоминается у сессии и подписки:
+списки фильтруются по нему, а события приходят с полем account.
+Задержки и сбои - см. fake_faults.py.
+
+Нагрузочный тест webhook_server.py (заглушка поднимается в том же процессе):
+    python fake_stripe_api.py load --webhook http://127.0.0.1:8080/webhook --payments 500 --concurrency 20
+"""
+import argparse
+import itertools
+import json
+import logging
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+
+import config
+import fake_faults
+from bench_stats import percentile
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+
+_lock = threading.Lock()
+_event_ids = itertools.count(1)
+
+SESSIONS = {}
+SUBSCRIPTIONS = {}
+CUSTOMERS = {}
+# ID сессии/подписки -> аккаунт Connect из заголовка Stripe-Account
+ACCOUNTS = {}
+# Куда отправлять события (флаг --webhook)
+WEBHOOK = {'url': config.WEBHOOK_URL}
+
+FAULTS = fake_faults.FaultInjector()
+
+def _price(price_id: str) -> dict:
+    """Объект Price: цены из config, неизвестные ID - как месячный тариф"""
+    plan = next((plan for plan, pid in config.STRIPE_PRICES.items() if pid == price_id), '1_month')
+    return {
+        'id': price_id,
+        'object': 'price',
+        'active': True,
+        'currency': 'eur',
+        'unit_amount': config.PLAN_PRICES_CENTS.get(plan, 499),
+        'recurring': {'interval': 'month', 'interval_count': config.PLAN_MONTHS.get(plan, 1)}
+    }
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}_test_{secrets.token_hex(12)}"
+
+def _error(status: int, error_type: str, message: str):
+    return jsonify({'error': {'type': error_type, 'message': message}}), status
+
+def _not_found(kind: str, object_id: str):
+    return _error(404, 'invalid_request_error', f"No such {kind}: '{object_id}'")
+
+@app.before_request
+def inject_faults():
+    """Задержки и сбои для запросов к API (не к /pay и /_fake)"""
+    if not request.path.startswith('/v1/'):
+        return None
+    outcome = FAULTS.apply()
+    if outcome == 'throttle':
+        response, status = _error(429, 'rate_limit_error', 'Too many requests')
+        response.headers['Retry-After'] = str(FAULTS.retry_after)
+        return response, status
+    if outcome == 'error':
+        return _error(500, 'api_error', 'Internal server error')
+    return None
+
+@app.route('/v1/checkout/sessions', methods=['POST'])
+def create_session():
+    """Создать Checkout Session"""
+    form = request.form
+    price_id = form.get('line_items[0][price]', '')
+    session_id = _new_id('cs')
+    session = {
+        'id': session_id,
+        'object': 'checkout.session',
+        'created': int(time.time()),
+        'mode': form.get('mode', 'subscription'),
+        'status': 'open',
+        'payment_status': 'unpaid',
+        'url': f"{request.host_url}pay/{session_id}",
+        'customer': None,
+        'customer_email': form.get('customer_email'),
+        'subscription': None,
+        'payment_intent': None,
+        'amount_total': _price(price_id)['unit_amount'],
+        'currency': 'eur',
+        'success_url': form.get('success_url'),
+        'cancel_url': form.get('cancel_url'),
+        'metadata': {
+            key[len('metadata['):-1]: value for key, value in form.items() if key.startswith('metadata[')
+        },
+        'line_items': [{'price': price_id, 'quantity': int(form.get('line_items[0][quantity]', 1))}]
+    }
+    with _lock:
+        SESSIONS[session_id] = session
+        if request.headers.get('Stripe-Account'):
+            ACCOUNTS[session_id] = request.headers['Stripe-Account']
+    return jsonify(session)
+
+def _list_page(objects: dict, matches=lambda obj: True, expand=None):
+    """Страница списка как в Stripe: новые первыми, limit / starting_after, expand data.<поле>"""
+    limit = min(int(request.args.get('limit', 10)), 100)
+    ids = list(reversed(objects))
+    start = 0
+    starting_after = request.args.get('starting_after')
+    if starting_after:
+        if starting_after not in objects:
+            return _not_found('object', starting_after)
+        start = ids.index(starting_after) + 1
+
+    page, has_more = [], False
+    account = request.headers.get('Stripe-Account')
+    for object_id in ids[start:]:
+        obj = objects[object_id]
+        if ACCOUNTS.get(object_id) != account or not matches(obj):
+            continue
+        if len(page) == limit:
+            has_more = True
+            break
+        page.append(obj)
+
+    for field in request.args.getlist('expand[]'):
+        name = field[len('data.'):]
+        if expand and name in expand:
+            page = [dict(obj, **{name: expand[name].get(obj.get(name), obj.get(name))}) for obj in page]
+    return jsonify({'object': 'list', 'url': request.path, 'has_more': has_more, 'data': page})
+
+@app.route('/v1/checkout/sessions')
+def list_sessions():
+    created_gte = int(request.args.get('created[gte]', 0))
+    return _list_page(SESSIONS, lambda s: s['created'] >= created_gte, expand={'subscription': SUBSCRIPTIONS})
+
+@app.route('/v1/subscriptions')
+def list_subscriptions():
+    status = request.args.get('status', 'active')
+    return _list_page(SUBSCRIPTIONS, lambda s: status == 'all' or s['status'] == status)
+
+@app.route('/v1/checkout/sessions/<session_id>')
+def get_session(session_id):
+    session = SESSIONS.get(session_id)
+    return jsonify(session) if session else _not_found('checkout.session', session_id)
+
+@app.route('/v1/prices/<price_id>')
+def get_price(price_id):
+    return jsonify(_price(price_id))
+
+@app.route('/v1/subscriptions/<subscription_id>', methods=['GET', 'DELETE'])
+def subscription_endpoint(subscription_id):
+    subscription = SUBSCRIPTIONS.get(subscription_id)
+    if not subscription:
+        return _not_found('subscription', subscription_id)
+    if request.method == 'DELETE':
+        subscription['status'] = 'canceled'
+        subscription['canceled_at'] = int(time.time())
+        send_event('customer.subscription.deleted', subscription, ACCOUNTS.get(subscription_id))
+    return jsonify(subscription)
+
+@app.route('/v1/customers/<customer_id>')
+def get_customer(customer_id):
+    customer = CUSTOMERS.get(customer_id)
+    return jsonify(customer) if customer else _not_found('customer', customer_id)
+
+def send_event(event_type: str, obj: dict, account: str = None):
+    """Отправить событие на webhook, вернуть (HTTP статус, мс)"""
+    event = {
+        'id': f"evt_test_{next(_event_ids)}_{secrets.token_hex(4)}",
+        'object': 'event',
+        'type': event_type,
+        'created': int(time.time()),
+        'data': {'object': obj}
+    }
+    if account:
+        event['account'] = account
+    started = time.perf_counter()
+    try:
+        response = requests.post(WEBHOOK['url'], data=json.dumps(event),
+                                 headers={'Content-Type': 'application/json'}, timeout=30)
+        status = response.status_code
+    except requests.RequestException as e:
+        logger.error(f"Webhook недоступен: {e}")
+        status = 0
+    return status, (time.perf_counter() - started) * 1000
+
+@app.route('/pay/<session_id>', methods=['GET', 'POST'])
+def pay(session_id):
+    """Имитация оплаты: подписка, клиент и событие checkout.session.completed"""
+    session = SESSIONS.get(session_id)
+    if not session:
+        return _not_found('checkout.session', session_id)
+    if session['status'] == 'complete':
+        return jsonify({'status': 'already_paid', 'session': session_id})
+
+    now = int(time.time())
+    price = _price(session['line_items'][0]['price'])
+    customer_id = _new_id('cus')
+    subscription_id = _new_id('sub')
+    months = price['recurring']['interval_count']
+    with _lock:
+        CUSTOMERS[customer_id] = {'id': customer_id, 'object': 'customer', 'email': session['customer_email']}
+        SUBSCRIPTIONS[subscription_id] = {
+            'id': subscription_id,
+            'object': 'subscription',
+            'status': 'active',
+            'customer': customer_id,
+            'current_period_start': now,
+            'current_period_end': now + months * 30 * 86400,
+            'items': {'object': 'list', 'data': [{'id': _new_id('si'), 'price': price, 'quantity': 1}]},
+            'metadata': session['metadata']
+        }
+        session.update({
+            'status': 'complete',
+            'payment_status': 'paid',
+            'customer': customer_id,
+            'subscription': subscription_id,
+            'payment_intent': _new_id('pi')
+        })
+        if session_id in ACCOUNTS:
+            ACCOUNTS[subscription_id] = ACCOUNTS[session_id]
+
+    status, elapsed_ms = send_event('checkout.session.completed', session, ACCOUNTS.get(session_id))
+    return jsonify({'status': 'paid', 'subscription': subscription_id,
+                    'webhook_status': status, 'webhook_ms': round(elapsed_ms, 2)})
+
+@app.route('/_fake/renew/<subscription_id>', methods=['POST'])
+def renew(subscription_id):
+    """Имитация автосписания: событие invoice.paid"""
+    subscription = SUBSCRIPTIONS.get(subscription_id)
+    if not subscription:
+        return _not_found('subscription', subscription_id)
+    invoice = {
+        'id': _new_id('in'),
+        'object': 'invoice',
+        'subscription': subscription_id,
+        'customer': subscription['customer'],
+        'amount_paid': subscription['items']['data'][0]['price']['unit_amount'],
+        'currency': 'eur',
+        'status': 'paid'
+    }
+    status, elapsed_ms = send_event('invoice.paid', invoice, ACCOUNTS.get(subscription_id))
+    return jsonify({'status': 'renewed', 'webhook_status': status, 'webhook_ms': round(elapsed_ms, 2)})
+
+@app.route('/_fake/faults', methods=['GET', 'POST'])
+def faults_endpoint():
+    """Посмотреть или изменить задержки и сбои"""
+    if request.method == 'POST':
+        FAULTS.update(request.get_json(force=True) or {})
+    return jsonify({'faults': FAULTS.as_dict(), 'injected': FAULTS.injected,
+                    'sessions': len(SESSIONS), 'subscriptions': len(SUBSCRIPTIONS)})
+
+def start_server(host: str, port: int):
+    """Запустить заглушку в фоновом потоке"""
+    server = make_server(host, port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info(f"Заглушка Stripe API запущена на {host}:{port}")
+    return server
+
+def run_load(args):
+    """Провести поток оплат через webhook_server.py и замерить время обработки событий"""
+    server = start_server(args.host, args.port)
+    client = app.test_client()
+    price_ids = list(config.STRIPE_PRICES.values())
+
+    def pay_once(i):
+        session = client.post('/v1/checkout/sessions', data={
+            'mode': 'subscription',
+            'line_items[0][price]': price_ids[i % len(price_ids)],
+            'line_items[0][quantity]': 1,
+            'customer_email': f'user{i}@example.com',
+            'metadata[telegram_id]': str(args.first_user_id + i)
+        }).get_json()
+        if 'id' not in session:
+            # Сбой заглушки на создании сессии - оплата не состоялась
+            return {'webhook_status': None}
+        return client.post(f"/pay/{session['id']}").get_json()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(pay_once, range(args.payments)))
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    latencies = [r['webhook_ms'] for r in results if r.get('webhook_status') == 200]
+    result = {
+        'payments': args.payments,
+        'webhook_errors': args.payments - len(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'webhook_ms_p50': round(percentile(latencies, 50), 2),
+        'webhook_ms_p95': round(percentile(latencies, 95), 2),
+        'webhook_ms_p99': round(percentile(latencies, 99), 2),
+        'stripe_faults_injected': FAULTS.injected
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Заглушка Stripe API")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    serve = sub.add_parser('serve', help="Запустить заглушку")
+    load = sub.add_parser('load', help="Нагрузочный тест webhook_server.py")
+    for command in (serve, load):
+        command.add_argument('--host', default='127.0.0.1')
+        command.add_argument('--port', type=int, default=8082)
+        command.add_argument('--webhook', default=config.WEBHOOK_URL, help="URL webhook_server.py")
+        fake_faults.add_arguments(command)
+
+    load.add_argument('--payments', type=int, default=500)
+    load.add_argument('--concurrency', type=int, default=20)
+    load.add_argument('--first-user-id', type=int, default=20_000_000)
+
+    args = parser.parse_args()
+    WEBHOOK['url'] = args.webhook
+    fake_faults.configure(FAULTS, args)
+
+    if args.command == 'serve':
+        logger.info(f"Заглушка Stripe API: http://{args.host}:{args.port}/v1 (события -> {args.webhook})")
+        app.run(host=args.host, port=args.port, debug=False, threaded=True)
+    else:
+        run_load(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Локальная заглушка Telegram Bot API для нагрузочного тестирования бота.
+
+Запуск заглушки:
+    python fake_telegram_api.py serve --port 8081 [--latency-ms 50 --error-rate 0.01 --throttle-rate 0.05]
+
+Бот, webhook-сервер и фоновые скрипты подключаются к ней через
+TELEGRAM_API_URL=http://127.0.0.1:8081/bot. Поддерживаются методы, которые использует проект:
+sendMessage, sendDocument, editMessageText, createChatInviteLink, revokeChatInviteLink,
+banChatMember, unbanChatMember, getChatMember, approve/declineChatJoinRequest.
+Задержки и сбои - см. fake_faults.py.
+
+Нагрузочный тест webhook-режима (заглушка поднимается в том же процессе):
+    python fake_telegram_api.py load --webhook http://127.0.0.1:8443/telegram \\
+        --secret <TELEGRAM_WEBHOOK_SECRET> --updates 1000 --concurrency 20
+"""
+import argparse
+import itertools
+import json
+import logging
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+
+import fake_faults
+from bench_stats import percentile
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+
+_message_ids = itertools.count(1)
+_lock = threading.Lock()
+
+# chat_id -> время последнего ответа бота (для замера задержки)
+REPLIES = {}
+# method -> количество вызовов
+CALLS = {}
+# user_id -> статус в канале (по умолчанию left)
+MEMBERS = {}
+
+FAULTS = fake_faults.FaultInjector()
+
+# Служебные методы без задержек и сбоев
+SERVICE_METHODS = {'getMe', 'getUpdates', 'getWebhookInfo', 'setWebhook', 'deleteWebhook'}
+
+BOT_USER = {
+    'id': 1,
+    'is_bot': True,
+    'first_name': 'FakeBot',
+    'username': 'fake_bot'
+}
+
+def _params():
+    """Параметры запроса (PTB шлёт form-data со значениями в JSON)"""
+    params = {}
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        params.update(body)
+    for key, value in request.values.items():
+        try:
+            params[key] = json.loads(value)
+        except (ValueError, TypeError):
+            params[key] = value
+    return params
+
+def _ok(result):
+    return jsonify({'ok': True, 'result': result})
+
+def _error(code: int, description: str, parameters: dict = None):
+    body = {'ok': False, 'error_code': code, 'description': description}
+    if parameters:
+        body['parameters'] = parameters
+    return jsonify(body), code
+
+def _message(chat_id: int, **fields):
+    """Объект Message, отправленный ботом"""
+    message = {
+        'message_id': next(_message_ids),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'channel'},
+        'from': BOT_USER
+    }
+    message.update(fields)
+    return message
+
+def _user(user_id: int):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+@app.route('/_fake/faults', methods=['GET', 'POST'])
+def faults_endpoint():
+    """Посмотреть или изменить задержки и сбои"""
+    if request.method == 'POST':
+        FAULTS.update(request.get_json(force=True) or {})
+    return jsonify({'faults': FAULTS.as_dict(), 'injected': FAULTS.injected, 'calls': CALLS})
+
+@app.route('/bot<token>/<method>', methods=['GET', 'POST'])
+def bot_api(token, method):
+    """Обработчик методов Bot API"""
+    params = _params()
+
+    with _lock:
+        CALLS[method] = CALLS.get(method, 0) + 1
+
+    if method not in SERVICE_METHODS:
+        outcome = FAULTS.apply()
+        if outcome == 'throttle':
+            return _error(429, f"Too Many Requests: retry after {FAULTS.retry_after}",
+                          {'retry_after': FAULTS.retry_after})
+        if outcome == 'error':
+            return _error(500, "Internal Server Error")
+
+    if method == 'getMe':
+        return _ok(dict(BOT_USER, can_join_groups=True, can_read_all_group_messages=False,
+                        supports_inline_queries=False))
+
+    if method == 'sendMessage':
+        chat_id = int(params.get('chat_id', 0))
+        with _lock:
+            REPLIES[chat_id] = time.perf_counter()
+        return _ok(_message(chat_id, text=params.get('text', '')))
+
+    if method == 'sendDocument':
+        chat_id = int(params.get('chat_id', 0))
+        file_id = params.get('document') if isinstance(params.get('document'), str) else secrets.token_hex(16)
+        return _ok(_message(chat_id, caption=params.get('caption'), document={
+            'file_id': file_id,
+            'file_unique_id': file_id[:16],
+            'file_name': 'document'
+        }))
+
+    if method == 'editMessageText':
+        return _ok(_message(int(params.get('chat_id', 0)), text=params.get('text', ''),
+                            message_id=int(params.get('message_id', 0))))
+
+    if method in ('createChatInviteLink', 'revokeChatInviteLink'):
+        link = params.get('invite_link') or f"https://t.me/+{secrets.token_urlsafe(12)}"
+        result = {
+            'invite_link': link,
+            'creator': BOT_USER,
+            'creates_join_request': bool(params.get('creates_join_request', False)),
+            'is_primary': False,
+            'is_revoked': method == 'revokeChatInviteLink'
+        }
+        for key in ('name', 'expire_date', 'member_limit'):
+            if params.get(key) is not None:
+                result[key] = params[key]
+        return _ok(result)
+
+    if method in ('banChatMember', 'unbanChatMember'):
+        user_id = int(params.get('user_id', 0))
+        with _lock:
+            if method == 'banChatMember':
+                MEMBERS[user_id] = 'kicked'
+            elif MEMBERS.get(user_id) == 'kicked' or not params.get('only_if_banned'):
+                MEMBERS[user_id] = 'left'
+        return _ok(True)
+
+    if method == 'approveChatJoinRequest':
+        with _lock:
+            MEMBERS[int(params.get('user_id', 0))] = 'member'
+        return _ok(True)
+
+    if method == 'getChatMember':
+        user_id = int(params.get('user_id', 0))
+        status = MEMBERS.get(user_id, 'left')
+        member = {'status': status, 'user': _user(user_id)}
+        if status == 'kicked':
+            member['until_date'] = 0
+        return _ok(member)
+
+    if method == 'getUpdates':
+        # Long polling: держим соединение, новых обновлений нет
+        time.sleep(min(float(params.get('timeout', 0) or 0), 1.0))
+        return _ok([])
+
+    if method == 'getWebhookInfo':
+        return _ok({'url': '', 'has_custom_certificate': False, 'pending_update_count': 0})
+
+    # setWebhook, deleteWebhook, setMyCommands и прочие служебные методы
+    return _ok(True)
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    """Синтетическое обновление с текстовым сообщением"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': f'User{user_id}'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'text': text
+        }
+    }
+
+def start_server(host: str, port: int):
+    """Запустить заглушку в фоновом потоке"""
+    server = make_server(host, port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info(f"Заглушка Bot API запущена на {host}:{port}")
+    return server
+
+def run_load(args):
+    """Отправить поток обновлений на webhook бота и замерить задержку ответа"""
+    server = start_server(args.host, args.port)
+    session = requests.Session()
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret}
+    sent_at = {}
+    errors = 0
+
+    def post(i):
+        user_id = args.first_user_id + i
+        sent_at[user_id] = time.perf_counter()
+        response = session.post(args.webhook, json=make_update(i + 1, user_id, args.text),
+                                headers=headers, timeout=10)
+        return response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for status in pool.map(post, range(args.updates)):
+            if status != 200:
+                errors += 1
+
+    # Ждём ответы бота
+    deadline = time.perf_counter() + args.wait
+    while time.perf_counter() < deadline and len(REPLIES) < args.updates - errors:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    latencies = [(REPLIES[uid] - ts) * 1000 for uid, ts in sent_at.items() if uid in REPLIES]
+
+    result = {
+        'updates': args.updates,
+        'http_errors': errors,
+        'replies': len(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'latency_ms_p50': round(percentile(latencies, 50), 2),
+        'latency_ms_p95': round(percentile(latencies, 95), 2),
+        'latency_ms_p99': round(percentile(latencies, 99), 2),
+        'api_calls': CALLS
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    serve = sub.add_parser('serve', help="Запустить заглушку")
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8081)
+    fake_faults.add_arguments(serve)
+
+    load = sub.add_parser('load', help="Нагрузочный тест webhook-режима бота")
+    load.add_argument('--host', default='127.0.0.1')
+    load.add_argument('--port', type=int, default=8081)
+    load.add_argument('--webhook', required=True, help="URL webhook бота")
+    load.add_argument('--secret', default='', help="TELEGRAM_WEBHOOK_SECRET")
+    load.add_argument('--updates', type=int, default=1000)
+    load.add_argument('--concurrency', type=int, default=20)
+    load.add_argument('--text', default='/start')
+    load.add_argument('--first-user-id', type=int, default=10_000_000)
+    load.add_argument('--wait', type=float, default=30.0, help="Сколько ждать ответы, сек")
+
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        fake_faults.configure(FAULTS, args)
+        logger.info(f"Заглушка Bot API: http://{args.host}:{args.port}/bot")
+        app.run(host=args.host, port=args.port, debug=False, threaded=True)
+    else:
+        run_load(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Кэш персональных инвайт-ссылок.
+
+У каждого пользователя не больше одной активной ссылки: пока она не истекла
+и не использована, бот и webhook-сервер отдают её же, а новую создают
+только после истечения или вступления в канал. Ссылки, которые больше
+не нужны (юзер удалён из канала), отзываются пачкой в фоне.
+
+В режиме join_request персональные ссылки не создаются (см. join_requests.py).
+"""
+import logging
+from datetime import datetime, timedelta
+
+from telegram import Bot
+from telegram.error import BadRequest
+
+import config
+import database as db
+from rate_limiter import PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+async def get_or_create_invite_link(bot: Bot, tenant, telegram_id: int) -> str:
+    """Вернуть действующую инвайт-ссылку пользователя в канал тенанта или создать новую"""
+    # В режиме заявок у всех одна статическая ссылка, доступ проверяется при одобрении
+    if config.CHANNEL_ACCESS_MODE == 'join_request':
+        return tenant.channel_join_link
+
+    now = datetime.now()
+    valid_until = now + timedelta(minutes=config.INVITE_LINK_MIN_REMAINING_MINUTES)
+
+    cached = db.get_active_invite_link(telegram_id, valid_until, tenant.id)
+    if cached:
+        logger.info(f"Инвайт-ссылка для {telegram_id} взята из кэша")
+        return cached['invite_link']
+
+    expire_date = now + timedelta(hours=config.INVITE_LINK_TTL_HOURS)
+    invite_link = await bot.create_chat_invite_link(
+        chat_id=tenant.channel_id,
+        member_limit=1,
+        name=f"User_{telegram_id}",
+        expire_date=expire_date
+    )
+
+    db.save_invite_link(telegram_id, invite_link.invite_link, expire_date, tenant.id)
+    return invite_link.invite_link
+
+async def revoke_superseded_invite_links(bot: Bot, tenant, batch_size: int = 100) -> int:
+    """Отозвать пачку ненужных ссылок тенанта, вернуть количество обработанных"""
+    links = db.get_superseded_invite_links(limit=batch_size, tenant_id=tenant.id)
+    revoked = []
+
+    for link in links:
+        try:
+            await bot.revoke_chat_invite_link(
+                chat_id=tenant.channel_id,
+                invite_link=link['invite_link'],
+                rate_limit_args={'priority': PRIORITY_BULK}
+            )
+            revoked.append(link['invite_link'])
+        except BadRequest as e:
+            # Ссылка уже недействительна - отзывать нечего
+            logger.warning(f"Ссылку {link['invite_link']} не удалось отозвать: {e}")
+            revoked.append(link['invite_link'])
+        except Exception as e:
+            # Сетевая ошибка - попробуем в следующий раз
+            logger.error(f"Ошибка отзыва ссылки {link['invite_link']}: {e}")
+
+    if revoked:
+        db.mark_invite_links_revoked(revoked, tenant.id)
+        logger.info(f"Отозвано инвайт-ссылок: {len(revoked)}")
+
+    return len(revoked)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Доступ в канал по заявкам (CHANNEL_ACCESS_MODE=join_request).
+
+Канал открыт одной статической ссылкой с одобрением заявок. Бот получает
+chat_join_request, проверяет подписку по горячему кэшу (с запасным запросом
+в БД) и одобряет/отклоняет накопившиеся заявки пачкой. Изменения подписок
+из webhook-сервера и проверки подписок приходят через шину cache_bus.py.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import List
+
+from telegram import Bot, ChatJoinRequest
+
+import cache_bus
+import config
+import database as db
+
+logger = logging.getLogger(__name__)
+
+class ActiveSubscriberCache:
+    """Горячий кэш активных подписчиков тенанта: telegram_id -> end_date"""
+
+    def __init__(self, ttl: int, tenant_id: str):
+        self.ttl = ttl
+        self.tenant_id = tenant_id
+        self._end_dates = {}
+        self._loaded_at = 0.0
+
+    def refresh(self):
+        """Перечитать всех активных подписчиков одним запросом"""
+        self._end_dates = db.get_active_subscriber_end_dates(self.tenant_id)
+        self._loaded_at = time.monotonic()
+        logger.info(f"Кэш подписчиков {self.tenant_id} обновлён: {len(self._end_dates)}")
+
+    def invalidate(self, key, version=None):
+        """Сообщение шины кэшей: подписка пользователя изменилась (None - все)"""
+        if key is None:
+            self._loaded_at = 0.0
+        else:
+            self._end_dates.pop(int(key), None)
+
+    def is_active(self, telegram_id: int) -> bool:
+        """Есть ли у пользователя активная подписка"""
+        if time.monotonic() - self._loaded_at > self.ttl:
+            self.refresh()
+
+        end_date = self._end_dates.get(telegram_id)
+        if end_date and datetime.fromisoformat(end_date) > datetime.now():
+            return True
+
+        # Промах: оплата могла прийти после обновления кэша
+        subscription = db.get_active_subscription(telegram_id, self.tenant_id)
+        if subscription:
+            self._end_dates[telegram_id] = subscription['end_date']
+            return True
+        return False
+
+class JoinRequestBatcher:
+    """Копит заявки на вступление и обрабатывает их пачкой"""
+
+    def __init__(self, bot: Bot, cache: ActiveSubscriberCache, interval: float, batch_size: int):
+        self.bot = bot
+        self.cache = cache
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending: List[ChatJoinRequest] = []
+        self._flush_task = None
+
+    async def add(self, join_request: ChatJoinRequest):
+        """Добавить заявку в очередь"""
+        self._pending.append(join_request)
+
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Одобрить/отклонить все накопленные заявки"""
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        calls = []
+        approved = 0
+        for join_request in batch:
+            user_id = join_request.from_user.id
+            if self.cache.is_active(user_id):
+                calls.append(self.bot.approve_chat_join_request(chat_id=join_request.chat.id, user_id=user_id))
+                approved += 1
+            else:
+                calls.append(self.bot.decline_chat_join_request(chat_id=join_request.chat.id, user_id=user_id))
+
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        for join_request, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка обработки заявки {join_request.from_user.id}: {result}")
+
+        logger.info(f"Заявки обработаны: одобрено {approved}, отклонено {len(batch) - approved}")
+
+def create_batcher(bot: Bot, tenant) -> JoinRequestBatcher:
+    """Собрать обработчик заявок в канал тенанта с настройками из config"""
+    cache = ActiveSubscriberCache(config.JOIN_REQUEST_CACHE_TTL, tenant.id)
+    cache_bus.BUS.subscribe('subscription', cache.invalidate)
+    return JoinRequestBatcher(
+        bot,
+        cache,
+        interval=config.JOIN_REQUEST_BATCH_INTERVAL_MS / 1000,
+        batch_size=config.JOIN_REQUEST_BATCH_SIZE
+    )
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Выбор ведущего для плановых задач: проверку истёкших подписок (check_subscriptions.py,
+auto_check.py) и уведомления (notify_expiring.py) можно запускать на нескольких узлах,
+работу делает один.
+
+Ведущий - держатель аренды: строки job_leases с владельцем, сроком и fencing-токеном.
+Держатель продлевает аренду каждые LEADER_LEASE_SECONDS / 3. Если продлить не удалось
+(процесс подвис, аренду забрали после истечения), задача прерывается перед следующим
+действием (Lease.check). Токен растёт при каждой смене владельца, и expire_subscriptions
+проверяет его в той же транзакции, поэтому бывший ведущий, проснувшийся после паузы,
+ничего не запишет.
+
+Разовые запуски из крона (run_exclusive): первый берёт аренду, остальные пропускают запуск;
+после завершения аренда держится ещё LEADER_JOB_COOLDOWN_SECONDS, чтобы крон другого узла
+со сдвигом в пару минут не повторил работу. Сроки аренды считаются по time.time() - часы
+узлов должны быть синхронизированы (NTP).
+
+    python leader.py status
+"""
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import datetime
+
+import config
+import database as db
+
+logger = logging.getLogger(__name__)
+
+LeaseLost = db.LeaseLost
+
+class Lease:
+    """Аренда задачи name, принадлежащая этому процессу"""
+
+    def __init__(self, name: str, ttl: float = None, holder: str = None):
+        self.name = name
+        self.ttl = ttl or config.LEADER_LEASE_SECONDS
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}"
+        self.token = None
+        self._valid_until = 0.0
+
+    @property
+    def fence(self):
+        """(имя, токен) для проверки в транзакциях записи"""
+        return (self.name, self.token)
+
+    @property
+    def is_held(self) -> bool:
+        return self.token is not None and time.monotonic() < self._valid_until
+
+    def _extend(self, started: float):
+        # Локальный срок короче срока в БД на пятую часть - запас на расхождение часов
+        self._valid_until = started + self.ttl * 0.8
+
+    def acquire(self) -> bool:
+        """Взять аренду, если она свободна"""
+        started = time.monotonic()
+        self.token = db.acquire_lease(self.name, self.holder, self.ttl)
+        if self.token is None:
+            return False
+        self._extend(started)
+        logger.info(f"Аренда {self.name} получена (токен {self.token}, {self.holder})")
+        return True
+
+    def renew(self) -> bool:
+        """Продлить аренду; False - аренда потеряна"""
+        started = time.monotonic()
+        if self.token is None or not db.renew_lease(self.name, self.holder, self.token, self.ttl):
+            self._valid_until = 0.0
+            return False
+        self._extend(started)
+        return True
+
+    def check(self):
+        """Вызывать перед каждым действием задачи: LeaseLost, если аренда потеряна или могла истечь"""
+        if not self.is_held:
+            raise LeaseLost(f"Аренда {self.name} потеряна")
+
+    def release(self, hold: float = 0):
+        """Отпустить аренду (hold сек - придержать от повторного запуска)"""
+        if self.token is not None:
+            db.release_lease(self.name, self.holder, self.token, hold)
+            self.token = None
+            self._valid_until = 0.0
+
+    async def keep_alive(self):
+        """Фоновое продление аренды, пока она не потеряна"""
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                renewed = await asyncio.to_thread(self.renew)
+            except Exception as e:
+                # Временная ошибка БД: следующая попытка, пока локальный срок не истёк
+                logger.error(f"Ошибка продления аренды {self.name}: {e}")
+                continue
+            if not renewed:
+                logger.warning(f"Аренда {self.name} потеряна, задача будет прервана")
+                return
+
+async def run_exclusive(name: str, job, cooldown: float = None):
+    """
+    Выполнить разовую задачу await job(lease), если аренда name свободна.
+    Иначе - пропустить (задача уже идёт или недавно выполнена на другом узле), вернуть None.
+    """
+    lease = Lease(name)
+    if not await asyncio.to_thread(lease.acquire):
+        logger.info(f"Задача {name} выполняется или недавно выполнена другим процессом - пропуск")
+        return None
+
+    keeper = asyncio.create_task(lease.keep_alive())
+    hold = 0
+    try:
+        result = await job(lease)
+        hold = config.LEADER_JOB_COOLDOWN_SECONDS if cooldown is None else cooldown
+        return result
+    except LeaseLost as e:
+        logger.error(f"Задача {name} прервана: {e}")
+        return None
+    finally:
+        keeper.cancel()
+        # После сбоя аренду отпускаем сразу - другой узел может повторить
+        await asyncio.to_thread(lease.release, hold)
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Аренды плановых задач")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('status', help="Показать держателей аренд")
+    parser.parse_args()
+
+    db.init_db()
+    now = time.time()
+    for lease in db.get_leases():
+        expires = lease['expires_at'] / 1000
+        state = f"ещё {expires - now:.0f} сек" if expires > now else "свободна"
+        print(f"{lease['name']}: {lease['holder']}, токен {lease['token']}, "
+              f"до {datetime.fromtimestamp(expires):%d.%m %H:%M:%S} ({state})")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Метрики в формате Prometheus для всех сервисов.
+
+webhook_server.py и redirect_server.py отдают их на /metrics, бот и auto_check.py -
+на отдельном порту (BOT_METRICS_PORT, AUTOCHECK_METRICS_PORT).
+Если prometheus_client не установлен, метрики отключаются (заглушки без накладных расходов).
+
+Замер накладных расходов инструментирования:
+    python metrics.py bench
+"""
+import functools
+import hmac
+import logging
+import time
+
+import config
+from profiling import report_timing
+import tracing
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import (
+        Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest, start_http_server
+    )
+    ENABLE_METRICS = True
+except ImportError:
+    ENABLE_METRICS = False
+    logger.warning("prometheus_client не найден - метрики отключены")
+
+class _NoopMetric:
+    """Заглушка метрики, если prometheus_client не установлен"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+    def set(self, value):
+        pass
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+if ENABLE_METRICS:
+    WEBHOOK_EVENTS = Counter('webhook_events_total', 'События Stripe webhook', ['type', 'outcome'])
+    HANDLER_SECONDS = Histogram('handler_duration_seconds', 'Время работы обработчиков', ['handler'], buckets=LATENCY_BUCKETS)
+    EXTERNAL_SECONDS = Histogram('external_call_duration_seconds', 'Время запросов к Stripe/Telegram', ['service', 'method'], buckets=LATENCY_BUCKETS)
+    EXTERNAL_ERRORS = Counter('external_call_errors_total', 'Ошибки запросов к Stripe/Telegram', ['service', 'method'])
+    DB_SECONDS = Histogram('db_query_duration_seconds', 'Время функций database.py', ['function'], buckets=LATENCY_BUCKETS)
+    SWEEP_SECONDS = Histogram('expiry_sweep_duration_seconds', 'Длительность проверки истёкших подписок', buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900))
+    SWEEP_SIZE = Gauge('expiry_sweep_size', 'Размер последней проверки истёкших подписок', ['kind'])
+    REDIRECT_REQUESTS = Counter('redirect_requests_total', 'Переходы по коротким ссылкам', ['result'])
+else:
+    WEBHOOK_EVENTS = HANDLER_SECONDS = EXTERNAL_SECONDS = EXTERNAL_ERRORS = _NoopMetric()
+    DB_SECONDS = SWEEP_SECONDS = SWEEP_SIZE = REDIRECT_REQUESTS = _NoopMetric()
+
+def timed_db(func):
+    """Декоратор: время выполнения функции database.py (и спан, если идёт трассировка)"""
+    if not ENABLE_METRICS and not config.TRACE_FILE:
+        return func
+
+    # Дочерняя метрика создаётся один раз, чтобы не искать label на каждом вызове
+    child = DB_SECONDS.labels(function=func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            child.observe(seconds)
+            tracing.record(f"db.{func.__name__}", seconds)
+
+    return wrapper
+
+def track_handler(func, name=None):
+    """Обёртка асинхронного обработчика: гистограмма времени работы и лог медленных вызовов"""
+    if not ENABLE_METRICS and not config.SLOW_HANDLER_MS:
+        return func
+
+    name = name or func.__name__
+    child = HANDLER_SECONDS.labels(handler=name)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        # CPU потока event loop за время обработчика (включая соседние задачи)
+        cpu_started = time.thread_time()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            wall = time.perf_counter() - started
+            child.observe(wall)
+            report_timing(name, wall, time.thread_time() - cpu_started)
+
+    return wrapper
+
+def observe_external(service, method, seconds, error=False):
+    """Учесть запрос к внешнему API (и спан, если идёт трассировка)"""
+    EXTERNAL_SECONDS.labels(service=service, method=method).observe(seconds)
+    tracing.record(f"{service}.{method}", seconds, error=error)
+    if error:
+        EXTERNAL_ERRORS.labels(service=service, method=method).inc()
+
+def start_metrics_server(port):
+    """Отдавать /metrics на отдельном порту (для бота и auto_check)"""
+    if not ENABLE_METRICS or not port:
+        return
+    start_http_server(port, addr=config.METRICS_LISTEN)
+    logger.info(f"Метрики доступны на {config.METRICS_LISTEN}:{port}/metrics")
+
+def _authorized(request, token):
+    """Заголовок Authorization: Bearer <token> (сравнение за постоянное время)"""
+    header = request.headers.get('Authorization', '')
+    return hmac.compare_digest(header.encode('utf-8'), f"Bearer {token}".encode('utf-8'))
+
+def flask_metrics_response(request):
+    """Ответ для Flask-маршрута /metrics (с проверкой METRICS_TOKEN, если задан)"""
+    if config.METRICS_TOKEN and not _authorized(request, config.METRICS_TOKEN):
+        return 'Forbidden', 403
+    if not ENABLE_METRICS:
+        return 'prometheus_client not installed', 503
+    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+def bench(iterations=200_000):
+    """Сравнить вызов функции с декоратором timed_db и без"""
+    def plain(x):
+        return x + 1
+
+    decorated = timed_db(plain)
+    results = {}
+    for name, fn in (('plain', plain), ('timed_db', decorated)):
+        started = time.perf_counter()
+        for i in range(iterations):
+            fn(i)
+        results[name] = (time.perf_counter() - started) / iterations * 1e9
+
+    child = HANDLER_SECONDS.labels(handler='bench')
+    started = time.perf_counter()
+    for _ in range(iterations):
+        child.observe(0.01)
+    results['histogram_observe'] = (time.perf_counter() - started) / iterations * 1e9
+
+    print(f"Метрики включены: {ENABLE_METRICS}")
+    for name, ns in results.items():
+        print(f"  {name}: {ns:.0f} нс/вызов")
+    print(f"  Накладные расходы timed_db: {results['timed_db'] - results['plain']:.0f} нс/вызов")
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['bench']:
+        bench()
+    else:
+        print("Использование: python metrics.py bench")
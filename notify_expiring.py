@@ -2,14 +2,26 @@
 """
 Скрипт для отправки уведомлений об истекающих подписках.
 Запускать как крон-задачу каждый день.
+Пользователи получают уведомление от бота своего тенанта (tenants.py),
+админы каждого тенанта - сводку только по его каналу.
 """
+import csv
+import io
 import logging
 import asyncio
-from telegram import Bot
+from telegram import InputFile
 from datetime import datetime, timedelta
 
 import config
 import database as db
+from rate_limiter import create_bot, PRIORITY_BULK
+from leader import run_exclusive
+import tenants
+
+BULK = {'priority': PRIORITY_BULK}
+
+# Запас под заголовок: лимит Telegram - 4096 символов
+MESSAGE_LIMIT = 3900
 
 # Настройка логирования
 logging.basicConfig(
@@ -18,78 +30,155 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-async def notify_expiring_subscriptions():
-    """Уведомить пользователей и админов об истекающих завтра подписках"""
+class AdminDigest:
+    """
+    Сводка для админов, собираемая по одной записи.
+    
+    Пока сводка помещается в DIGEST_MAX_MESSAGES сообщений, она копится кусками
+    по границам записей. Если больше - остаётся только CSV, который отправляется файлом.
+    """
+    
+    def __init__(self, max_messages: int):
+        self.max_messages = max_messages
+        self.count = 0
+        self.chunks = ['']
+        self.overflow = False
+        self._csv_buffer = io.StringIO()
+        self._csv = csv.writer(self._csv_buffer)
+        self._csv.writerow(['telegram_id', 'username', 'first_name', 'end_date'])
+    
+    def add(self, sub: dict):
+        """Добавить подписку в сводку"""
+        self.count += 1
+        self._csv.writerow([sub['telegram_id'], sub['username'] or '', sub['first_name'] or '', sub['end_date']])
+        
+        if self.overflow:
+            return
+        
+        username = f"@{sub['username']}" if sub['username'] else "Нет username"
+        name = sub['first_name'] or "Без имени"
+        end_date = datetime.fromisoformat(sub['end_date']).strftime('%d.%m.%Y %H:%M')
+        record = f"• {name} ({username})\n  Истекает: {end_date}\n\n"
+        
+        if len(self.chunks[-1]) + len(record) > MESSAGE_LIMIT:
+            if len(self.chunks) >= self.max_messages:
+                # Слишком длинно для сообщений - дальше только файл
+                self.overflow = True
+                self.chunks = []
+                return
+            self.chunks.append('')
+        self.chunks[-1] += record
+    
+    def header(self) -> str:
+        return f"""⚠️ УВЕДОМЛЕНИЕ ДЛЯ АДМИНОВ
+
+Подписки, истекающие завтра ({self.count}):
+
+"""
+    
+    def messages(self):
+        """Сообщения сводки (первое - с заголовком)"""
+        return [(self.header() if i == 0 else '') + chunk for i, chunk in enumerate(self.chunks)]
+    
+    def csv_bytes(self) -> bytes:
+        return self._csv_buffer.getvalue().encode('utf-8-sig')
+
+async def send_admin_digest(bot, tenant, digest: AdminDigest):
+    """Отправить сводку всем админам тенанта: сообщениями или одним загруженным файлом"""
+    if not digest.overflow:
+        for admin_id in tenant.admin_ids:
+            try:
+                for text in digest.messages():
+                    await bot.send_message(chat_id=admin_id, text=text, rate_limit_args=BULK)
+                logger.info(f"Уведомление отправлено админу {admin_id}")
+            except Exception as e:
+                logger.error(f"Ошибка отправки уведомления админу {admin_id}: {e}")
+        return
+    
+    # Файл загружаем один раз, остальным админам отправляем по file_id
+    file_id = None
+    caption = digest.header().strip()
+    filename = f"expiring_{(datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')}.csv"
+    
+    for admin_id in tenant.admin_ids:
+        try:
+            if file_id:
+                await bot.send_document(chat_id=admin_id, document=file_id, caption=caption, rate_limit_args=BULK)
+            else:
+                message = await bot.send_document(
+                    chat_id=admin_id,
+                    document=InputFile(digest.csv_bytes(), filename=filename),
+                    caption=caption,
+                    rate_limit_args=BULK
+                )
+                file_id = message.document.file_id
+            logger.info(f"Сводка-файл отправлена админу {admin_id}")
+        except Exception as e:
+            logger.error(f"Ошибка отправки сводки админу {admin_id}: {e}")
+
+async def notify_expiring_subscriptions(lease=None):
+    """
+    Уведомить пользователей и админов об истекающих завтра подписках.
+    lease - аренда leader.py: без неё уведомления прерываются, чтобы не задвоиться.
+    """
     logger.info("Начало проверки истекающих подписок")
     
-    bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
+    bots = {}
     
     # Получаем подписки, истекающие завтра
     tomorrow = datetime.now() + timedelta(days=1)
     tomorrow_end = tomorrow.replace(hour=23, minute=59, second=59)
     tomorrow_start = tomorrow.replace(hour=0, minute=0, second=0)
     
-    with db.get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT s.*, u.username, u.first_name
-            FROM subscriptions s
-            JOIN users u ON s.telegram_id = u.telegram_id
-            WHERE s.status = 'active'
-            AND s.end_date >= ?
-            AND s.end_date <= ?
-        """, (tomorrow_start.isoformat(), tomorrow_end.isoformat()))
-        
-        expiring = cursor.fetchall()
-    
-    logger.info(f"Найдено истекающих завтра подписок: {len(expiring)}")
+    digests = {}
     
-    if not expiring:
-        logger.info("Нет истекающих подписок")
-        return
-    
-    # Уведомляем пользователей
-    for sub in expiring:
+    # Уведомляем пользователей, параллельно собирая сводки для админов тенантов
+    for sub in db.iter_subscriptions_ending_between(tomorrow_start, tomorrow_end):
+        if lease:
+            lease.check()
         telegram_id = sub['telegram_id']
         end_date = datetime.fromisoformat(sub['end_date']).strftime('%d.%m.%Y %H:%M')
         
-        message = config.MESSAGES['subscription_expiring_soon'].format(
+        tenant = tenants.TENANTS.get(sub['tenant_id'])
+        if tenant is None:
+            logger.warning(f"Пропуск подписки {sub['id']}: тенант {sub['tenant_id']} не настроен")
+            continue
+        if tenant.id not in bots:
+            bots[tenant.id] = create_bot(tenant)
+            digests[tenant.id] = AdminDigest(config.DIGEST_MAX_MESSAGES)
+        
+        message = tenant.messages['subscription_expiring_soon'].format(
             expiry_date=end_date
         )
         
         try:
-            await bot.send_message(chat_id=telegram_id, text=message)
+            await bots[tenant.id].send_message(chat_id=telegram_id, text=message, rate_limit_args=BULK)
             logger.info(f"Уведомление отправлено пользователю {telegram_id}")
         except Exception as e:
             logger.error(f"Ошибка отправки уведомления пользователю {telegram_id}: {e}")
+        
+        digests[tenant.id].add(sub)
     
-    # Уведомляем админов
-    admin_message = f"""⚠️ УВЕДОМЛЕНИЕ ДЛЯ АДМИНОВ
-
-Подписки, истекающие завтра ({len(expiring)}):
-
-"""
+    logger.info(f"Найдено истекающих завтра подписок: {sum(d.count for d in digests.values())}")
     
-    for sub in expiring:
-        username = f"@{sub['username']}" if sub['username'] else "Нет username"
-        name = sub['first_name'] or "Без имени"
-        end_date = datetime.fromisoformat(sub['end_date']).strftime('%d.%m.%Y %H:%M')
-        
-        admin_message += f"• {name} ({username})\n  Истекает: {end_date}\n\n"
+    if not digests:
+        logger.info("Нет истекающих подписок")
+        return
     
-    for admin_id in config.ADMIN_IDS:
-        try:
-            await bot.send_message(chat_id=admin_id, text=admin_message)
-            logger.info(f"Уведомление отправлено админу {admin_id}")
-        except Exception as e:
-            logger.error(f"Ошибка отправки уведомления админу {admin_id}: {e}")
+    # Уведомляем админов
+    for tenant_id, digest in digests.items():
+        if lease:
+            lease.check()
+        await send_admin_digest(bots[tenant_id], tenants.get(tenant_id), digest)
     
     logger.info("Уведомления отправлены")
 
 def main():
     """Точка входа"""
     config.validate_config()
-    asyncio.run(notify_expiring_subscriptions())
+    db.init_db()
+    # На нескольких узлах уведомления отправляет один (см. leader.py)
+    asyncio.run(run_exclusive('expiry_notify', notify_expiring_subscriptions))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Профилирование работающего процесса по запросу админа.
+
+- Бот: команда /profile [секунды] [sample|cprofile]
+- webhook_server.py / redirect_server.py: POST /debug/profile?seconds=30 с заголовком
+  Authorization: Bearer <PROFILE_TOKEN> (без PROFILE_TOKEN эндпоинт отключён)
+
+Режимы:
+- sample - поток раз в PROFILE_SAMPLE_INTERVAL_MS снимает стеки всех потоков и пишет
+  их в формате collapsed stacks (*.folded): flamegraph.pl, speedscope, inferno
+- cprofile - cProfile потока event loop бота (*.prof): snakeviz, flameprof
+
+Сессия ограничена по времени (не больше PROFILE_MAX_SECONDS), одновременно - одна на процесс.
+Файлы складываются в PROFILE_DIR.
+
+Обработчики дольше SLOW_HANDLER_MS пишутся в лог с временем wall/CPU (0 - отключено).
+"""
+import asyncio
+import cProfile
+import hmac
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+MODES = ('sample', 'cprofile')
+
+class ProfilerBusy(RuntimeError):
+    """Уже идёт другая сессия профилирования"""
+
+class _Session:
+    """Общая часть сессий: путь к файлу, ожидание завершения"""
+
+    extension = ''
+
+    def __init__(self, seconds: float, name: str):
+        self.seconds = seconds
+        self.started_at = datetime.now()
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        self.path = os.path.join(
+            config.PROFILE_DIR,
+            f"{name}-{self.started_at.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}{self.extension}"
+        )
+        self.finished = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return not self.finished.is_set()
+
+    async def wait(self):
+        """Дождаться окончания сессии из асинхронного кода"""
+        await asyncio.to_thread(self.finished.wait)
+
+class SamplingSession(_Session):
+    """Сэмплирующий профайлер: стеки всех потоков, кроме собственного"""
+
+    extension = '.folded'
+
+    def __init__(self, seconds: float, name: str, interval: float):
+        super().__init__(seconds, name)
+        self.interval = interval
+        self.samples = 0
+        self._stacks = Counter()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        try:
+            while time.monotonic() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    stack.append(names.get(thread_id, str(thread_id)))
+                    self._stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+                time.sleep(self.interval)
+            self._dump()
+        except Exception as e:
+            logger.error(f"Ошибка сэмплирующего профайлера: {e}")
+        finally:
+            self.finished.set()
+
+    def _dump(self):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"Профиль сохранён: {self.path} ({self.samples} сэмплов)")
+
+class CProfileSession(_Session):
+    """cProfile потока event loop (включается и выключается в этом же потоке)"""
+
+    extension = '.prof'
+
+    def __init__(self, seconds: float, name: str):
+        super().__init__(seconds, name)
+        self._profile = cProfile.Profile()
+        self._loop = asyncio.get_running_loop()
+
+    def start(self):
+        self._profile.enable()
+        self._loop.call_later(self.seconds, self._stop)
+
+    def _stop(self):
+        try:
+            self._profile.disable()
+            self._profile.dump_stats(self.path)
+            logger.info(f"Профиль сохранён: {self.path}")
+        except Exception as e:
+            logger.error(f"Ошибка сохранения профиля: {e}")
+        finally:
+            self.finished.set()
+
+_lock = threading.Lock()
+_current: Optional[_Session] = None
+
+def start_profile(mode: str = 'sample', seconds: Optional[float] = None, name: str = 'profile') -> _Session:
+    """Запустить сессию профилирования (cprofile - только из event loop)"""
+    global _current
+    if mode not in MODES:
+        raise ValueError(f"Неизвестный режим профилирования: {mode}")
+    seconds = min(max(1, seconds or config.PROFILE_DEFAULT_SECONDS), config.PROFILE_MAX_SECONDS)
+
+    with _lock:
+        if _current is not None and _current.running:
+            raise ProfilerBusy(f"Профилирование уже идёт: {_current.path}")
+        if mode == 'cprofile':
+            session = CProfileSession(seconds, name)
+        else:
+            session = SamplingSession(seconds, name, config.PROFILE_SAMPLE_INTERVAL_MS / 1000)
+        session.start()
+        _current = session
+
+    logger.info(f"Профилирование запущено ({mode}, {seconds} сек): {session.path}")
+    return session
+
+def report_timing(name: str, wall: float, cpu: float):
+    """Записать в лог обработчик, который работал дольше SLOW_HANDLER_MS"""
+    if config.SLOW_HANDLER_MS and wall * 1000 >= config.SLOW_HANDLER_MS:
+        logger.warning(f"Медленный обработчик {name}: wall {wall * 1000:.0f} мс, CPU {cpu * 1000:.0f} мс")
+
+def init_flask_timing(app):
+    """Лог медленных запросов Flask-приложения"""
+    if not config.SLOW_HANDLER_MS:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        g.profiling_started = (time.perf_counter(), time.thread_time())
+
+    @app.teardown_request
+    def _stop_timer(exc):
+        started = g.pop('profiling_started', None)
+        if started:
+            report_timing(
+                f"{request.method} {request.path}",
+                time.perf_counter() - started[0],
+                time.thread_time() - started[1]
+            )
+
+def flask_profile_response(request, name: str):
+    """Ответ для Flask-маршрута POST /debug/profile (только режим sample)"""
+    # Сравнение за постоянное время: по времени ответа токен не подобрать
+    authorization = request.headers.get('Authorization', '').encode('utf-8')
+    expected = f"Bearer {config.PROFILE_TOKEN}".encode('utf-8')
+    if not config.PROFILE_TOKEN or not hmac.compare_digest(authorization, expected):
+        return {'error': 'Forbidden'}, 403
+    try:
+        seconds = float(request.args.get('seconds', config.PROFILE_DEFAULT_SECONDS))
+    except ValueError:
+        return {'error': 'Invalid seconds'}, 400
+    try:
+        session = start_profile('sample', seconds, name)
+    except ProfilerBusy as e:
+        return {'error': str(e)}, 409
+    return {'status': 'started', 'mode': 'sample', 'seconds': session.seconds, 'path': session.path}, 202
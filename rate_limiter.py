@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Общий для всех процессов лимитер исходящих запросов к Telegram.
+
+bot.py, webhook_server.py, check_subscriptions.py/auto_check.py и notify_expiring.py
+берут токены из одних и тех же token bucket'ов в отдельном SQLite-файле
+(RATE_LIMIT_DB), поэтому всплеск продлений и проверка подписок вместе
+не превышают лимиты Telegram.
+
+- Глобальный бакет: TELEGRAM_RATE_GLOBAL запросов в секунду на все процессы
+- Бакет на чат: TELEGRAM_RATE_PER_CHAT (личные) / TELEGRAM_RATE_PER_GROUP (группы, каналы)
+- Массовые отправки (rate_limit_args={'priority': 'bulk'}) не трогают резерв
+  TELEGRAM_RATE_BULK_RESERVE глобального бакета - он остаётся для транзакционных
+  сообщений (инвайт-ссылки после оплаты и т.п.)
+- При 429 пауза RetryAfter записывается в общий файл и соблюдается всеми процессами
+
+Лимиты Telegram считаются на бота, поэтому у ботов тенантов (tenants.py) свои бакеты:
+ключи с префиксом ID бота. У тенанта 'default' префикса нет - ключи прежние.
+"""
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Coroutine, Dict, Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter, ExtBot
+from telegram.request import HTTPXRequest
+
+import config
+from metrics import observe_external
+import tenants
+import tracing
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_TRANSACTIONAL = 'transactional'
+PRIORITY_BULK = 'bulk'
+
+# Соединений к Bot API у ботов вне Application (у PTB по умолчанию одно - запросы
+# параллельных обработчиков webhook-сервера выстраиваются в очередь к нему)
+CONNECTION_POOL_SIZE = 16
+
+# Служебные методы, которые не расходуют лимит на сообщения
+UNLIMITED_ENDPOINTS = {'getMe', 'getUpdates', 'setWebhook', 'deleteWebhook', 'getWebhookInfo', 'close', 'logOut'}
+
+# Лимит на чат действует только на сообщения; createChatInviteLink, banChatMember и прочие
+# действия с каналом расходуют лишь глобальный бакет
+MESSAGE_ENDPOINT_PREFIXES = ('send', 'copyMessage', 'forwardMessage')
+
+class SharedTokenBuckets:
+    """Token bucket'ы в SQLite-файле, общие для нескольких процессов"""
+
+    def __init__(self, path: str, global_rate: float, chat_rate: float, group_rate: float,
+                 chat_burst: float, bulk_reserve: float, scope: str = ''):
+        self.path = path
+        self.scope = scope
+        self.global_rate = global_rate
+        self.global_capacity = max(1.0, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = max(1.0, chat_burst)
+        self.group_rate = group_rate
+        self.bulk_reserve = bulk_reserve * self.global_capacity
+        self._conn = None
+        self._lock = threading.Lock()
+        self._acquired = 0
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            ''')
+        return self._conn
+
+    def _chat_limits(self, chat_id: int):
+        if chat_id < 0:
+            return self.group_rate, 1.0
+        return self.chat_rate, self.chat_burst
+
+    @staticmethod
+    def _load(conn, key, capacity, rate, now):
+        row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return capacity
+        return min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+
+    def try_acquire(self, chat_id: Optional[int], priority: str) -> float:
+        """Взять токен: 0 - можно отправлять, иначе сколько секунд подождать"""
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                pause = conn.execute('SELECT updated FROM buckets WHERE key = ?', (f'{self.scope}pause',)).fetchone()
+                if pause and pause[0] > now:
+                    conn.execute('COMMIT')
+                    return pause[0] - now
+
+                global_key = f'{self.scope}global'
+                global_tokens = self._load(conn, global_key, self.global_capacity, self.global_rate, now)
+                need = 1.0 + (self.bulk_reserve if priority == PRIORITY_BULK else 0.0)
+                if global_tokens < need:
+                    conn.execute('COMMIT')
+                    return (need - global_tokens) / self.global_rate
+
+                updates = [(global_key, global_tokens - 1.0, now)]
+
+                if chat_id is not None:
+                    rate, capacity = self._chat_limits(chat_id)
+                    key = f'{self.scope}chat:{chat_id}'
+                    chat_tokens = self._load(conn, key, capacity, rate, now)
+                    if chat_tokens < 1.0:
+                        conn.execute('COMMIT')
+                        return (1.0 - chat_tokens) / rate
+                    updates.append((key, chat_tokens - 1.0, now))
+
+                conn.executemany('''
+                    INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated
+                ''', updates)
+
+                # Изредка чистим бакеты давно неактивных чатов
+                self._acquired += 1
+                if self._acquired % 1000 == 0:
+                    conn.execute("DELETE FROM buckets WHERE key LIKE ? AND updated < ?",
+                                 (f'{self.scope}chat:%', now - 300))
+
+                conn.execute('COMMIT')
+                return 0.0
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def pause(self, seconds: float):
+        """Приостановить все процессы на seconds (после 429)"""
+        with self._lock:
+            conn = self._connect()
+            until = time.time() + seconds
+            conn.execute('''
+                INSERT INTO buckets (key, tokens, updated) VALUES (?, 0, ?)
+                ON CONFLICT(key) DO UPDATE SET updated = MAX(updated, excluded.updated)
+            ''', (f'{self.scope}pause', until))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class SharedRateLimiter(BaseRateLimiter[Dict[str, Any]]):
+    """Лимитер для PTB поверх SharedTokenBuckets"""
+
+    def __init__(self, buckets: SharedTokenBuckets, max_retries: int = 2):
+        self.buckets = buckets
+        self.max_retries = max_retries
+
+    async def initialize(self) -> None:
+        """Файл открывается лениво при первом запросе"""
+
+    async def shutdown(self) -> None:
+        self.buckets.close()
+
+    async def _acquire(self, chat_id, priority):
+        while True:
+            # BEGIN IMMEDIATE ждёт другие процессы до 5 сек - не на event loop
+            wait = await asyncio.to_thread(self.buckets.try_acquire, chat_id, priority)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    @staticmethod
+    async def _timed(callback, args, kwargs, endpoint):
+        """Выполнить запрос к Bot API с замером времени (без ожидания лимита)"""
+        started = time.perf_counter()
+        try:
+            result = await callback(*args, **kwargs)
+        except Exception:
+            observe_external('telegram', endpoint, time.perf_counter() - started, error=True)
+            raise
+        observe_external('telegram', endpoint, time.perf_counter() - started)
+        return result
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]]
+    ):
+        """Дождаться токенов и выполнить запрос, при 429 - общая пауза и повтор"""
+        if endpoint in UNLIMITED_ENDPOINTS:
+            return await self._timed(callback, args, kwargs, endpoint)
+
+        priority = (rate_limit_args or {}).get('priority', PRIORITY_TRANSACTIONAL)
+        chat_id = data.get('chat_id') if endpoint.startswith(MESSAGE_ENDPOINT_PREFIXES) else None
+        try:
+            chat_id = int(chat_id) if chat_id is not None else None
+        except (TypeError, ValueError):
+            # @username канала - лимит только глобальный
+            chat_id = None
+
+        for attempt in range(self.max_retries + 1):
+            with tracing.span('telegram.rate_limit_wait'):
+                await self._acquire(chat_id, priority)
+            try:
+                return await self._timed(callback, args, kwargs, endpoint)
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+                logger.warning(f"Лимит Telegram ({endpoint}), пауза {retry_after} сек для всех процессов")
+                await asyncio.to_thread(self.buckets.pause, retry_after)
+                if attempt == self.max_retries:
+                    raise
+
+def create_rate_limiter(scope: str = '') -> SharedRateLimiter:
+    """Лимитер с настройками из config (scope - префикс ключей бота)"""
+    buckets = SharedTokenBuckets(
+        path=config.RATE_LIMIT_DB,
+        global_rate=config.TELEGRAM_RATE_GLOBAL,
+        chat_rate=config.TELEGRAM_RATE_PER_CHAT,
+        group_rate=config.TELEGRAM_RATE_PER_GROUP,
+        chat_burst=config.TELEGRAM_RATE_CHAT_BURST,
+        bulk_reserve=config.TELEGRAM_RATE_BULK_RESERVE,
+        scope=scope
+    )
+    return SharedRateLimiter(buckets)
+
+def tenant_scope(tenant) -> str:
+    """Префикс ключей бакетов бота тенанта"""
+    return '' if tenant.id == tenants.DEFAULT_ID else f'{tenant.bot_id}:'
+
+def create_bot(tenant=None) -> ExtBot:
+    """Бот тенанта (по умолчанию 'default') для webhook-сервера и фоновых скриптов"""
+    tenant = tenant or tenants.get(tenants.DEFAULT_ID)
+    return ExtBot(
+        token=tenant.bot_token,
+        base_url=config.TELEGRAM_API_URL,
+        request=HTTPXRequest(connection_pool_size=CONNECTION_POOL_SIZE),
+        rate_limiter=create_rate_limiter(tenant_scope(tenant))
+    )
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Сверка локальной БД со Stripe: восстанавливает то, что не дошло через webhook
+(например, пока webhook_server.py был недоступен).
+
+Два прохода по спискам Stripe (постранично через starting_after):
+  1. Checkout Sessions за последние RECONCILE_SESSION_DAYS дней с expand подписки:
+     зависшие pending-платежи и оплаченные сессии без локальной подписки.
+  2. Все подписки Stripe: пропущенные продления (invoice.paid) и отмены/неоплата
+     (customer.subscription.*).
+
+Сверка идёт пачками по RECONCILE_CHUNK_SIZE: один SELECT и одна транзакция исправлений
+на пачку, поэтому память не зависит от числа подписок. Исправления вносятся только в БД:
+закончившейся подписке ставится end_date окончания, а предупреждение и удаление из канала
+делает check_subscriptions.py как обычно.
+
+Оба прохода выполняются для аккаунта платформы и каждого аккаунта Stripe Connect
+тенантов (tenants.py). Тенант объекта - metadata.tenant_id, иначе тенант аккаунта.
+
+    python reconcile.py --dry-run
+    python reconcile.py
+"""
+import argparse
+import logging
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import islice
+
+import config
+import database as db
+from stripe_integration import list_all
+import tenants
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Статусы Stripe, при которых webhook_server.py убирает пользователя из канала
+ENDED_STATUSES = ('canceled', 'unpaid', 'past_due', 'incomplete_expired')
+
+class Report:
+    """Счётчики сверки и несколько примеров расхождений"""
+
+    def __init__(self, samples: int):
+        self.counts = Counter()
+        # Созданные первым проходом (их не нужно считать второй раз в dry-run)
+        self.created = set()
+        self.samples = []
+        self.max_samples = samples
+
+    def add(self, kind: str, detail: str):
+        self.counts[kind] += 1
+        if len(self.samples) < self.max_samples:
+            self.samples.append(f"{kind}: {detail}")
+
+def chunks(iterable, size):
+    """Пачки по size элементов из генератора"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _date(timestamp):
+    return datetime.fromtimestamp(timestamp).isoformat()
+
+def _price_id(subscription):
+    items = subscription.get('items', {}).get('data', [])
+    return items[0].get('price', {}).get('id') if items else None
+
+def object_tenant_id(obj, stripe_account):
+    """Тенант объекта Stripe: по метаданным, затем по аккаунту Connect"""
+    tenant_id = (obj.get('metadata') or {}).get('tenant_id')
+    if tenant_id:
+        return tenant_id
+    tenant = tenants.for_account(stripe_account) if stripe_account else None
+    return tenant.id if tenant else tenants.DEFAULT_ID
+
+def subscription_correction(stripe_sub, local, now, telegram_id=None, tenant_id=tenants.DEFAULT_ID):
+    """Исправление локальной подписки по объекту Stripe (None - расхождения нет)"""
+    status = stripe_sub.get('status')
+    period_end = stripe_sub.get('current_period_end')
+
+    if local is None:
+        # Подписки нет в БД: создаём, только если знаем пользователя и она ещё действует
+        telegram_id = telegram_id or stripe_sub.get('metadata', {}).get('telegram_id')
+        if status not in ('active', 'trialing') or not period_end or period_end <= now.timestamp() or not telegram_id:
+            return None
+        return {
+            'kind': 'missing',
+            'id': None,
+            'tenant_id': tenant_id,
+            'telegram_id': int(telegram_id),
+            'stripe_subscription_id': stripe_sub['id'],
+            'stripe_customer_id': stripe_sub.get('customer'),
+            'stripe_price_id': _price_id(stripe_sub),
+            'status': 'active',
+            'start_date': _date(stripe_sub.get('current_period_start') or now.timestamp()),
+            'end_date': _date(period_end),
+        }
+
+    correction = {
+        'id': local['id'],
+        'tenant_id': local['tenant_id'],
+        'telegram_id': local['telegram_id'],
+        'stripe_price_id': local['stripe_price_id'],
+        'old_status': local['status'],
+        'old_end_date': local['end_date'],
+    }
+    lapsed = local['status'] != 'active' or local['end_date'] <= now.isoformat()
+
+    if status in ('active', 'trialing') and period_end and period_end > now.timestamp() and lapsed:
+        # Пропущено продление: Stripe списал оплату, а у нас подписка закончилась
+        return dict(correction, kind='renewal', status='active', end_date=_date(period_end))
+
+    if status in ENDED_STATUSES and not lapsed:
+        # Пропущена отмена: подписка заканчивается сейчас, дальше - обычная проверка истёкших
+        ended_at = stripe_sub.get('ended_at') or stripe_sub.get('canceled_at') or now.timestamp()
+        return dict(correction, kind='ended', status='active', end_date=min(local['end_date'], _date(ended_at)))
+
+    return None
+
+def reconcile_sessions(report, chunk_size, dry_run, now, stripe_account=None):
+    """Проход по недавним Checkout Sessions: платежи и подписки из потерянных checkout.session.completed"""
+    since = int((now - timedelta(days=config.RECONCILE_SESSION_DAYS)).timestamp())
+    sessions = list_all('checkout/sessions', 'list_checkout_sessions',
+                        {'created[gte]': since}, expand=('subscription',), stripe_account=stripe_account)
+
+    for chunk in chunks(sessions, chunk_size):
+        statuses = db.get_payment_statuses([s['id'] for s in chunk])
+        subscription_ids = [s['subscription']['id'] for s in chunk if isinstance(s.get('subscription'), dict)]
+        local_subs = db.get_subscriptions_by_stripe_ids(subscription_ids)
+
+        payments, corrections = [], []
+        for session in chunk:
+            report.counts['sessions'] += 1
+            telegram_id = session.get('metadata', {}).get('telegram_id')
+            tenant_id = object_tenant_id(session, stripe_account)
+            local_status = statuses.get(session['id'])
+
+            if session.get('status') == 'complete' and session.get('payment_status') in ('paid', 'no_payment_required'):
+                target = 'succeeded'
+            elif session.get('status') == 'expired':
+                target = 'expired'
+            else:
+                target = None
+            if target and local_status in (None, 'pending') and (local_status or telegram_id):
+                payments.append({
+                    'stripe_checkout_session_id': session['id'],
+                    'status': target,
+                    'telegram_id': int(telegram_id) if telegram_id and not local_status else None,
+                    'tenant_id': tenant_id,
+                    'stripe_payment_id': session.get('payment_intent'),
+                    'amount': session.get('amount_total'),
+                    'currency': session.get('currency'),
+                })
+                report.add(f"payment_{target}", f"{session['id']} ({local_status or 'нет в БД'})")
+
+            stripe_sub = session.get('subscription')
+            if target == 'succeeded' and isinstance(stripe_sub, dict) and stripe_sub['id'] not in local_subs:
+                correction = subscription_correction(stripe_sub, None, now, telegram_id, tenant_id)
+                if correction:
+                    corrections.append(correction)
+                    report.created.add(stripe_sub['id'])
+                    report.add('missing', f"{stripe_sub['id']} -> {telegram_id}")
+
+        if not dry_run:
+            if payments:
+                report.counts['applied_payments'] += db.set_payment_statuses(payments)
+            if corrections:
+                report.counts['applied_subscriptions'] += db.apply_subscription_corrections(corrections)
+
+def reconcile_subscriptions(report, chunk_size, dry_run, now, stripe_account=None):
+    """Проход по всем подпискам Stripe"""
+    subscriptions = list_all('subscriptions', 'list_subscriptions', {'status': 'all'}, stripe_account=stripe_account)
+
+    for chunk in chunks(subscriptions, chunk_size):
+        local_subs = db.get_subscriptions_by_stripe_ids([s['id'] for s in chunk])
+        corrections = []
+        for stripe_sub in chunk:
+            report.counts['subscriptions'] += 1
+            correction = subscription_correction(stripe_sub, local_subs.get(stripe_sub['id']), now,
+                                                 tenant_id=object_tenant_id(stripe_sub, stripe_account))
+            if correction and stripe_sub['id'] not in report.created:
+                corrections.append(correction)
+                report.add(correction['kind'], f"{stripe_sub['id']} ({stripe_sub.get('status')}) -> "
+                                               f"{correction['status']} до {correction['end_date']}")
+        if corrections and not dry_run:
+            report.counts['applied_subscriptions'] += db.apply_subscription_corrections(corrections)
+
+def run(chunk_size=None, dry_run=False, samples=20):
+    """Полная сверка, вернуть отчёт"""
+    chunk_size = chunk_size or config.RECONCILE_CHUNK_SIZE
+    report = Report(samples)
+    now = datetime.now()
+    started = time.perf_counter()
+
+    # None - аккаунт платформы (тенанты без stripe_account)
+    accounts = sorted({tenant.stripe_account for tenant in tenants.all_tenants()}, key=lambda a: a or '')
+    for stripe_account in accounts:
+        reconcile_sessions(report, chunk_size, dry_run, now, stripe_account)
+        reconcile_subscriptions(report, chunk_size, dry_run, now, stripe_account)
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Сверка{' (dry-run)' if dry_run else ''} за {elapsed:.1f} сек: "
+                f"{', '.join(f'{kind}={count}' for kind, count in sorted(report.counts.items()))}")
+    return report
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Сверка подписок и платежей со Stripe")
+    parser.add_argument('--dry-run', action='store_true', help="Только показать расхождения, ничего не менять")
+    parser.add_argument('--chunk-size', type=int, help="Объектов в пачке (по умолчанию RECONCILE_CHUNK_SIZE)")
+    parser.add_argument('--samples', type=int, default=20, help="Сколько расхождений вывести в отчёт")
+    args = parser.parse_args()
+
+    config.validate_config()
+    db.init_db()
+
+    report = run(args.chunk_size, args.dry_run, args.samples)
+    for line in report.samples:
+        print(line)
+
+if __name__ == '__main__':
+    main()
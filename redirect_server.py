@@ -7,6 +7,9 @@ import logging
 from flask import Flask, redirect, request, render_template_string
 from datetime import datetime
 
+import metrics
+import profiling
+
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
@@ -14,6 +17,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+profiling.init_flask_timing(app)
 
 # Хранилище коротких ссылок -> полных Stripe URL
 # Обновляется при создании checkout session в stripe_integration.py
@@ -32,10 +36,12 @@ def redirect_payment(short_code):
     # Проверяем, есть ли короткий код в базе
     if short_code in SHORT_LINKS:
         full_url = SHORT_LINKS[short_code]
+        metrics.REDIRECT_REQUESTS.labels(result='hit').inc()
         logger.info(f"Редирект: {short_code} -> {full_url[:50]}...")
         return redirect(full_url)
     
     # Если не найден - показываем красивую страницу ошибки
+    metrics.REDIRECT_REQUESTS.labels(result='miss').inc()
     logger.warning(f"Короткий код не найден: {short_code}")
     return render_template_string(ERROR_PAGE), 404
 
@@ -63,6 +69,16 @@ def health():
         'links_count': len(SHORT_LINKS)
     }
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики Prometheus"""
+    return metrics.flask_metrics_response(request)
+
+@app.route('/debug/profile', methods=['POST'])
+def profile_endpoint():
+    """Запустить сэмплирующий профайлер (PROFILE_TOKEN)"""
+    return profiling.flask_profile_response(request, 'redirect')
+
 # Красивая страница ошибки
 ERROR_PAGE = """
 <!DOCTYPE html>
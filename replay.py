@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Воспроизведение событий Stripe из журнала webhook_capture.py через те же обработчики,
+что и в webhook_server.py (разбор инцидентов, восстановление состояния после отката БД).
+
+Режимы:
+    python replay.py --speed 10           # по порядку, в 10 раз быстрее исходного темпа
+    python replay.py --concurrency 16     # как можно быстрее; события одной подписки - по порядку
+    python replay.py --dry-run            # только посчитать отобранные события
+
+Фильтры: --type (можно несколько), --since/--until (дата события), --subscription.
+В отчёте - пропускная способность, задержки и расхождения: события, обработка которых
+закончилась другим HTTP статусом, чем при исходном приёме.
+
+Обработчики пишут в DATABASE_URL и отправляют сообщения через Telegram/Stripe API:
+для разбора инцидентов направляйте TELEGRAM_API_URL и STRIPE_API_URL на заглушки
+(fake_telegram_api.py, fake_stripe_api.py), а DATABASE_URL - на копию БД.
+"""
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Optional
+
+import config
+import tracing
+import webhook_capture
+from bench_stats import percentile
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+def event_subscription(event: Dict) -> Optional[str]:
+    """Stripe Subscription ID, к которому относится событие"""
+    obj = event.get('data', {}).get('object', {})
+    if obj.get('object') == 'subscription':
+        return obj.get('id')
+    subscription = obj.get('subscription')
+    return subscription.get('id') if isinstance(subscription, dict) else subscription
+
+def _timestamp(value: str) -> float:
+    return datetime.fromisoformat(value).timestamp()
+
+def select_events(args):
+    """Генератор (запись журнала, событие) с учётом фильтров"""
+    since = _timestamp(args.since) if args.since else None
+    until = _timestamp(args.until) if args.until else None
+    for record in webhook_capture.read_events(args.paths):
+        try:
+            event = json.loads(record['payload'])
+        except json.JSONDecodeError:
+            logger.warning(f"Пропущено событие с неразборчивым телом (получено {record['received']})")
+            continue
+        created = event.get('created', record['received'])
+        if args.type and event.get('type') not in args.type:
+            continue
+        if since is not None and created < since:
+            continue
+        if until is not None and created >= until:
+            continue
+        if args.subscription and event_subscription(event) != args.subscription:
+            continue
+        yield record, event
+
+class Replay:
+    """Прогон событий и отчёт"""
+
+    def __init__(self, dispatch, samples: int):
+        self.dispatch = dispatch
+        self.max_samples = samples
+        self.lock = threading.Lock()
+        self.by_type = Counter()
+        self.latencies = []
+        self.divergences = 0
+        self.samples = []
+
+    def handle(self, record: Dict, event: Dict):
+        started = time.perf_counter()
+        # Отдельное имя трассы, чтобы воспроизведение не смешивалось с реальными событиями
+        with tracing.start_trace('stripe_replay'):
+            _, status = self.dispatch(record['payload'].encode('utf-8'))
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self.lock:
+            self.by_type[event.get('type')] += 1
+            self.latencies.append(elapsed_ms)
+            if status != record.get('status'):
+                self.divergences += 1
+                if len(self.samples) < self.max_samples:
+                    self.samples.append(f"{event.get('id')} {event.get('type')}: "
+                                        f"было {record.get('status')}, стало {status}")
+
+    def run_paced(self, events, speed: float):
+        """По порядку, паузы между событиями - исходные, делённые на speed"""
+        first_received = started = None
+        for record, event in events:
+            if first_received is None:
+                first_received, started = record['received'], time.perf_counter()
+            delay = (record['received'] - first_received) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+            self.handle(record, event)
+
+    def run_concurrent(self, events, concurrency: int):
+        """Как можно быстрее: события одной подписки - в одном потоке, по порядку"""
+        queues = [queue.Queue(maxsize=1000) for _ in range(concurrency)]
+
+        def worker(q):
+            while True:
+                item = q.get()
+                if item is None:
+                    return
+                try:
+                    self.handle(*item)
+                except Exception as e:
+                    logger.error(f"Ошибка воспроизведения {item[1].get('id')}: {e}")
+
+        threads = [threading.Thread(target=worker, args=(q,), daemon=True) for q in queues]
+        for thread in threads:
+            thread.start()
+        for record, event in events:
+            key = event_subscription(event) or event.get('id')
+            queues[hash(key) % concurrency].put((record, event))
+        for q in queues:
+            q.put(None)
+        for thread in threads:
+            thread.join()
+
+    def report(self, elapsed: float) -> Dict:
+        total = len(self.latencies)
+        return {
+            'events': total,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_eps': round(total / elapsed, 1) if elapsed else 0,
+            'handler_ms_p50': round(percentile(self.latencies, 50), 2),
+            'handler_ms_p95': round(percentile(self.latencies, 95), 2),
+            'handler_ms_p99': round(percentile(self.latencies, 99), 2),
+            'by_type': dict(self.by_type),
+            'divergences': self.divergences,
+            'divergence_samples': self.samples
+        }
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Воспроизведение событий Stripe из журнала")
+    parser.add_argument('paths', nargs='*', help="Файлы или каталоги журнала (по умолчанию WEBHOOK_CAPTURE_DIR)")
+    parser.add_argument('--type', action='append', help="Только события этого типа (можно несколько)")
+    parser.add_argument('--since', help="С даты события (YYYY-MM-DD или ISO)")
+    parser.add_argument('--until', help="До даты события (не включая)")
+    parser.add_argument('--subscription', help="Только события подписки sub_...")
+    parser.add_argument('--speed', type=float, help="По порядку в N раз быстрее исходного темпа")
+    parser.add_argument('--concurrency', type=int, default=8, help="Потоков в режиме максимальной скорости")
+    parser.add_argument('--samples', type=int, default=20, help="Сколько расхождений вывести")
+    parser.add_argument('--dry-run', action='store_true', help="Только посчитать отобранные события")
+    args = parser.parse_args()
+
+    if not args.paths and not config.WEBHOOK_CAPTURE_DIR:
+        parser.error("укажите файлы журнала или WEBHOOK_CAPTURE_DIR")
+    if args.speed is not None and args.speed <= 0:
+        parser.error("--speed должен быть > 0")
+
+    events = select_events(args)
+    if args.dry_run:
+        counts = Counter(event.get('type') for _, event in events)
+        print(json.dumps({'events': sum(counts.values()), 'by_type': dict(counts)}, ensure_ascii=False, indent=2))
+        return
+
+    config.validate_config()
+    # Импорт поднимает бота и loop обработчиков, для --dry-run он не нужен
+    import database as db
+    import webhook_server
+    db.init_db()
+
+    replay = Replay(webhook_server.dispatch_event, args.samples)
+    started = time.perf_counter()
+    if args.speed:
+        replay.run_paced(events, args.speed)
+    else:
+        replay.run_concurrent(events, max(1, args.concurrency))
+    print(json.dumps(replay.report(time.perf_counter() - started), ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Архивация старых строк: истёкшие/отменённые подписки и брошенные платежи
+(pending, failed, expired) старше заданного числа дней переносятся в таблицы
+subscriptions_archive / payments_archive (в той же БД или в RETENTION_ARCHIVE_DB).
+
+Перенос идёт небольшими пачками с паузой между ними, чтобы не держать блокировку
+записи, после чего свободные страницы возвращаются incremental vacuum.
+Запускать кроном раз в сутки:
+    python retention.py [--dry-run]
+"""
+import argparse
+import logging
+import time
+from datetime import datetime, timedelta
+
+import config
+import database as db
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+def policies():
+    """Таблица -> срок хранения в днях (0 - политика отключена)"""
+    return {
+        'subscriptions': config.RETENTION_SUBSCRIPTION_DAYS,
+        'payments': config.RETENTION_PAYMENT_DAYS,
+    }
+
+def archive_table(table, days, batch_size, pause, dry_run=False):
+    """Перенести в архив все подходящие строки table пачками, вернуть их число"""
+    cutoff = datetime.now() - timedelta(days=days)
+    if dry_run:
+        count = db.count_archive_candidates(table, cutoff)
+        logger.info(f"{table}: к архивации {count} строк старше {cutoff:%Y-%m-%d}")
+        return count
+
+    moved = 0
+    started = time.perf_counter()
+    while True:
+        batch = db.archive_batch(table, cutoff, batch_size)
+        moved += batch
+        if batch < batch_size:
+            break
+        time.sleep(pause)
+    logger.info(f"{table}: в архив перенесено {moved} строк старше {cutoff:%Y-%m-%d} "
+                f"за {time.perf_counter() - started:.1f} сек")
+    return moved
+
+def vacuum(pages, pause):
+    """Вернуть свободные страницы файлу БД порциями по pages"""
+    freed = 0
+    while True:
+        result = db.incremental_vacuum(pages)
+        if result is None:
+            logger.warning("auto_vacuum не INCREMENTAL - место не освобождается "
+                           "(один раз: python retention.py --enable-incremental-vacuum)")
+            return 0
+        step, remaining = result
+        freed += step
+        if not remaining or not step:
+            break
+        time.sleep(pause)
+    logger.info(f"Incremental vacuum: освобождено {freed} страниц")
+    return freed
+
+def run(batch_size=None, dry_run=False):
+    """Применить все политики хранения"""
+    batch_size = batch_size or config.RETENTION_BATCH_SIZE
+    pause = config.RETENTION_BATCH_PAUSE_MS / 1000
+    moved = 0
+    for table, days in policies().items():
+        if days:
+            moved += archive_table(table, days, batch_size, pause, dry_run)
+    if moved and not dry_run:
+        vacuum(config.RETENTION_VACUUM_PAGES, pause)
+    return moved
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Архивация старых подписок и платежей")
+    parser.add_argument('--dry-run', action='store_true', help="Только посчитать строки к архивации")
+    parser.add_argument('--batch-size', type=int, help="Строк в пачке (по умолчанию RETENTION_BATCH_SIZE)")
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help="Один раз перевести БД в auto_vacuum = INCREMENTAL (полный VACUUM)")
+    args = parser.parse_args()
+
+    config.validate_config()
+    db.init_db()
+
+    if args.enable_incremental_vacuum:
+        logger.info("Полный VACUUM: БД заблокирована до завершения")
+        db.enable_incremental_vacuum()
+        logger.info("auto_vacuum = INCREMENTAL включён")
+        return
+
+    run(args.batch_size, args.dry_run)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Статистика подписок для админской команды /stats.
+
+Цифры читаются из агрегатных таблиц, которые database.py обновляет
+в тех же транзакциях, что и подписки/платежи, поэтому /stats не сканирует
+subscriptions и payments.
+
+Пересчёт агрегатов с нуля (если они разошлись с данными):
+    python stats.py recompute
+
+Без --tenant статистика выводится по каждому тенанту (tenants.py).
+"""
+import argparse
+import logging
+from datetime import datetime
+
+import database as db
+import tenants
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+DAILY_METRICS = [('new', '🆕'), ('renewed', '🔄'), ('expired', '⌛'), ('cancelled', '❌')]
+
+def format_stats(stats: dict, tenant) -> str:
+    """Текст для /stats (тарифы и MRR - по каталогу тенанта)"""
+    price_to_plan = {info['price_id']: plan for plan, info in tenant.plans.items()}
+
+    lines = ["📊 Estadísticas", "", "💳 Suscripciones activas por plan:"]
+    total_active = 0
+    mrr_cents = 0.0
+    for price_id, count in sorted(stats['plans'].items(), key=lambda item: -item[1]):
+        plan = price_to_plan.get(price_id, price_id or "desconocido")
+        lines.append(f"  • {plan}: {count}")
+        total_active += count
+        if plan in tenant.plans:
+            mrr_cents += count * tenant.plans[plan]['cents'] / tenant.plans[plan]['months']
+    lines.append(f"  Total: {total_active}")
+    lines.append("")
+    lines.append(f"💶 MRR: {mrr_cents / 100:.2f} EUR")
+    lines.append("")
+
+    lines.append("📅 Últimos días (🆕 nuevas / 🔄 renovadas / ⌛ expiradas / ❌ canceladas):")
+    if not stats['daily']:
+        lines.append("  Sin datos")
+    for day, metrics in stats['daily'].items():
+        counts = " / ".join(f"{icon} {metrics.get(metric, 0)}" for metric, icon in DAILY_METRICS)
+        lines.append(f"  {datetime.fromisoformat(day).strftime('%d.%m')}: {counts}")
+    lines.append("")
+
+    lines.append("💰 Ingresos:")
+    if not stats['revenue']:
+        lines.append("  Sin pagos")
+    for row in stats['revenue']:
+        lines.append(f"  • {row['amount'] / 100:.2f} {row['currency'].upper()} ({row['payments_count']} pagos)")
+
+    return "\n".join(lines)
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Статистика подписок")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('show', help="Показать статистику")
+    sub.add_parser('recompute', help="Пересчитать агрегаты из исходных таблиц")
+    parser.add_argument('--tenant', help="Только этот тенант (по умолчанию все)")
+    args = parser.parse_args()
+
+    db.init_db()
+
+    if args.command == 'recompute':
+        db.recompute_stats()
+
+    for tenant in [tenants.get(args.tenant)] if args.tenant else tenants.all_tenants():
+        print(f"[{tenant.id}]")
+        print(format_stats(db.get_stats(tenant_id=tenant.id), tenant))
+        print()
+
+if __name__ == '__main__':
+    main()
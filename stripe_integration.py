@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 import requests
 import logging
-from typing import Dict, Optional
+import time
+from typing import Dict, Iterable, Iterator, Optional
 
 import config
+from metrics import observe_external
 
 try:
     from short_link_generator import create_short_link
@@ -15,23 +17,72 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
-STRIPE_API_BASE = "https://api.stripe.com/v1"
+STRIPE_API_BASE = config.STRIPE_API_URL
 
-def get_headers():
-    """Получить заголовки для запросов к Stripe API"""
-    return {
+def get_headers(stripe_account: Optional[str] = None):
+    """Получить заголовки для запросов к Stripe API (stripe_account - подключённый аккаунт Connect)"""
+    headers = {
         "Authorization": f"Bearer {config.STRIPE_API_KEY}",
         "Content-Type": "application/x-www-form-urlencoded"
     }
+    if stripe_account:
+        headers["Stripe-Account"] = stripe_account
+    return headers
 
-def create_checkout_session(price_id: str, customer_email: str, metadata: Dict) -> Optional[Dict]:
+def stripe_request(method: str, url: str, operation: str, stripe_account: Optional[str] = None,
+                   **kwargs) -> requests.Response:
+    """Запрос к Stripe API с замером времени и учётом ошибок в метриках"""
+    started = time.perf_counter()
+    try:
+        response = requests.request(method, url, headers=get_headers(stripe_account), **kwargs)
+    except Exception:
+        observe_external('stripe', operation, time.perf_counter() - started, error=True)
+        raise
+    observe_external('stripe', operation, time.perf_counter() - started, error=response.status_code >= 400)
+    return response
+
+def list_all(resource: str, operation: str, params: Optional[Dict] = None,
+             expand: Iterable[str] = (), page_size: int = 100, max_retries: int = 5,
+             stripe_account: Optional[str] = None) -> Iterator[Dict]:
+    """
+    Все объекты списка Stripe (GET /v1/<resource>) постранично через starting_after.
+    
+    Генератор: в памяти только текущая страница. 429 и 5xx повторяются с паузой,
+    остальные ошибки - исключение (сверка должна остановиться, а не пропустить хвост списка).
+    """
+    url = f"{STRIPE_API_BASE}/{resource}"
+    params = dict(params or {}, limit=page_size)
+    if expand:
+        params['expand[]'] = [f"data.{field}" for field in expand]
+    
+    while True:
+        for attempt in range(max_retries + 1):
+            response = stripe_request('get', url, operation, stripe_account, params=params, timeout=30)
+            if response.status_code != 429 and response.status_code < 500:
+                break
+            if attempt == max_retries:
+                break
+            time.sleep(float(response.headers.get('Retry-After', 2 ** attempt)))
+        if response.status_code != 200:
+            raise RuntimeError(f"Stripe {resource}: HTTP {response.status_code} {response.text[:200]}")
+        
+        page = response.json()
+        yield from page['data']
+        
+        if not page.get('has_more') or not page['data']:
+            return
+        params['starting_after'] = page['data'][-1]['id']
+
+def create_checkout_session(price_id: str, customer_email: str, metadata: Dict,
+                            stripe_account: Optional[str] = None) -> Optional[Dict]:
     """
     Создать Checkout Session в Stripe
     
     Args:
         price_id: ID цены в Stripe
         customer_email: Email клиента
-        metadata: Метаданные (telegram_id, username, etc)
+        metadata: Метаданные (telegram_id, username, plan, tenant_id)
+        stripe_account: Аккаунт Connect тенанта (None - аккаунт платформы)
     
     Returns:
         Dict с данными сессии или None при ошибке
@@ -49,11 +100,12 @@ def create_checkout_session(price_id: str, customer_email: str, metadata: Dict)
             "cancel_url": config.WEBHOOK_URL.replace('/webhook', '/cancel'),
         }
         
-        # Добавляем метаданные
+        # Добавляем метаданные (копия в подписке - для событий invoice.* и customer.subscription.*)
         for key, value in metadata.items():
             data[f"metadata[{key}]"] = str(value)
+            data[f"subscription_data[metadata][{key}]"] = str(value)
         
-        response = requests.post(url, headers=get_headers(), data=data)
+        response = stripe_request('post', url, 'create_checkout_session', stripe_account, data=data)
         
         if response.status_code == 200:
             session = response.json()
@@ -61,12 +113,8 @@ def create_checkout_session(price_id: str, customer_email: str, metadata: Dict)
             
             # Добавляем короткую ссылку если доступен генератор
             if ENABLE_SHORT_LINKS:
-                plan_map = {
-                    config.STRIPE_PRICES['1_month']: '1m',
-                    config.STRIPE_PRICES['6_months']: '6m',
-                    config.STRIPE_PRICES['12_months']: '12m'
-                }
-                plan_name = plan_map.get(price_id, '')
+                plan_map = {'1_month': '1m', '6_months': '6m', '12_months': '12m'}
+                plan_name = plan_map.get(metadata.get('plan'), '')
                 
                 # Создаём короткую ссылку
                 short_url = create_short_link(session['url'], plan_name)
@@ -94,7 +142,7 @@ def get_price_info(price_id: str) -> Optional[Dict]:
     """
     try:
         url = f"{STRIPE_API_BASE}/prices/{price_id}"
-        response = requests.get(url, headers=get_headers())
+        response = stripe_request('get', url, 'get_price')
         
         if response.status_code == 200:
             price = response.json()
@@ -121,11 +169,11 @@ def get_price_info(price_id: str) -> Optional[Dict]:
         logger.error(f"Исключение при получении цены: {e}")
         return None
 
-def get_subscription(subscription_id: str) -> Optional[Dict]:
+def get_subscription(subscription_id: str, stripe_account: Optional[str] = None) -> Optional[Dict]:
     """Получить информацию о подписке"""
     try:
         url = f"{STRIPE_API_BASE}/subscriptions/{subscription_id}"
-        response = requests.get(url, headers=get_headers())
+        response = stripe_request('get', url, 'get_subscription', stripe_account)
         
         if response.status_code == 200:
             return response.json()
@@ -141,7 +189,7 @@ def cancel_subscription(subscription_id: str) -> bool:
     """Отменить подписку"""
     try:
         url = f"{STRIPE_API_BASE}/subscriptions/{subscription_id}"
-        response = requests.delete(url, headers=get_headers())
+        response = stripe_request('delete', url, 'cancel_subscription')
         
         if response.status_code == 200:
             logger.info(f"Подписка {subscription_id} отменена")
@@ -158,7 +206,7 @@ def get_checkout_session(session_id: str) -> Optional[Dict]:
     """Получить информацию о Checkout Session"""
     try:
         url = f"{STRIPE_API_BASE}/checkout/sessions/{session_id}"
-        response = requests.get(url, headers=get_headers())
+        response = stripe_request('get', url, 'get_checkout_session')
         
         if response.status_code == 200:
             return response.json()
@@ -174,7 +222,7 @@ def get_customer(customer_id: str) -> Optional[Dict]:
     """Получить информацию о клиенте"""
     try:
         url = f"{STRIPE_API_BASE}/customers/{customer_id}"
-        response = requests.get(url, headers=get_headers())
+        response = stripe_request('get', url, 'get_customer')
         
         if response.status_code == 200:
             return response.json()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Несколько ботов-каналов (тенантов) в одной установке: общие процессы, БД и пулы соединений.
+
+Тенант - свой бот (токен), канал, админы, каталог тарифов и тексты. Тенант 'default'
+собирается из переменных окружения (TELEGRAM_BOT_TOKEN, CHANNEL_ID, ADMIN_IDS) и
+каталога в config.py - это прежняя одноканальная установка, её строки в БД имеют
+tenant_id = 'default'. Остальные тенанты описываются в JSON-файле TENANTS_FILE:
+
+    [
+      {
+        "id": "geo",
+        "bot_token": "123456:ABC...",
+        "channel_id": -1001234567890,
+        "admin_ids": [111111111],
+        "stripe_account": "acct_...",
+        "channel_join_link": "https://t.me/+...",
+        "plans": {
+          "1_month": {"price_id": "price_...", "cents": 499, "months": 1, "label": "📅 1 mes - 4.99 EUR"}
+        },
+        "messages": {"welcome": "..."}
+      }
+    ]
+
+plans и messages необязательны: недостающие тарифы и тексты берутся из config.py.
+События Stripe относятся к тенанту по полю account (Stripe Connect, stripe_account
+тенанта) или по metadata.tenant_id, которую бот пишет в Checkout Session и подписку.
+"""
+import json
+import logging
+import re
+from typing import Dict, List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ID = 'default'
+
+class UnknownTenant(Exception):
+    """Событие или строка БД относится к тенанту, которого нет в конфигурации"""
+
+class Tenant:
+    """Бот и канал одного тенанта"""
+
+    def __init__(self, id: str, bot_token: str, channel_id: int, admin_ids: List[int],
+                 plans: Dict[str, Dict], messages: Optional[Dict[str, str]] = None,
+                 stripe_account: Optional[str] = None, channel_join_link: str = ''):
+        self.id = id
+        self.bot_token = bot_token
+        self.channel_id = channel_id
+        self.admin_ids = admin_ids
+        self.plans = plans
+        self.messages = dict(config.MESSAGES, **(messages or {}))
+        self.stripe_account = stripe_account
+        self.channel_join_link = channel_join_link
+
+    def __repr__(self):
+        return f"Tenant({self.id})"
+
+    @property
+    def bot_id(self) -> str:
+        """Числовой ID бота из токена (ключ лимитов Telegram)"""
+        return self.bot_token.split(':', 1)[0]
+
+    @property
+    def stripe_prices(self) -> Dict[str, str]:
+        """{тариф: Price ID}"""
+        return {plan: info['price_id'] for plan, info in self.plans.items()}
+
+    def plan_for_price(self, price_id: str) -> Optional[str]:
+        return next((plan for plan, info in self.plans.items() if info['price_id'] == price_id), None)
+
+    def plan_for_label(self, text: str) -> Optional[str]:
+        """Тариф по тексту кнопки"""
+        return next((plan for plan, info in self.plans.items() if info['label'] == text), None)
+
+    def months_for_price(self, price_id: str) -> int:
+        """Длительность тарифа в месяцах (неизвестный Price ID - 1 месяц)"""
+        plan = self.plan_for_price(price_id)
+        return self.plans[plan]['months'] if plan else 1
+
+def default_plans() -> Dict[str, Dict]:
+    """Каталог тарифов из config.py"""
+    return {
+        plan: {
+            'price_id': price_id,
+            'cents': config.PLAN_PRICES_CENTS[plan],
+            'months': config.PLAN_MONTHS[plan],
+            'label': config.PLAN_LABELS[plan],
+        }
+        for plan, price_id in config.STRIPE_PRICES.items()
+    }
+
+def _from_env() -> Optional[Tenant]:
+    if not config.TELEGRAM_BOT_TOKEN:
+        return None
+    return Tenant(
+        DEFAULT_ID, config.TELEGRAM_BOT_TOKEN, config.CHANNEL_ID, config.ADMIN_IDS, default_plans(),
+        channel_join_link=config.CHANNEL_JOIN_LINK
+    )
+
+def _from_dict(entry: Dict, errors: List[str]) -> Optional[Tenant]:
+    tenant_id = str(entry.get('id', ''))
+    where = f"тенант {tenant_id or '?'}"
+    if not re.fullmatch(r'[A-Za-z0-9_-]{1,32}', tenant_id):
+        errors.append(f"{where}: id - от 1 до 32 символов A-Z a-z 0-9 _ -")
+        return None
+    required = ['bot_token', 'channel_id', 'admin_ids']
+    if config.CHANNEL_ACCESS_MODE == 'join_request':
+        required.append('channel_join_link')
+    missing = [field for field in required if not entry.get(field)]
+    if missing:
+        errors.append(f"{where}: не задан {', '.join(missing)}")
+        return None
+
+    plans = default_plans()
+    for plan, info in (entry.get('plans') or {}).items():
+        merged = dict(plans.get(plan, {}), **info)
+        missing = {'price_id', 'cents', 'months', 'label'} - set(merged)
+        if missing:
+            errors.append(f"{where}: тариф {plan} без {', '.join(sorted(missing))}")
+            continue
+        plans[plan] = merged
+    return Tenant(
+        tenant_id, entry['bot_token'], int(entry['channel_id']), [int(i) for i in entry['admin_ids']],
+        plans, messages=entry.get('messages'), stripe_account=entry.get('stripe_account') or None,
+        channel_join_link=entry.get('channel_join_link', '')
+    )
+
+def load(path: str = None) -> Dict[str, Tenant]:
+    """Тенант из окружения и тенанты из файла path (ValueError при ошибках в файле)"""
+    path = config.TENANTS_FILE if path is None else path
+    registry = {}
+    env_tenant = _from_env()
+    if env_tenant:
+        registry[env_tenant.id] = env_tenant
+    if not path:
+        return registry
+
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)
+    errors = []
+    for entry in entries:
+        tenant = _from_dict(entry, errors)
+        if tenant:
+            registry[tenant.id] = tenant
+    tokens = [tenant.bot_token for tenant in registry.values()]
+    if len(tokens) != len(set(tokens)):
+        errors.append("один bot_token у нескольких тенантов")
+    accounts = [tenant.stripe_account for tenant in registry.values() if tenant.stripe_account]
+    if len(accounts) != len(set(accounts)):
+        errors.append("один stripe_account у нескольких тенантов")
+    if errors:
+        raise ValueError(f"Ошибки {path}:\n" + "\n".join(f"- {e}" for e in errors))
+    logger.info(f"Тенанты: {', '.join(registry)}")
+    return registry
+
+TENANTS = load()
+
+def get(tenant_id: str) -> Tenant:
+    """Тенант по ID (UnknownTenant, если его нет в конфигурации)"""
+    tenant = TENANTS.get(tenant_id or DEFAULT_ID)
+    if tenant is None:
+        raise UnknownTenant(f"тенант {tenant_id} не настроен")
+    return tenant
+
+def all_tenants() -> List[Tenant]:
+    return list(TENANTS.values())
+
+def for_account(stripe_account: Optional[str]) -> Optional[Tenant]:
+    """Тенант по подключённому аккаунту Stripe Connect"""
+    return next((tenant for tenant in TENANTS.values() if tenant.stripe_account == stripe_account), None)
+
+def _event_metadata(obj: Dict) -> Dict:
+    # У инвойса метаданные подписки лежат в subscription_details
+    return obj.get('metadata') or (obj.get('subscription_details') or {}).get('metadata') or {}
+
+def tenant_id_for_event(event: Dict) -> Optional[str]:
+    """
+    tenant_id события Stripe: по аккаунту Connect, затем по metadata.tenant_id.
+    None - по событию не определить (берётся из локальной подписки или 'default').
+    UnknownTenant - событие чужого аккаунта или удалённого из конфигурации тенанта.
+    """
+    account = event.get('account')
+    if account:
+        tenant = for_account(account)
+        if tenant is None:
+            raise UnknownTenant(f"аккаунт Stripe {account} не привязан к тенанту")
+        return tenant.id
+    tenant_id = _event_metadata(event.get('data', {}).get('object', {})).get('tenant_id')
+    if tenant_id and tenant_id not in TENANTS:
+        raise UnknownTenant(f"тенант {tenant_id} не настроен")
+    return tenant_id
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Страницы списка подписок админ-панели: лимит длины сообщения и курсор"""
+import re
+
+import pytest
+
+import bot
+import config
+import database as db
+
+@pytest.fixture
+def subscriptions(monkeypatch):
+    db.configure('sqlite:///:memory:')
+    db.init_db()
+    for i in range(60):
+        # Самые длинные имя и username, которые допускает Telegram
+        db.add_or_update_user(1000 + i, 'u' * 32, 'N' * 64)
+        db.create_subscription(1000 + i, f'cus_{i}', f'sub_{i}', 'price_1', 1)
+    monkeypatch.setattr(config, 'ADMIN_PAGE_SIZE', 50)
+    yield
+    db.configure('sqlite:///:memory:')
+
+def _buttons(markup):
+    return {button.text: button.callback_data for button in markup.inline_keyboard[0]}
+
+def _open(callback_data):
+    """Разбор callback_data как в admin_subscriptions_page"""
+    _, days_key, direction, rest = callback_data.split(':', 3)
+    end_date, sub_id = rest.rsplit(':', 1)
+    return bot.render_subscriptions_page('default', None, direction, (end_date, int(sub_id)))
+
+def _ids(message):
+    return [int(value) for value in re.findall(r'User ID: (\d+)', message)]
+
+def test_pages_fit_limit_without_gaps(subscriptions):
+    message, markup = bot.render_subscriptions_page('default')
+    pages = [_ids(message)]
+    assert len(message) <= bot.MESSAGE_LIMIT
+    # Страница короче ADMIN_PAGE_SIZE, но "Siguiente" ведёт к первой непоказанной записи
+    assert len(pages[0]) < config.ADMIN_PAGE_SIZE
+
+    while 'Siguiente »' in _buttons(markup):
+        message, markup = _open(_buttons(markup)['Siguiente »'])
+        assert len(message) <= bot.MESSAGE_LIMIT
+        pages.append(_ids(message))
+
+    shown = [telegram_id for page in pages for telegram_id in page]
+    assert shown == list(range(1000, 1060))
+
+    # Назад - тоже без пропусков
+    message, markup = _open(_buttons(markup)['« Anterior'])
+    assert len(message) <= bot.MESSAGE_LIMIT
+    assert _ids(message) and _ids(message)[-1] == pages[-1][0] - 1
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Рассылка broadcast.py: один исполнитель на рассылку, незавершённые отправки после падения"""
+import asyncio
+import time
+
+import pytest
+
+import broadcast
+import database as db
+import leader
+
+class _Bot:
+    """Бот, который запоминает получателей"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, rate_limit_args=None):
+        await asyncio.sleep(0.001)
+        self.sent.append(chat_id)
+
+@pytest.fixture
+def broadcast_id():
+    db.configure('sqlite:///:memory:')
+    db.init_db()
+    for telegram_id in range(100, 130):
+        db.add_or_update_user(telegram_id, None, 'User')
+        db.create_subscription(telegram_id, f'cus_{telegram_id}', f'sub_{telegram_id}', 'price_1', 1)
+    yield db.create_broadcast('Hola', created_by=1)
+    db.configure('sqlite:///:memory:')
+
+def _outbox(broadcast_id):
+    with db.get_db() as conn:
+        rows = conn.execute('SELECT status, COUNT(*) AS n FROM broadcast_outbox WHERE broadcast_id = ? GROUP BY status',
+                            (broadcast_id,)).fetchall()
+    return {row['status']: row['n'] for row in rows}
+
+def test_second_runner_does_not_steal_claims(broadcast_id, monkeypatch):
+    released = []
+    release = db.release_stale_broadcast_claims
+    monkeypatch.setattr(db, 'release_stale_broadcast_claims',
+                        lambda *args, **kwargs: released.append(release(*args, **kwargs)) or released[-1])
+    bot = _Bot()
+
+    async def both():
+        # Бот уже ведёт рассылку, админ запускает broadcast.py resume
+        first = asyncio.create_task(broadcast.run_broadcast(bot, broadcast_id, concurrency=4))
+        while len(bot.sent) < 2:
+            await asyncio.sleep(0.001)
+        second = await broadcast.run_broadcast(bot, broadcast_id, concurrency=4)
+        return await first, second
+
+    first, second = asyncio.run(both())
+    assert second['status'] == 'running'
+    # Отправки первого исполнителя не ушли в unknown
+    assert released == [0]
+    assert sorted(bot.sent) == list(range(100, 130))
+    assert _outbox(broadcast_id) == {'sent': 30}
+    assert (first['status'], first['sent']) == ('done', 30)
+
+def test_resume_after_crash_skips_in_flight(broadcast_id):
+    # Упавший процесс успел взять пачку: эти получатели могли уже получить сообщение
+    db.enqueue_broadcast_chunk(broadcast_id, 100)
+    in_flight = db.claim_broadcast_recipients(broadcast_id, 5)
+
+    bot = _Bot()
+    result = asyncio.run(broadcast.run_broadcast(bot, broadcast_id))
+    assert not set(in_flight) & set(bot.sent)
+    assert _outbox(broadcast_id) == {'sent': 25, 'unknown': 5}
+    assert result['status'] == 'done'
+
+def test_runner_without_lease_is_fenced(broadcast_id):
+    db.enqueue_broadcast_chunk(broadcast_id, 100)
+    other = leader.Lease(f'broadcast:{broadcast_id}', 60, 'other-node')
+    assert other.acquire()
+    claimed = db.claim_broadcast_recipients(broadcast_id, 5, fence=other.fence)
+
+    # Пока аренду держит другой процесс, запуск ничего не трогает
+    bot = _Bot()
+    result = asyncio.run(broadcast.run_broadcast(bot, broadcast_id))
+    assert bot.sent == [] and result['status'] == 'running'
+    assert _outbox(broadcast_id) == {'pending': 25, 'sending': 5}
+
+    # Аренда перешла к другому держателю - старый токен не берёт новых получателей
+    stale_fence = other.fence
+    other.release()
+    time.sleep(0.002)
+    assert leader.Lease(f'broadcast:{broadcast_id}', 60, 'node-b').acquire()
+    with pytest.raises(db.LeaseLost):
+        db.claim_broadcast_recipients(broadcast_id, 5, fence=stale_fence)
+    assert len(claimed) == 5
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Шина инвалидации cache_bus.py: публикация и опрос разными процессами через один файл"""
+import pytest
+
+from cache_bus import CacheBus
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'cache_bus.db')
+
+def _listen(bus, entity):
+    received = []
+    bus.subscribe(entity, lambda key, version: received.append((key, version)))
+    return received
+
+def test_delivery_between_processes(path):
+    publisher, subscriber = CacheBus(path, 60), CacheBus(path, 60)
+    received = _listen(subscriber, 'subscription')
+    # Первый опрос только запоминает позицию в журнале
+    publisher.publish('subscription', 1, 1.0)
+    assert subscriber.poll() == 0
+
+    publisher.publish('subscription', 2, 2.0)
+    publisher.publish('user', 3, 3.0)
+    assert subscriber.poll() == 2
+    assert received == [('2', 2.0)]
+    # Без новых коммитов data_version не меняется - повторный опрос пуст
+    assert subscriber.poll() == 0
+
+def test_own_messages_delivered(path):
+    bus = CacheBus(path, 60)
+    received = _listen(bus, 'user')
+    bus.poll()
+    bus.publish('user', 7, 1.0)
+    assert bus.poll() == 1
+    assert received == [('7', 1.0)]
+
+def test_lagging_subscriber_resets_caches(path):
+    publisher, subscriber = CacheBus(path, 0), CacheBus(path, 60)
+    received = _listen(subscriber, 'subscription')
+    publisher.publish('subscription', 0)
+    subscriber.poll()
+
+    # Каждая 500-я публикация чистит журнал: при нулевом сроке хранения остаётся только она
+    for key in range(1, 501):
+        publisher.publish('subscription', key)
+    subscriber.poll()
+    assert received == [(None, None)]
+
+    publisher.publish('subscription', 501, 5.0)
+    subscriber.poll()
+    assert received[-1] == ('501', 5.0)
+
+def test_disabled_bus(path):
+    bus = CacheBus('', 60)
+    bus.publish('user', 1)
+    assert bus.poll() == 0
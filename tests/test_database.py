@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Основные функции database.py на SQLite в памяти и, если задан TEST_DATABASE_URL, на PostgreSQL
+"""
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import database as db
+
+POSTGRES_URL = os.getenv('TEST_DATABASE_URL', '')
+
+@pytest.fixture(params=[
+    pytest.param('sqlite:///:memory:', id='sqlite'),
+    pytest.param(POSTGRES_URL, id='postgresql',
+                 marks=pytest.mark.skipif(not POSTGRES_URL, reason="TEST_DATABASE_URL не задан")),
+])
+def store(request):
+    backend = db.configure(request.param)
+    if backend.name == 'postgresql':
+        with db.get_db() as conn:
+            conn.execute('DROP SCHEMA public CASCADE')
+            conn.execute('CREATE SCHEMA public')
+    db.init_db()
+    yield backend
+    db.configure('sqlite:///:memory:')
+
+def _active(stats):
+    return sum(stats['plans'].values())
+
+def test_init_db_idempotent(store):
+    db.init_db()
+    assert db.get_stats() == {'plans': {}, 'daily': {}, 'revenue': []}
+
+def test_subscription_lifecycle(store):
+    db.add_or_update_user(1, 'user1', 'User')
+    db.add_or_update_user(1, 'renamed', 'User')
+    assert db.get_user_by_telegram_id(1)['username'] == 'renamed'
+
+    db.create_subscription(1, 'cus_1', 'sub_1', 'price_1', 1)
+    subscription = db.get_active_subscription(1)
+    assert subscription['stripe_subscription_id'] == 'sub_1'
+
+    # Продление активной подписки сдвигает end_date, новой строки нет
+    db.renew_or_create_subscription(1, 'cus_1', 'sub_1', 'price_1', 1)
+    renewed = db.get_active_subscription(1)
+    assert renewed['id'] == subscription['id'] and renewed['end_date'] > subscription['end_date']
+    db.extend_subscription('sub_1', 1)
+    assert db.get_subscription_by_stripe_id('sub_1')['end_date'] > renewed['end_date']
+
+    assert db.get_known_telegram_ids() == [1]
+    assert list(db.get_active_subscriber_end_dates()) == [1]
+    rows, has_more = db.get_active_subscriptions_page(10)
+    assert [row['telegram_id'] for row in rows] == [1] and not has_more
+    now = datetime.now()
+    assert len(list(db.iter_subscriptions_ending_between(now, now + timedelta(days=400)))) == 1
+    assert db.get_subscriptions_by_stripe_ids(['sub_1', 'sub_x']).keys() == {'sub_1'}
+
+    assert _active(db.get_stats()) == 1
+    # Тенанты не видят подписки друг друга
+    assert db.get_active_subscription(1, 'other') is None
+    assert _active(db.get_stats(tenant_id='other')) == 0
+
+    db.update_subscription_status('sub_1', 'cancelled')
+    assert db.get_active_subscription(1) is None
+    stats = db.get_stats()
+    assert _active(stats) == 0
+    assert stats['daily'][now.date().isoformat()]['cancelled'] == 1
+
+def test_expire_and_recompute(store):
+    db.add_or_update_user(2, 'user2', 'User')
+    # Подписка на 0 месяцев истекает сразу
+    db.create_subscription(2, 'cus_2', 'sub_2', 'price_1', 0)
+    expired = db.get_expired_subscriptions()
+    assert [row['telegram_id'] for row in expired] == [2]
+    assert db.expire_subscriptions([row['id'] for row in expired]) == 1
+    assert db.expire_subscriptions([row['id'] for row in expired]) == 0
+
+    before = db.get_stats(days=60)
+    db.recompute_stats()
+    after = db.get_stats(days=60)
+    assert after['plans'] == before['plans']
+    assert after['revenue'] == before['revenue']
+    assert sum(day.get('expired', 0) for day in after['daily'].values()) == 1
+
+def _correction(telegram_id, status, start_days_ago, end_days_ago, **extra):
+    now = datetime.now()
+    return dict({
+        'id': None, 'tenant_id': 'default', 'telegram_id': telegram_id,
+        'stripe_subscription_id': f'sub_{telegram_id}', 'stripe_customer_id': f'cus_{telegram_id}',
+        'stripe_price_id': 'price_1', 'status': status,
+        'start_date': (now - timedelta(days=start_days_ago)).isoformat(),
+        'end_date': (now - timedelta(days=end_days_ago)).isoformat(),
+    }, **extra)
+
+def test_stats_match_recompute_after_corrections(store):
+    for telegram_id in range(20, 27):
+        db.add_or_update_user(telegram_id, None, 'User')
+    db.create_subscription(20, 'cus_20', 'sub_20', 'price_1', 1)
+    # Сверка досоздаёт пропущенные webhook'ом подписки задним числом
+    db.apply_subscription_corrections([
+        _correction(21, 'active', 40, -10),
+        _correction(22, 'expired', 70, 40),
+        _correction(23, 'cancelled', 50, -5),
+        _correction(24, 'active', 35, 3),
+        _correction(25, 'active', 20, -20),
+    ])
+    # Проверка подписок истекает 24-ю, сверка - 25-ю (закончилась в Stripe 2 дня назад)
+    db.expire_subscriptions([db.get_subscription_by_stripe_id('sub_24')['id']])
+    local = db.get_subscription_by_stripe_id('sub_25')
+    db.apply_subscription_corrections([dict(
+        _correction(25, 'expired', 20, 2), id=local['id'], old_status='active', old_end_date=local['end_date'])])
+    db.update_subscription_status('sub_21', 'cancelled')
+    db.update_subscription_status('sub_21', 'cancelled')
+
+    live = db.get_stats(days=120)
+    today = datetime.now().date()
+    assert live['daily'][(today - timedelta(days=40)).isoformat()] == {'new': 1, 'expired': 1}
+    assert live['daily'][today.isoformat()] == {'new': 1, 'cancelled': 2}
+
+    db.recompute_stats()
+    assert db.get_stats(days=120) == live
+
+def test_payments(store):
+    assert db.record_payment_pending(3, 'cs_3', 499, 'eur')
+    assert not db.record_payment_pending(3, 'cs_3', 499, 'eur')
+    assert db.get_subscription_by_checkout_session('cs_3') == 3
+
+    assert db.set_payment_status('cs_3', 'succeeded', stripe_payment_id='pi_3')
+    assert not db.set_payment_status('cs_3', 'succeeded', stripe_payment_id='pi_3')
+    # Тот же payment intent у другой сессии - IntegrityError гасится, транзакция откатывается
+    assert db.record_payment_pending(3, 'cs_4', 499, 'eur')
+    assert not db.set_payment_status('cs_4', 'succeeded', stripe_payment_id='pi_3')
+    assert db.get_payment_statuses(['cs_3', 'cs_4']) == {'cs_3': 'succeeded', 'cs_4': 'pending'}
+
+    # Сверка создаёт строку, которой нет (pending не записался)
+    assert db.set_payment_statuses([
+        {'stripe_checkout_session_id': 'cs_4', 'status': 'expired'},
+        {'stripe_checkout_session_id': 'cs_5', 'status': 'succeeded', 'telegram_id': 3,
+         'stripe_payment_id': 'pi_5', 'amount': 2499, 'currency': 'EUR'},
+    ]) == 2
+    assert db.get_stats()['revenue'] == [{'currency': 'eur', 'amount': 2998, 'payments_count': 2}]
+
+def test_payment_upsert_keeps_amount(store):
+    assert db.record_payment_pending(3, 'cs_6', 2499, 'usd')
+    # Событие без суммы (сверка) не затирает сумму и валюту pending-строки
+    assert db.set_payment_status('cs_6', 'succeeded', telegram_id=3, stripe_payment_id='pi_6')
+    assert db.get_stats()['revenue'] == [{'currency': 'usd', 'amount': 2499, 'payments_count': 1}]
+
+_LEGACY_SCHEMA = [
+    '''CREATE TABLE users (
+        telegram_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    '''CREATE TABLE subscriptions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, telegram_id INTEGER NOT NULL, stripe_customer_id TEXT,
+        stripe_subscription_id TEXT, stripe_price_id TEXT, status TEXT NOT NULL,
+        start_date TIMESTAMP NOT NULL, end_date TIMESTAMP NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (telegram_id) REFERENCES users (telegram_id))''',
+    '''CREATE TABLE payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, telegram_id INTEGER NOT NULL,
+        stripe_payment_id TEXT UNIQUE, stripe_checkout_session_id TEXT UNIQUE,
+        amount INTEGER NOT NULL, currency TEXT NOT NULL, status TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (telegram_id) REFERENCES users (telegram_id))''',
+    '''CREATE TABLE invite_links (
+        invite_link TEXT PRIMARY KEY, telegram_id INTEGER NOT NULL, expire_date TIMESTAMP NOT NULL,
+        status TEXT NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    # Колонка, добавленная ALTER TABLE прежней миграцией: внешний ключ остался на users (telegram_id)
+    "ALTER TABLE subscriptions ADD COLUMN tenant_id TEXT NOT NULL DEFAULT 'default'",
+]
+
+def test_upgrade_from_single_tenant_schema(store):
+    with db.get_db() as conn:
+        if store.name == 'postgresql':
+            conn.execute('DROP SCHEMA public CASCADE')
+            conn.execute('CREATE SCHEMA public')
+        else:
+            tables = [row['name'] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'sqlite_sequence'")]
+            for table in tables:
+                conn.execute(f'DROP TABLE {table}')
+        for ddl in _LEGACY_SCHEMA:
+            conn.execute(ddl)
+        now = datetime.now()
+        conn.execute("INSERT INTO users (telegram_id, first_name) VALUES (1, 'User')")
+        subscription_id = store.insert_id(
+            conn.cursor(), "INSERT INTO subscriptions (telegram_id, status, start_date, end_date) VALUES (1, 'active', ?, ?)",
+            (now.isoformat(), (now + timedelta(days=30)).isoformat()))
+        payment_id = store.insert_id(
+            conn.cursor(), "INSERT INTO payments (telegram_id, stripe_checkout_session_id, amount, currency, status) "
+                           "VALUES (1, 'cs_1', 999, 'eur', 'pending')", ())
+        conn.execute("INSERT INTO invite_links (invite_link, telegram_id, expire_date, status) VALUES (?, 1, ?, 'active')",
+                     ('https://t.me/+old', (now + timedelta(hours=1)).isoformat()))
+
+    db.init_db()
+    db.init_db()
+
+    with db.get_db() as conn:
+        cursor = conn.cursor()
+        for table in ('subscriptions', 'payments'):
+            assert store.foreign_keys(cursor, table) in ([], [['tenant_id', 'telegram_id']])
+        assert store.primary_key(cursor, 'invite_links') == ['tenant_id', 'invite_link']
+        if store.name == 'sqlite':
+            # Внешние ключи ссылаются на существующий ключ users: без "foreign key mismatch"
+            conn.execute('PRAGMA foreign_keys = ON')
+            assert conn.execute('PRAGMA foreign_key_check').fetchall() == []
+            conn.execute("UPDATE subscriptions SET status = 'active' WHERE id = ?", (subscription_id,))
+            conn.execute('PRAGMA foreign_keys = OFF')
+
+    assert db.get_active_subscription(1)['id'] == subscription_id
+    assert db.mark_invite_link_used('https://t.me/+old')
+    # Новые строки получают id после перенесённых
+    assert db.create_subscription(1, 'cus_1', 'sub_1', 'price_1', 1) > subscription_id
+    assert db.record_payment_pending(1, 'cs_2', 999, 'eur')
+    with db.get_db() as conn:
+        assert conn.execute("SELECT id FROM payments WHERE stripe_checkout_session_id = 'cs_2'").fetchone()['id'] > payment_id
+
+def test_invite_links_and_members(store):
+    expire = datetime.now() + timedelta(hours=1)
+    db.save_invite_link(4, 'https://t.me/+a', expire)
+    db.save_invite_link(4, 'https://t.me/+b', expire)
+    assert db.get_active_invite_link(4, datetime.now())['invite_link'] == 'https://t.me/+b'
+    assert [row['invite_link'] for row in db.get_superseded_invite_links()] == ['https://t.me/+a']
+    db.mark_invite_links_revoked(['https://t.me/+a'])
+    assert db.mark_invite_link_used('https://t.me/+b')
+    assert db.get_active_invite_link(4, datetime.now()) is None
+
+    assert db.is_channel_member(4) is None
+    db.set_channel_member_statuses([(4, 'member', True), (5, 'left', False)])
+    db.set_channel_member_status(5, 'member', True)
+    assert db.is_channel_member(4) and db.is_channel_member(5)
+
+def test_broadcast(store):
+    for telegram_id in (6, 7):
+        db.add_or_update_user(telegram_id, None, 'User')
+        db.create_subscription(telegram_id, f'cus_{telegram_id}', f'sub_{telegram_id}', 'price_1', 1)
+    db.mark_user_blocked(7)
+
+    broadcast_id = db.create_broadcast('Hola', created_by=1)
+    assert [row['id'] for row in db.get_running_broadcasts()] == [broadcast_id]
+    assert db.enqueue_broadcast_chunk(broadcast_id, 100) == 1
+    assert db.enqueue_broadcast_chunk(broadcast_id, 100) == 0
+    assert db.claim_broadcast_recipients(broadcast_id, 10) == [6]
+    db.record_broadcast_results(broadcast_id, [(6, 'sent', None)])
+    assert db.release_stale_broadcast_claims(broadcast_id) == 0
+    assert db.set_broadcast_status(broadcast_id, 'done')
+    broadcast = db.get_broadcast(broadcast_id)
+    assert (broadcast['status'], broadcast['total'], broadcast['sent']) == ('done', 1, 1)
+
+def test_leases(store):
+    token = db.acquire_lease('job', 'a', 60)
+    assert token == 1
+    assert db.acquire_lease('job', 'b', 60) is None
+    assert db.renew_lease('job', 'a', token, 60)
+    db.release_lease('job', 'a', token)
+    # Отпущенная аренда свободна со следующей миллисекунды
+    time.sleep(0.002)
+    assert db.acquire_lease('job', 'b', 60) == 2
+    assert not db.renew_lease('job', 'a', token, 60)
+    with pytest.raises(db.LeaseLost):
+        db.expire_subscriptions([1], fence=('job', token))
+    assert [lease['holder'] for lease in db.get_leases()] == ['b']
+
+def test_archive(store):
+    db.add_or_update_user(8, None, 'User')
+    db.expire_subscriptions([db.create_subscription(8, 'cus_8', 'sub_8', 'price_1', 0)])
+
+    cutoff = datetime.now() + timedelta(days=1)
+    assert db.count_archive_candidates('subscriptions', cutoff) == 1
+    assert db.archive_batch('subscriptions', cutoff, 10) == 1
+    assert db.archive_batch('subscriptions', cutoff, 10) == 0
+    assert db.get_subscription_by_stripe_id('sub_8') is None
+
+    # Архивные подписки остаются в истории статистики
+    db.recompute_stats()
+    daily = db.get_stats()['daily']
+    assert daily[datetime.now().date().isoformat()]['new'] == 1
+    if store.name == 'postgresql':
+        assert db.incremental_vacuum(10) == (0, 0)
+
+def test_archive_same_day_cutoff(store):
+    # Граница в тот же день, что и даты строк: сравнение не зависит от разделителя даты и времени
+    db.add_or_update_user(9, None, 'User')
+    db.expire_subscriptions([db.create_subscription(9, 'cus_9', 'sub_9', 'price_1', 0)])
+    assert db.record_payment_pending(9, 'cs_9', 2499, 'eur')
+
+    cutoff = datetime.now() + timedelta(minutes=1)
+    assert db.count_archive_candidates('subscriptions', cutoff) == 1
+    assert db.count_archive_candidates('payments', cutoff) == 1
+    assert db.archive_batch('subscriptions', cutoff, 10) == 1
+    assert db.archive_batch('payments', cutoff, 10) == 1
+
+    # Строки новее границы остаются
+    db.expire_subscriptions([db.create_subscription(9, 'cus_9', 'sub_10', 'price_1', 0)])
+    assert db.count_archive_candidates('subscriptions', datetime.now() - timedelta(minutes=1)) == 0
+    assert db.count_archive_candidates('payments', datetime.now() - timedelta(minutes=1)) == 0
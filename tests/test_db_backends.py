@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Перевод SQL диалекта SQLite в PostgreSQL (db_backends.translate) на запросах database.py"""
+import re
+from datetime import datetime, timedelta
+
+import pytest
+
+import database as db
+from db_backends import translate
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+class _RecordingCursor:
+    """Курсор SQLite, запоминающий текст выполненных запросов"""
+
+    def __init__(self, cursor, log):
+        self._cursor = cursor
+        self._log = log
+
+    def execute(self, sql, params=()):
+        self._log.append(sql)
+        self._cursor.execute(sql, params)
+        return self
+
+    def executemany(self, sql, params_seq):
+        self._log.append(sql)
+        self._cursor.executemany(sql, params_seq)
+        return self
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class _RecordingConnection:
+    def __init__(self, conn, log):
+        self._conn = conn
+        self._log = log
+
+    def cursor(self):
+        return _RecordingCursor(self._conn.cursor(), self._log)
+
+    def execute(self, sql, params=()):
+        self._log.append(sql)
+        return self._conn.execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+@pytest.fixture(scope='module')
+def statements():
+    """SQL, который выполняют init_db и основные функции database.py"""
+    backend = db.configure('sqlite:///:memory:')
+    log = []
+    connect = backend.connect
+    backend.connect = lambda: _RecordingConnection(connect(), log)
+    try:
+        db.init_db()
+        db.add_or_update_user(1, 'user', 'User')
+        db.create_subscription(1, 'cus_1', 'sub_1', 'price_1', 1)
+        db.renew_or_create_subscription(1, 'cus_1', 'sub_1', 'price_1', 1)
+        db.get_active_subscriptions_page(10)
+        db.record_payment_pending(1, 'cs_1', 499, 'eur')
+        db.set_payment_status('cs_1', 'succeeded', stripe_payment_id='pi_1')
+        db.expire_subscriptions([1])
+        db.get_stats()
+        db.recompute_stats()
+        db.acquire_lease('job', 'host:1', 60)
+        db.count_archive_candidates('subscriptions', datetime.now() + timedelta(days=400))
+        db.archive_batch('subscriptions', datetime.now() + timedelta(days=400), 10)
+        db.recompute_stats()
+    finally:
+        db.configure('sqlite:///:memory:')
+    # PRAGMA и ATTACH есть только в ветках SQLite
+    return [sql for sql in dict.fromkeys(log) if not re.match(r'\s*(PRAGMA|ATTACH)', sql, re.IGNORECASE)]
+
+def _code(sql):
+    """SQL без строковых литералов"""
+    return _LITERAL.sub("''", sql)
+
+def test_statements_captured(statements):
+    assert any('CREATE TABLE IF NOT EXISTS subscriptions' in sql for sql in statements)
+    assert any('stats_revenue' in sql and 'INSERT' in sql for sql in statements)
+    assert any('_archive' in sql for sql in statements)
+
+def test_placeholders_translated(statements):
+    for sql in statements:
+        original, translated = _code(sql), _code(translate(sql))
+        assert '?' not in translated, sql
+        assert not re.search(r'(?<![:\w]):[A-Za-z_]', translated), sql
+        assert translated.count('%s') == original.count('?'), sql
+        # Кроме плейсхолдеров psycopg2 знаков % не остаётся
+        assert not re.search(r'%(?![s(%])', translated.replace('%%', '')), sql
+
+def test_ddl_types_translated(statements):
+    ddl = [translate(sql) for sql in statements if re.match(r'\s*CREATE\s+TABLE', sql)]
+    assert ddl
+    for sql in ddl:
+        assert not re.search(r'\bINTEGER\b', sql), sql
+        assert not re.search(r'\bTIMESTAMP\b', sql), sql
+        assert 'AUTOINCREMENT' not in sql
+        assert 'FOREIGN KEY' not in sql
+
+def test_current_timestamp_replaced(statements):
+    for sql in statements:
+        assert 'CURRENT_TIMESTAMP' not in translate(sql), sql
+
+def test_translate_examples():
+    assert translate("SELECT * FROM t WHERE a LIKE 'x%' AND b = ?") == \
+        "SELECT * FROM t WHERE a LIKE 'x%%' AND b = %s"
+    assert translate('SELECT id FROM t WHERE d < :cutoff LIMIT :limit') == \
+        'SELECT id FROM t WHERE d < %(cutoff)s LIMIT %(limit)s'
+    assert translate('SELECT x::text FROM t') == 'SELECT x::text FROM t'
+
+    ddl = translate('''
+        CREATE TABLE IF NOT EXISTS p (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (telegram_id) REFERENCES users (telegram_id)
+        )
+    ''')
+    assert 'id BIGSERIAL PRIMARY KEY' in ddl
+    assert 'telegram_id BIGINT NOT NULL' in ddl
+    assert "created_at TEXT DEFAULT to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')" in ddl
+    assert 'FOREIGN KEY' not in ddl and ddl.rstrip().endswith(')')
+
+    # Вне DDL типы не трогаются
+    assert translate('SELECT CAST(x AS INTEGER) FROM t') == 'SELECT CAST(x AS INTEGER) FROM t'
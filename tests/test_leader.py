@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Аренды leader.py: один держатель, fencing-токен отсекает бывшего ведущего"""
+import asyncio
+import time
+
+import pytest
+
+import database as db
+import leader
+
+@pytest.fixture(autouse=True)
+def store():
+    db.configure('sqlite:///:memory:')
+    db.init_db()
+    yield
+    db.configure('sqlite:///:memory:')
+
+def test_single_holder():
+    first, second = leader.Lease('sweep', 60, 'node-a'), leader.Lease('sweep', 60, 'node-b')
+    assert first.acquire()
+    assert not second.acquire()
+    assert first.renew()
+    first.check()
+
+    first.release()
+    time.sleep(0.002)
+    assert second.acquire()
+    assert second.token == 2
+
+def test_stale_leader_fenced_off():
+    db.add_or_update_user(1, None, 'User')
+    db.create_subscription(1, 'cus_1', 'sub_1', 'price_1', 1)
+    subscription_id = db.get_subscription_by_stripe_id('sub_1')['id']
+
+    stale = leader.Lease('sweep', 0.05, 'node-a')
+    assert stale.acquire()
+    # Ведущий «завис» дольше срока аренды, её забрал другой узел
+    time.sleep(0.06)
+    with pytest.raises(leader.LeaseLost):
+        stale.check()
+    current = leader.Lease('sweep', 60, 'node-b')
+    assert current.acquire()
+    assert current.token > stale.token
+
+    assert not stale.renew()
+    with pytest.raises(leader.LeaseLost):
+        db.expire_subscriptions([subscription_id], fence=stale.fence)
+    assert db.get_subscription_by_stripe_id('sub_1')['status'] == 'active'
+
+    assert db.expire_subscriptions([subscription_id], fence=current.fence) == 1
+
+def test_run_exclusive_skips_and_holds_cooldown():
+    calls = []
+
+    async def job(lease):
+        lease.check()
+        calls.append(lease.token)
+        # Пока задача идёт, второй запуск пропускается
+        assert await leader.run_exclusive('digest', job) is None
+        return 'done'
+
+    assert asyncio.run(leader.run_exclusive('digest', job, cooldown=60)) == 'done'
+    assert calls == [1]
+    # Аренда придержана на cooldown - крон другого узла не повторит работу
+    assert asyncio.run(leader.run_exclusive('digest', job)) is None
+    assert calls == [1]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""Доступ к /metrics по METRICS_TOKEN"""
+from types import SimpleNamespace
+
+import pytest
+
+import config
+import metrics
+
+def _request(authorization=None):
+    headers = {} if authorization is None else {'Authorization': authorization}
+    return SimpleNamespace(headers=headers)
+
+@pytest.mark.parametrize('authorization', [None, '', 'Bearer wrong', 'secret', 'Bearer secretx', 'Bearer сekret'])
+def test_wrong_token_forbidden(monkeypatch, authorization):
+    monkeypatch.setattr(config, 'METRICS_TOKEN', 'secret')
+    assert metrics.flask_metrics_response(_request(authorization))[1] == 403
+
+def test_token_accepted(monkeypatch):
+    monkeypatch.setattr(config, 'METRICS_TOKEN', 'secret')
+    assert metrics.flask_metrics_response(_request('Bearer secret'))[1] != 403
+    monkeypatch.setattr(config, 'METRICS_TOKEN', '')
+    assert metrics.flask_metrics_response(_request())[1] != 403
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""Доступ к POST /debug/profile по PROFILE_TOKEN"""
+from types import SimpleNamespace
+
+import pytest
+
+import config
+import profiling
+
+def _request(authorization=None, seconds='abc'):
+    headers = {} if authorization is None else {'Authorization': authorization}
+    return SimpleNamespace(headers=headers, args={'seconds': seconds})
+
+@pytest.mark.parametrize('authorization', [None, 'Bearer wrong', 'Bearer secretx', 'Bearer сekret'])
+def test_wrong_token_forbidden(monkeypatch, authorization):
+    monkeypatch.setattr(config, 'PROFILE_TOKEN', 'secret')
+    assert profiling.flask_profile_response(_request(authorization), 'test')[1] == 403
+
+def test_disabled_without_token(monkeypatch):
+    monkeypatch.setattr(config, 'PROFILE_TOKEN', '')
+    assert profiling.flask_profile_response(_request('Bearer '), 'test')[1] == 403
+
+def test_token_accepted(monkeypatch):
+    monkeypatch.setattr(config, 'PROFILE_TOKEN', 'secret')
+    # Токен принят - дальше проверяется параметр seconds
+    assert profiling.flask_profile_response(_request('Bearer secret'), 'test')[1] == 400
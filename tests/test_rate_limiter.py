@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Общие token bucket'ы rate_limiter.py: два процесса на одном файле"""
+import pytest
+
+import rate_limiter
+from rate_limiter import PRIORITY_BULK, PRIORITY_TRANSACTIONAL, SharedTokenBuckets
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Остановленные часы: без пополнения бакетов между вызовами"""
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter.time, 'time', lambda: now[0])
+    return now
+
+@pytest.fixture
+def processes(tmp_path):
+    """Два лимитера на одном файле - как бот и проверка подписок"""
+    buckets = [
+        SharedTokenBuckets(str(tmp_path / 'rate_limit.db'), global_rate=10, chat_rate=1, group_rate=0.5,
+                           chat_burst=3, bulk_reserve=0.2)
+        for _ in range(2)
+    ]
+    yield buckets
+    for bucket in buckets:
+        bucket.close()
+
+def test_global_bucket_shared(clock, processes):
+    first, second = processes
+    for i in range(10):
+        assert processes[i % 2].try_acquire(None, PRIORITY_TRANSACTIONAL) == 0
+    # 10 токенов на оба процесса, следующий через 1/10 сек
+    assert first.try_acquire(None, PRIORITY_TRANSACTIONAL) == pytest.approx(0.1)
+    assert second.try_acquire(None, PRIORITY_TRANSACTIONAL) == pytest.approx(0.1)
+
+    clock[0] += 0.1
+    assert second.try_acquire(None, PRIORITY_TRANSACTIONAL) == 0
+
+def test_bulk_keeps_reserve(clock, processes):
+    bulk, transactional = processes
+    # Резерв - 20% глобального бакета: массовой отправке достаются 8 токенов из 10
+    for _ in range(8):
+        assert bulk.try_acquire(None, PRIORITY_BULK) == 0
+    assert bulk.try_acquire(None, PRIORITY_BULK) == pytest.approx(0.1)
+
+    # Транзакционные сообщения другого процесса забирают резерв
+    assert transactional.try_acquire(None, PRIORITY_TRANSACTIONAL) == 0
+    assert transactional.try_acquire(None, PRIORITY_TRANSACTIONAL) == 0
+    assert transactional.try_acquire(None, PRIORITY_TRANSACTIONAL) > 0
+    assert bulk.try_acquire(None, PRIORITY_BULK) == pytest.approx(0.3)
+
+def test_per_chat_limits(clock, processes):
+    first, second = processes
+    for _ in range(3):
+        assert first.try_acquire(42, PRIORITY_TRANSACTIONAL) == 0
+    assert second.try_acquire(42, PRIORITY_TRANSACTIONAL) == pytest.approx(1.0)
+    assert second.try_acquire(43, PRIORITY_TRANSACTIONAL) == 0
+
+    # Группы и каналы - без запаса, 1 сообщение в 2 сек
+    assert first.try_acquire(-100, PRIORITY_TRANSACTIONAL) == 0
+    assert second.try_acquire(-100, PRIORITY_TRANSACTIONAL) == pytest.approx(2.0)
+
+def test_pause_applies_to_all_processes(clock, processes):
+    first, second = processes
+    first.pause(5)
+    assert second.try_acquire(None, PRIORITY_TRANSACTIONAL) == pytest.approx(5)
+    # Более короткая пауза не сокращает уже объявленную
+    second.pause(1)
+    assert first.try_acquire(None, PRIORITY_TRANSACTIONAL) == pytest.approx(5)
+
+    clock[0] += 5
+    assert first.try_acquire(None, PRIORITY_TRANSACTIONAL) == 0
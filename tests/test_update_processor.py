@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""PerUserUpdateProcessor: очередь на пользователя, общий лимит и слоты админов"""
+import asyncio
+from types import SimpleNamespace
+
+from update_processor import ADMIN_SLOTS, PENDING_FACTOR, PerUserUpdateProcessor
+
+ADMIN_IDS = [1, 2, 3]
+
+def _update(user_id, n):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), n=n)
+
+class _Probe:
+    """Обработчики, которые записывают порядок и число одновременных вызовов"""
+
+    def __init__(self):
+        self.done = []
+        self.running = 0
+        self.max_running = 0
+        self.pending = 0
+        self.max_pending = 0
+
+    async def handle(self, update, delay=0.001):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(delay)
+        self.running -= 1
+        self.done.append((update.effective_user.id, update.n))
+
+def _instrument(processor, probe):
+    """Считать обновления внутри do_process_update (в работе и в очередях пользователей)"""
+    do_process_update = processor.do_process_update
+
+    async def counted(update, coroutine):
+        probe.pending += 1
+        probe.max_pending = max(probe.max_pending, probe.pending)
+        try:
+            await do_process_update(update, coroutine)
+        finally:
+            probe.pending -= 1
+
+    processor.do_process_update = counted
+
+def test_per_user_order_and_limits():
+    async def scenario():
+        processor = PerUserUpdateProcessor(limit=3, admin_ids=ADMIN_IDS)
+        await processor.initialize()
+        probe = _Probe()
+        _instrument(processor, probe)
+
+        # Наплыв: 10 пользователей по 20 обновлений вперемешку
+        updates = [_update(user_id, n) for n in range(20) for user_id in range(100, 110)]
+        await asyncio.gather(*(processor.process_update(update, probe.handle(update)) for update in updates))
+        return processor, probe
+
+    processor, probe = asyncio.run(scenario())
+    assert len(probe.done) == 200
+    for user_id in range(100, 110):
+        assert [n for uid, n in probe.done if uid == user_id] == list(range(20))
+    assert probe.max_running == 3
+    assert probe.max_pending == 3 * PENDING_FACTOR
+    assert processor._user_locks == {}
+
+def test_admin_not_blocked_by_flood():
+    async def scenario():
+        processor = PerUserUpdateProcessor(limit=2, admin_ids=ADMIN_IDS)
+        await processor.initialize()
+        probe = _Probe()
+        _instrument(processor, probe)
+        release = asyncio.Event()
+
+        async def stuck(update):
+            await release.wait()
+            await probe.handle(update)
+
+        # Все места и слоты заняты зависшими обработчиками пользователей
+        flood = [_update(user_id, 0) for user_id in range(100, 100 + 2 * PENDING_FACTOR + 5)]
+        tasks = [asyncio.create_task(processor.process_update(update, stuck(update))) for update in flood]
+        await asyncio.sleep(0.01)
+        assert probe.pending == 2 * PENDING_FACTOR
+
+        # Админы проходят сразу, но сами ограничены своими слотами
+        admin = [_update(admin_id, n) for n in range(2) for admin_id in ADMIN_IDS]
+        await asyncio.wait_for(asyncio.gather(
+            *(processor.process_update(update, probe.handle(update, 0.01)) for update in admin)), 1)
+        assert sorted(probe.done) == sorted((update.effective_user.id, update.n) for update in admin)
+        assert probe.max_running == ADMIN_SLOTS
+
+        release.set()
+        await asyncio.gather(*tasks)
+        return probe
+
+    probe = asyncio.run(scenario())
+    assert len(probe.done) == 6 + 2 * PENDING_FACTOR + 5
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Сквозная трассировка: от события Stripe до доставки в Telegram.
+
+webhook_server.py открывает трассу на каждое событие (trace_id - идентификатор
+корреляции), а шаги обработки, функции database.py и запросы к Stripe/Telegram
+записываются в неё спанами. Спаны пишутся строками JSON в TRACE_FILE
+(пустое значение - трассировка отключена), вне трассы ничего не пишется.
+
+Просмотр:
+    python tracing.py slowest --limit 10
+    python tracing.py show <trace_id | event_id | telegram_id>
+"""
+import argparse
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Открытый спан текущей задачи/потока
+_current = contextvars.ContextVar('trace_span', default=None)
+
+_write_lock = threading.Lock()
+_writes = 0
+
+class Span:
+    """Открытый спан; атрибуты можно дополнять до закрытия"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attrs: Dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.start = time.time()
+        self._started = time.perf_counter()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self, error: Optional[BaseException] = None):
+        _write({
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': round((time.perf_counter() - self._started) * 1000, 3),
+            'status': 'error' if error else 'ok',
+            'error': str(error) if error else None,
+            'attrs': self.attrs,
+            'pid': os.getpid()
+        })
+
+def _write(record: Dict):
+    """Дописать спан в TRACE_FILE (файл ротируется при превышении TRACE_MAX_MB)"""
+    global _writes
+    line = json.dumps(record, ensure_ascii=False, default=str) + '\n'
+    try:
+        with _write_lock:
+            _writes += 1
+            if _writes % 100 == 0 and os.path.exists(config.TRACE_FILE) \
+                    and os.path.getsize(config.TRACE_FILE) > config.TRACE_MAX_MB * 1024 * 1024:
+                os.replace(config.TRACE_FILE, config.TRACE_FILE + '.1')
+            with open(config.TRACE_FILE, 'a', encoding='utf-8') as f:
+                f.write(line)
+    except OSError as e:
+        logger.warning(f"Не удалось записать спан {record['name']}: {e}")
+
+def current_trace_id() -> Optional[str]:
+    """trace_id текущей трассы (или None)"""
+    current = _current.get()
+    return current.trace_id if current else None
+
+@contextmanager
+def _open(span: Span):
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        _current.reset(token)
+        span.finish(e)
+        raise
+    _current.reset(token)
+    span.finish()
+
+@contextmanager
+def start_trace(name: str, **attrs):
+    """Начать новую трассу (корневой спан)"""
+    if not config.TRACE_FILE:
+        yield None
+        return
+    with _open(Span(name, os.urandom(16).hex(), None, attrs)) as span:
+        yield span
+
+@contextmanager
+def span(name: str, **attrs):
+    """Дочерний спан текущей трассы; вне трассы ничего не делает"""
+    current = _current.get()
+    if current is None:
+        yield None
+        return
+    with _open(Span(name, current.trace_id, current.span_id, attrs)) as child:
+        yield child
+
+def annotate(**attrs):
+    """Добавить атрибуты к спану, который сейчас открыт"""
+    current = _current.get()
+    if current is not None:
+        current.set(**attrs)
+
+def bind(coro):
+    """Обернуть корутину, чтобы она выполнялась в текущем спане (в другом потоке/loop)"""
+    current = _current.get()
+
+    async def runner():
+        _current.set(current)
+        return await coro
+
+    return runner()
+
+def record(name: str, seconds: float, error: bool = False, **attrs):
+    """Записать уже завершившийся шаг (например, запрос к API) как дочерний спан"""
+    current = _current.get()
+    if current is None:
+        return
+    _write({
+        'trace_id': current.trace_id,
+        'span_id': os.urandom(8).hex(),
+        'parent_id': current.span_id,
+        'name': name,
+        'start': time.time() - seconds,
+        'duration_ms': round(seconds * 1000, 3),
+        'status': 'error' if error else 'ok',
+        'error': None,
+        'attrs': attrs,
+        'pid': os.getpid()
+    })
+
+def traced(func=None, *, name: Optional[str] = None):
+    """Декоратор: вызов функции - спан текущей трассы (telegram_id попадает в атрибуты)"""
+    if func is None:
+        return functools.partial(traced, name=name)
+
+    span_name = name or func.__name__
+    params = list(inspect.signature(func).parameters)
+    id_index = params.index('telegram_id') if 'telegram_id' in params else None
+
+    def _attrs(args, kwargs):
+        if 'telegram_id' in kwargs:
+            return {'telegram_id': kwargs['telegram_id']}
+        if id_index is not None and id_index < len(args):
+            return {'telegram_id': args[id_index]}
+        return {}
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with span(span_name, **_attrs(args, kwargs)):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(span_name, **_attrs(args, kwargs)):
+            return func(*args, **kwargs)
+    return wrapper
+
+# === ПРОСМОТР ТРАСС ===
+
+def load_spans(path: str) -> Dict[str, List[Dict]]:
+    """Прочитать спаны из файла (и предыдущего после ротации), сгруппировать по trace_id"""
+    traces = defaultdict(list)
+    for file_path in (path + '.1', path):
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record_ = json.loads(line)
+                except ValueError:
+                    continue
+                traces[record_['trace_id']].append(record_)
+    return traces
+
+def _root(spans: List[Dict]) -> Optional[Dict]:
+    roots = [s for s in spans if s['parent_id'] is None]
+    return roots[0] if roots else None
+
+def _end(span_: Dict) -> float:
+    return span_['start'] + span_['duration_ms'] / 1000
+
+def critical_path(span_: Dict, children: Dict[str, List[Dict]]) -> List[Dict]:
+    """
+    Критический путь: идём от конца спана назад, выбирая ребёнка, закончившегося
+    последним до текущей точки. Возвращает шаги с собственным временем на пути.
+    """
+    path = []
+    cursor = _end(span_)
+    own = span_['duration_ms']
+    for child in sorted(children.get(span_['span_id'], []), key=_end, reverse=True):
+        # Небольшой допуск: время старта записанных постфактум спанов вычислено
+        if _end(child) <= cursor + 0.001:
+            path = critical_path(child, children) + path
+            own -= child['duration_ms']
+            cursor = child['start']
+    return [{'name': span_['name'], 'self_ms': max(0.0, own), 'start': span_['start']}] + path
+
+def _trace_attr(spans: List[Dict], key: str):
+    for span_ in spans:
+        if key in span_['attrs']:
+            return span_['attrs'][key]
+    return None
+
+def print_trace(spans: List[Dict]):
+    """Дерево спанов и разбивка критического пути"""
+    root = _root(spans)
+    if root is None:
+        print("Трасса неполная (нет корневого спана)")
+        return
+
+    children = defaultdict(list)
+    for span_ in spans:
+        if span_['parent_id']:
+            children[span_['parent_id']].append(span_)
+
+    started = datetime.fromtimestamp(root['start']).strftime('%Y-%m-%d %H:%M:%S')
+    print(f"Трасса {root['trace_id']} ({started}, {root['duration_ms']:.1f} мс)")
+    print(f"  event: {_trace_attr(spans, 'event_type')} {_trace_attr(spans, 'event_id')}, "
+          f"telegram_id: {_trace_attr(spans, 'telegram_id')}")
+
+    def walk(span_, depth):
+        offset = (span_['start'] - root['start']) * 1000
+        error = f"  ❌ {span_['error'] or 'error'}" if span_['status'] == 'error' else ''
+        print(f"  {'  ' * depth}{span_['name']}: +{offset:.1f} мс, {span_['duration_ms']:.1f} мс{error}")
+        for child in sorted(children.get(span_['span_id'], []), key=lambda s: s['start']):
+            walk(child, depth + 1)
+
+    walk(root, 0)
+
+    print("  Критический путь:")
+    for step in sorted(critical_path(root, children), key=lambda s: -s['self_ms']):
+        if step['self_ms'] >= 0.05:
+            share = step['self_ms'] / root['duration_ms'] * 100 if root['duration_ms'] else 0
+            print(f"    {step['name']}: {step['self_ms']:.1f} мс ({share:.0f}%)")
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Просмотр трасс обработки событий Stripe")
+    parser.add_argument('--file', default=config.TRACE_FILE, help="Файл трасс (по умолчанию TRACE_FILE)")
+    sub = parser.add_subparsers(dest='command', required=True)
+    slowest = sub.add_parser('slowest', help="Самые медленные трассы")
+    slowest.add_argument('--limit', type=int, default=10)
+    slowest.add_argument('--details', action='store_true', help="Показать дерево и критический путь")
+    show = sub.add_parser('show', help="Трассы по trace_id, event_id или telegram_id")
+    show.add_argument('key')
+    show.add_argument('--limit', type=int, default=5, help="Сколько последних трасс показать")
+    args = parser.parse_args()
+
+    if not args.file:
+        parser.error("TRACE_FILE не задан")
+
+    traces = load_spans(args.file)
+
+    if args.command == 'slowest':
+        complete = [spans for spans in traces.values() if _root(spans)]
+        complete.sort(key=lambda spans: -_root(spans)['duration_ms'])
+        for spans in complete[:args.limit]:
+            if args.details:
+                print_trace(spans)
+                print()
+                continue
+            root = _root(spans)
+            started = datetime.fromtimestamp(root['start']).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"{root['duration_ms']:9.1f} мс  {started}  {root['trace_id']}  "
+                  f"{_trace_attr(spans, 'event_type')}  telegram_id={_trace_attr(spans, 'telegram_id')}")
+        return
+
+    def matches(trace_id, spans):
+        if trace_id == args.key:
+            return True
+        return any(
+            str(span_['attrs'].get('event_id')) == args.key or str(span_['attrs'].get('telegram_id')) == args.key
+            for span_ in spans
+        )
+
+    found = [spans for trace_id, spans in traces.items() if matches(trace_id, spans) and _root(spans)]
+    if not found:
+        print("Трассы не найдены")
+        return
+    found.sort(key=lambda spans: _root(spans)['start'])
+    for spans in found[-args.limit:]:
+        print_trace(spans)
+        print()
+
+if __name__ == '__main__':
+    main()
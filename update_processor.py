@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Параллельная обработка обновлений Telegram с сохранением порядка для каждого пользователя.
+
+- Обновления разных пользователей обрабатываются одновременно (не больше limit штук)
+- Обновления одного telegram_id обрабатываются строго по очереди
+- В обработке и в очередях пользователей - не больше PENDING_FACTOR * limit обновлений,
+  остальные ждут у PTB
+- Обновления от админов не ждут общего лимита: у них свои ADMIN_SLOTS слотов
+"""
+import asyncio
+from typing import Awaitable, Iterable, Optional
+
+from telegram.ext import BaseUpdateProcessor
+
+# Сколько обновлений на слот может ждать своей очереди у пользователя
+PENDING_FACTOR = 4
+
+# Слоты админов сверх общего лимита
+ADMIN_SLOTS = 2
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обработчик обновлений с лимитом параллельности и очередью на пользователя"""
+
+    def __init__(self, limit: int, admin_ids: Iterable[int] = ()):
+        # Семафор базового класса занимается ещё до очереди пользователя, поэтому он
+        # больше limit: обновления одного пользователя не занимают все места
+        super().__init__(max_concurrent_updates=limit * PENDING_FACTOR)
+        self.limit = limit
+        self.admin_ids = set(admin_ids)
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._admin_slots: Optional[asyncio.Semaphore] = None
+        # telegram_id -> [lock, количество ожидающих обновлений]
+        self._user_locks = {}
+
+    @staticmethod
+    def get_user_key(update: object) -> Optional[int]:
+        """telegram_id отправителя (или id чата), по которому упорядочиваются обновления"""
+        user = getattr(update, 'effective_user', None)
+        if user:
+            return user.id
+        chat = getattr(update, 'effective_chat', None)
+        if chat:
+            return chat.id
+        return None
+
+    async def process_update(self, update: object, coroutine: Awaitable) -> None:
+        """Админы не ждут мест, занятых обновлениями пользователей"""
+        if self.get_user_key(update) in self.admin_ids:
+            await self.do_process_update(update, coroutine)
+        else:
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        """Дождаться очереди пользователя, затем слота, затем выполнить обработчик"""
+        key = self.get_user_key(update)
+
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            slots = self._admin_slots if key in self.admin_ids else self._slots
+            async with entry[0]:
+                async with slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[key]
+
+    async def initialize(self) -> None:
+        """Создать семафоры внутри рабочего event loop"""
+        self._slots = asyncio.Semaphore(self.limit)
+        self._admin_slots = asyncio.Semaphore(ADMIN_SLOTS)
+
+    async def shutdown(self) -> None:
+        """Ничего не освобождаем: задачи завершает Application"""
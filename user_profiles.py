@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Отложенная запись профилей пользователей (/start и кнопка « Atrás).
+
+Профиль (username, first_name, last_name) сравнивается с отпечатком последней
+записи в памяти: неизменённый не пишется вовсе, изменённый попадает в буфер,
+который сбрасывается одной транзакцией раз в USER_WRITE_INTERVAL_MS или при
+накоплении USER_WRITE_BATCH_SIZE записей, а также при остановке бота.
+Отпечатки хранятся отдельно для каждого тенанта (tenants.py).
+"""
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+
+import cache_bus
+import config
+import database as db
+from tenants import DEFAULT_ID
+
+logger = logging.getLogger(__name__)
+
+Profile = Tuple[Optional[str], Optional[str], Optional[str]]
+
+class ProfileWriter:
+    """Буфер записей профилей с отпечатками уже записанных"""
+
+    def __init__(self, interval: float, batch_size: int, cache_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self._fingerprints: Dict[str, Dict[int, int]] = {}
+        self._pending: Dict[Tuple[str, int], Profile] = {}
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    async def save(self, telegram_id: int, username=None, first_name=None, last_name=None,
+                   tenant_id: str = DEFAULT_ID):
+        """Записать профиль, если он изменился с прошлой записи"""
+        profile = (username, first_name, last_name)
+        fingerprint = hash(profile)
+        fingerprints = self._fingerprints.setdefault(tenant_id, {})
+        if fingerprints.get(telegram_id) == fingerprint:
+            return
+
+        if len(fingerprints) >= self.cache_size:
+            # Сброс дешевле LRU: худший случай - по одной лишней записи на пользователя
+            fingerprints.clear()
+        fingerprints[telegram_id] = fingerprint
+        self._pending[(tenant_id, telegram_id)] = profile
+
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def forget(self, telegram_id: int, tenant_id: str = DEFAULT_ID):
+        """Забыть отпечаток (строка в БД изменилась помимо буфера, например is_blocked)"""
+        self._fingerprints.get(tenant_id, {}).pop(telegram_id, None)
+
+    def invalidate(self, key, version=None):
+        """Сообщение шины кэшей: строка пользователя изменилась в другом процессе (None - все)"""
+        # Ключ шины - только telegram_id: забываем его у всех тенантов
+        for fingerprints in self._fingerprints.values():
+            if key is None:
+                fingerprints.clear()
+            else:
+                fingerprints.pop(int(key), None)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Записать накопленные профили одной транзакцией"""
+        async with self._lock:
+            batch, self._pending = self._pending, {}
+            by_tenant: Dict[str, list] = {}
+            for (tenant_id, telegram_id), profile in batch.items():
+                by_tenant.setdefault(tenant_id, []).append((telegram_id, *profile))
+            for tenant_id, rows in by_tenant.items():
+                try:
+                    await asyncio.to_thread(db.upsert_users, rows, tenant_id)
+                except Exception as e:
+                    # Без отпечатков следующий /start этих пользователей повторит запись
+                    for row in rows:
+                        self.forget(row[0], tenant_id)
+                    logger.error(f"Не удалось записать профили {tenant_id} ({len(rows)}): {e}")
+
+    async def close(self):
+        """Остановка: сбросить буфер"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+WRITER = ProfileWriter(
+    interval=config.USER_WRITE_INTERVAL_MS / 1000,
+    batch_size=config.USER_WRITE_BATCH_SIZE,
+    cache_size=config.USER_FINGERPRINT_CACHE_SIZE
+)
+cache_bus.BUS.subscribe('user', WRITER.invalidate)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Журнал сырых событий Stripe для воспроизведения (replay.py).
+
+webhook_server.py дописывает каждое принятое событие (тело запроса как есть, время
+получения, HTTP статус и время обработки) строкой JSON в сжатый gzip-файл в
+WEBHOOK_CAPTURE_DIR (пустое значение - журнал отключён). Файл закрывается и начинается
+новый при превышении WEBHOOK_CAPTURE_ROTATE_MB, файлы старше WEBHOOK_CAPTURE_KEEP_DAYS
+удаляются. Каждая запись сбрасывается на диск сразу (Z_SYNC_FLUSH), поэтому после
+падения процесса читается всё, кроме, возможно, последней строки.
+"""
+import glob
+import gzip
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+FILE_PATTERN = 'stripe-*.jsonl.gz'
+
+class CaptureLog:
+    """Дописываемый журнал событий с ротацией по размеру"""
+
+    def __init__(self, directory: str, rotate_mb: float, keep_days: int):
+        self.directory = directory
+        self.rotate_bytes = rotate_mb * 1024 * 1024
+        self.keep_days = keep_days
+        self._lock = threading.Lock()
+        self._file = None
+        self._raw = None
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"stripe-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.jsonl.gz"
+        self._raw = open(os.path.join(self.directory, name), 'ab')
+        self._file = gzip.GzipFile(fileobj=self._raw, mode='ab')
+        self._cleanup()
+
+    def _cleanup(self):
+        """Удалить файлы старше срока хранения"""
+        if not self.keep_days:
+            return
+        cutoff = time.time() - self.keep_days * 86400
+        for path in glob.glob(os.path.join(self.directory, FILE_PATTERN)):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError as e:
+                logger.warning(f"Не удалось удалить старый журнал {path}: {e}")
+
+    def write(self, payload: bytes, status: int, elapsed: float):
+        """Дописать событие; ошибки журнала не должны ломать обработку webhook"""
+        if not self.directory:
+            return
+        record = {
+            'received': time.time(),
+            'status': status,
+            'ms': round(elapsed * 1000, 3),
+            'payload': payload.decode('utf-8', 'replace')
+        }
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        try:
+            with self._lock:
+                if self._file is None:
+                    self._open()
+                self._file.write(line)
+                self._file.flush(zlib.Z_SYNC_FLUSH)
+                if self._raw.tell() >= self.rotate_bytes:
+                    self.close()
+        except OSError as e:
+            logger.warning(f"Не удалось записать событие в журнал: {e}")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._raw.close()
+            self._file = self._raw = None
+
+def _read_file(path: str) -> Iterator[Dict]:
+    """Записи одного файла; оборванный хвост (файл пишется или процесс упал) пропускается"""
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"{path}: пропущена неполная строка")
+    except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+        logger.warning(f"{path}: файл оборван ({e}), прочитано до обрыва")
+
+def read_events(paths: Optional[List[str]] = None) -> Iterator[Dict]:
+    """
+    Все записи журнала по времени получения. paths - файлы или каталоги
+    (по умолчанию WEBHOOK_CAPTURE_DIR). Файлы разных процессов сливаются, в памяти
+    держится по одной записи на файл.
+    """
+    files = []
+    for path in paths or [config.WEBHOOK_CAPTURE_DIR]:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, FILE_PATTERN))))
+        else:
+            files.append(path)
+    return heapq.merge(*(_read_file(path) for path in files), key=lambda record: record['received'])
+
+CAPTURE = CaptureLog(config.WEBHOOK_CAPTURE_DIR, config.WEBHOOK_CAPTURE_ROTATE_MB, config.WEBHOOK_CAPTURE_KEEP_DAYS)
@@ -1,14 +1,22 @@
 # -*- coding: utf-8 -*-
 import logging
 from flask import Flask, request, jsonify
-from telegram import Bot
 import json
+import time
 import asyncio
+import threading
 from datetime import datetime, timedelta
 
 import config
 import database as db
 from stripe_integration import get_checkout_session, get_subscription, verify_webhook_signature
+from invite_links import get_or_create_invite_link
+from rate_limiter import create_bot
+import metrics
+import profiling
+import tenants
+import tracing
+import webhook_capture
 
 # Настройка логирования
 logging.basicConfig(
@@ -18,46 +26,57 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+profiling.init_flask_timing(app)
 
-# Создаём экземпляр бота для отправки уведомлений
-bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
+# Боты тенантов для отправки уведомлений (создаются при первом событии тенанта)
+bots = {}
 
-def get_duration_from_price_id(price_id: str) -> int:
-    """Определить длительность подписки по Price ID"""
-    for period, pid in config.STRIPE_PRICES.items():
-        if pid == price_id:
-            if '1_month' in period:
-                return 1
-            elif '6_months' in period:
-                return 6
-            elif '12_months' in period:
-                return 12
-    return 1  # По умолчанию 1 месяц
+# HTTP-клиент бота привязан к одному event loop, поэтому все обработчики выполняются
+# в общем loop фонового потока, а потоки Flask только ждут результат.
+# Поток запускается при первом событии: импорт модуля (replay.py, бенчмарки) его не создаёт
+_loop = None
+_loop_lock = threading.Lock()
 
-async def send_telegram_message(chat_id: int, text: str, parse_mode: str = None):
-    """Отправить сообщение пользователю"""
+def _get_loop():
+    """Общий loop фонового потока"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='webhook-loop', daemon=True).start()
+    return _loop
+
+def run_async(coro):
+    """Выполнить корутину в общем loop и дождаться результата"""
+    return asyncio.run_coroutine_threadsafe(tracing.bind(coro), _get_loop()).result()
+
+def get_bot(tenant):
+    """Бот тенанта (вызывается только из общего loop, поэтому без блокировки)"""
+    if tenant.id not in bots:
+        bots[tenant.id] = create_bot(tenant)
+    return bots[tenant.id]
+
+@tracing.traced
+async def send_telegram_message(tenant, chat_id: int, text: str, parse_mode: str = None):
+    """Отправить сообщение пользователю от бота тенанта"""
     try:
-        await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+        await get_bot(tenant).send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
         logger.info(f"Сообщение отправлено пользователю {chat_id}")
     except Exception as e:
         logger.error(f"Ошибка отправки сообщения {chat_id}: {e}")
 
-async def create_and_send_invite_link(telegram_id: int):
-    """Создать инвайт-ссылку и отправить пользователю"""
+@tracing.traced
+async def create_and_send_invite_link(tenant, telegram_id: int):
+    """Создать инвайт-ссылку в канал тенанта и отправить пользователю"""
     try:
-        # Создаём одноразовую инвайт-ссылку
-        invite_link = await bot.create_chat_invite_link(
-            chat_id=config.CHANNEL_ID,
-            member_limit=1,
-            name=f"User_{telegram_id}",
-            expire_date=datetime.now() + timedelta(hours=24)
-        )
+        # Берём действующую ссылку из кэша или создаём одноразовую
+        invite_link = await get_or_create_invite_link(get_bot(tenant), tenant, telegram_id)
         
-        message = config.MESSAGES['payment_success'].format(
-            invite_link=invite_link.invite_link
+        message = tenant.messages['payment_success'].format(
+            invite_link=invite_link
         )
         
-        await send_telegram_message(telegram_id, message)
+        await send_telegram_message(tenant, telegram_id, message)
         logger.info(f"Инвайт-ссылка отправлена пользователю {telegram_id}")
         return True
     
@@ -65,19 +84,29 @@ async def create_and_send_invite_link(telegram_id: int):
         logger.error(f"Ошибка создания инвайт-ссылки для {telegram_id}: {e}")
         return False
 
-async def kick_user_from_channel(telegram_id: int):
-    """Удалить пользователя из канала"""
+@tracing.traced
+async def kick_user_from_channel(tenant, telegram_id: int):
+    """Удалить пользователя из канала тенанта"""
     try:
-        # Баним пользователя
-        await bot.ban_chat_member(chat_id=config.CHANNEL_ID, user_id=telegram_id)
-        # Сразу разбаниваем (кик)
-        await bot.unban_chat_member(chat_id=config.CHANNEL_ID, user_id=telegram_id)
+        # Неиспользованную ссылку больше нельзя оставлять рабочей
+        db.supersede_invite_links(telegram_id, tenant.id)
         
-        logger.info(f"Пользователь {telegram_id} удалён из канала")
+        # Если пользователь точно не в канале - удалять некого
+        if db.is_channel_member(telegram_id, tenant.id) is False:
+            logger.info(f"Пользователь {telegram_id} не в канале, удаление пропущено")
+        else:
+            bot = get_bot(tenant)
+            # Баним пользователя
+            await bot.ban_chat_member(chat_id=tenant.channel_id, user_id=telegram_id)
+            # Сразу разбаниваем (кик)
+            await bot.unban_chat_member(chat_id=tenant.channel_id, user_id=telegram_id)
+            db.set_channel_member_status(telegram_id, 'left', False, tenant.id)
+            
+            logger.info(f"Пользователь {telegram_id} удалён из канала")
         
         # Уведомляем пользователя
-        message = config.MESSAGES['subscription_expired']
-        await send_telegram_message(telegram_id, message)
+        message = tenant.messages['subscription_expired']
+        await send_telegram_message(tenant, telegram_id, message)
         return True
     
     except Exception as e:
@@ -87,49 +116,65 @@ async def kick_user_from_channel(telegram_id: int):
 @app.route('/webhook', methods=['POST'])
 def stripe_webhook():
     """Обработчик webhook от Stripe"""
+    # Одна трасса на событие: trace_id связывает все шаги до отправки в Telegram
+    with tracing.start_trace('stripe_webhook'):
+        return process_stripe_webhook()
+
+def process_stripe_webhook():
+    """Проверка подписи, обработка события и запись в журнал событий"""
     payload = request.data
     sig_header = request.headers.get('Stripe-Signature', '')
     
     # Проверяем подпись (если настроен webhook secret)
     if not verify_webhook_signature(payload, sig_header):
         logger.error("Неверная подпись webhook")
+        metrics.WEBHOOK_EVENTS.labels(type='unknown', outcome='invalid_signature').inc()
         return jsonify({'error': 'Invalid signature'}), 400
     
+    started = time.perf_counter()
+    body, status = dispatch_event(payload)
+    webhook_capture.CAPTURE.write(payload, status, time.perf_counter() - started)
+    return jsonify(body), status
+
+def dispatch_event(payload: bytes):
+    """Вызвать обработчик события, вернуть (тело ответа, HTTP статус). Используется и replay.py"""
+    event_type = 'unknown'
     try:
         event = json.loads(payload)
         event_type = event['type']
+        tracing.annotate(event_id=event.get('id'), event_type=event_type)
         
-        logger.info(f"Получен webhook: {event_type}")
-        
-        # Обработка успешной оплаты Checkout Session
-        if event_type == 'checkout.session.completed':
-            asyncio.run(handle_checkout_completed(event['data']['object']))
-        
-        # Обработка успешного платежа по подписке
-        elif event_type == 'invoice.paid':
-            asyncio.run(handle_invoice_paid(event['data']['object']))
+        logger.info(f"Получен webhook: {event_type} (trace {tracing.current_trace_id()})")
         
-        # Обработка провала платежа
-        elif event_type == 'invoice.payment_failed':
-            asyncio.run(handle_invoice_failed(event['data']['object']))
-        
-        # Обработка отмены подписки
-        elif event_type == 'customer.subscription.deleted':
-            asyncio.run(handle_subscription_deleted(event['data']['object']))
-        
-        # Обработка обновления подписки
-        elif event_type == 'customer.subscription.updated':
-            asyncio.run(handle_subscription_updated(event['data']['object']))
+        handler = EVENT_HANDLERS.get(event_type)
+        if handler:
+            # Тенант по аккаунту Connect или метаданным; None - по локальной подписке
+            tenant_id = tenants.tenant_id_for_event(event)
+            started = time.perf_counter()
+            run_async(handler(event['data']['object'], tenant_id))
+            metrics.HANDLER_SECONDS.labels(handler=event_type).observe(time.perf_counter() - started)
+            metrics.WEBHOOK_EVENTS.labels(type=event_type, outcome='success').inc()
+        else:
+            metrics.WEBHOOK_EVENTS.labels(type=event_type, outcome='ignored').inc()
         
-        return jsonify({'status': 'success'}), 200
+        return {'status': 'success'}, 200
+    
+    except tenants.UnknownTenant as e:
+        # Повтор от Stripe не поможет, пока тенант не добавлен в конфигурацию
+        logger.warning(f"Событие {event_type} пропущено: {e}")
+        metrics.WEBHOOK_EVENTS.labels(type=event_type, outcome='unknown_tenant').inc()
+        return {'status': 'ignored'}, 200
     
     except Exception as e:
         logger.error(f"Ошибка обработки webhook: {e}")
-        return jsonify({'error': str(e)}), 500
+        metrics.WEBHOOK_EVENTS.labels(type=event_type, outcome='error').inc()
+        return {'error': str(e)}, 500
 
-async def handle_checkout_completed(session):
+@tracing.traced
+async def handle_checkout_completed(session, tenant_id):
     """Обработка завершения Checkout Session"""
     logger.info(f"Checkout Session завершён: {session['id']}")
+    tenant = tenants.get(tenant_id)
     
     # Получаем Telegram ID из метаданных
     metadata = session.get('metadata', {})
@@ -140,6 +185,7 @@ async def handle_checkout_completed(session):
         return
     
     telegram_id = int(telegram_id)
+    tracing.annotate(telegram_id=telegram_id)
     
     # Получаем информацию о подписке
     subscription_id = session.get('subscription')
@@ -149,8 +195,8 @@ async def handle_checkout_completed(session):
         logger.error("Subscription ID не найден в сессии")
         return
     
-    # Получаем детали подписки из Stripe
-    subscription = get_subscription(subscription_id)
+    # Получаем детали подписки из Stripe (в потоке, чтобы не блокировать общий loop)
+    subscription = await asyncio.to_thread(get_subscription, subscription_id, tenant.stripe_account)
     
     if not subscription:
         logger.error(f"Не удалось получить подписку {subscription_id}")
@@ -163,7 +209,7 @@ async def handle_checkout_completed(session):
         return
     
     price_id = items[0].get('price', {}).get('id')
-    duration = get_duration_from_price_id(price_id)
+    duration = tenant.months_for_price(price_id)
     
     # Продлеваем существующую подписку или создаём новую
     db.renew_or_create_subscription(
@@ -171,23 +217,36 @@ async def handle_checkout_completed(session):
         stripe_customer_id=customer_id,
         stripe_subscription_id=subscription_id,
         stripe_price_id=price_id,
-        duration_months=duration
+        duration_months=duration,
+        tenant_id=tenant.id
     )
     
     # Обновляем статус платежа
-    db.add_payment(
+    db.set_payment_status(
+        session['id'],
+        'succeeded',
         telegram_id=telegram_id,
-        stripe_payment_id=session.get('payment_intent', ''),
-        stripe_checkout_session_id=session['id'],
-        amount=session.get('amount_total', 0),
-        currency=session.get('currency', 'eur'),
-        status='succeeded'
+        stripe_payment_id=session.get('payment_intent'),
+        amount=session.get('amount_total'),
+        currency=session.get('currency'),
+        tenant_id=tenant.id
     )
     
     # Отправляем инвайт-ссылку
-    await create_and_send_invite_link(telegram_id)
+    await create_and_send_invite_link(tenant, telegram_id)
+
+@tracing.traced
+async def handle_checkout_expired(session, tenant_id):
+    """Checkout Session истекла без оплаты"""
+    db.set_payment_status(session['id'], 'expired')
 
-async def handle_invoice_paid(invoice):
+@tracing.traced
+async def handle_checkout_payment_failed(session, tenant_id):
+    """Отложенная оплата Checkout Session не прошла"""
+    db.set_payment_status(session['id'], 'failed')
+
+@tracing.traced
+async def handle_invoice_paid(invoice, tenant_id):
     """Обработка успешной оплаты счёта (автосписание - продление подписки)"""
     logger.info(f"Инвойс оплачен (автосписание): {invoice['id']}")
     
@@ -204,9 +263,12 @@ async def handle_invoice_paid(invoice):
         return
     
     telegram_id = subscription['telegram_id']
+    tracing.annotate(telegram_id=telegram_id)
+    # Тенант - владелец локальной подписки
+    tenant = tenants.get(subscription['tenant_id'])
     
     # Получаем детали подписки из Stripe чтобы узнать price_id и duration
-    stripe_subscription = get_subscription(subscription_id)
+    stripe_subscription = await asyncio.to_thread(get_subscription, subscription_id, tenant.stripe_account)
     
     if not stripe_subscription:
         logger.error(f"Не удалось получить подписку {subscription_id} из Stripe")
@@ -219,7 +281,7 @@ async def handle_invoice_paid(invoice):
         return
     
     price_id = items[0].get('price', {}).get('id')
-    duration = get_duration_from_price_id(price_id)
+    duration = tenant.months_for_price(price_id)
     
     # ПРОДЛЕВАЕМ подписку через renew_or_create (обновляет end_date!)
     db.renew_or_create_subscription(
@@ -227,21 +289,22 @@ async def handle_invoice_paid(invoice):
         stripe_customer_id=stripe_subscription.get('customer'),
         stripe_subscription_id=subscription_id,
         stripe_price_id=price_id,
-        duration_months=duration
+        duration_months=duration,
+        tenant_id=tenant.id
     )
     
     logger.info(f"✅ Автосписание: подписка продлена для {telegram_id}")
     
-    # Проверяем, есть ли пользователь в канале
-    # Если нет - отправляем новую инвайт-ссылку
+    # Проверяем по локальной таблице, есть ли пользователь в канале
+    # Если нет (или неизвестно) - отправляем инвайт-ссылку
     try:
-        member = await bot.get_chat_member(config.CHANNEL_ID, telegram_id)
-        if member.status in ['left', 'kicked']:
-            await create_and_send_invite_link(telegram_id)
+        if not db.is_channel_member(telegram_id, tenant.id):
+            await create_and_send_invite_link(tenant, telegram_id)
             logger.info(f"Пользователь {telegram_id} не в канале, отправлена инвайт-ссылка")
         else:
             # Уведомляем о продлении (можно отключить если не нужно)
             await send_telegram_message(
+                tenant,
                 telegram_id,
                 "✅ Tu suscripción ha sido renovada automáticamente.\n\nTu acceso al canal continúa activo."
             )
@@ -249,7 +312,8 @@ async def handle_invoice_paid(invoice):
     except Exception as e:
         logger.error(f"Ошибка проверки статуса пользователя {telegram_id}: {e}")
 
-async def handle_invoice_failed(invoice):
+@tracing.traced
+async def handle_invoice_failed(invoice, tenant_id):
     """Обработка провала оплаты счёта"""
     logger.info(f"Инвойс не оплачен: {invoice['id']}")
     
@@ -268,7 +332,8 @@ async def handle_invoice_failed(invoice):
         telegram_id = subscription['telegram_id']
         logger.info(f"Оплата не прошла для пользователя {telegram_id}")
 
-async def handle_subscription_deleted(subscription):
+@tracing.traced
+async def handle_subscription_deleted(subscription, tenant_id):
     """Обработка удаления/отмены подписки"""
     logger.info(f"Подписка отменена: {subscription['id']}")
     
@@ -283,10 +348,11 @@ async def handle_subscription_deleted(subscription):
     if sub_data:
         telegram_id = sub_data['telegram_id']
         
-        # Удаляем из канала
-        await kick_user_from_channel(telegram_id)
+        # Удаляем из канала тенанта подписки
+        await kick_user_from_channel(tenants.get(sub_data['tenant_id']), telegram_id)
 
-async def handle_subscription_updated(subscription):
+@tracing.traced
+async def handle_subscription_updated(subscription, tenant_id):
     """Обработка обновления подписки"""
     logger.info(f"Подписка обновлена: {subscription['id']}")
     
@@ -301,7 +367,24 @@ async def handle_subscription_updated(subscription):
         sub_data = db.get_subscription_by_stripe_id(subscription_id)
         if sub_data:
             telegram_id = sub_data['telegram_id']
-            await kick_user_from_channel(telegram_id)
+            await kick_user_from_channel(tenants.get(sub_data['tenant_id']), telegram_id)
+
+# Обработчики событий Stripe
+EVENT_HANDLERS = {
+    # Успешная оплата Checkout Session
+    'checkout.session.completed': handle_checkout_completed,
+    # Сессия истекла / отложенная оплата не прошла
+    'checkout.session.expired': handle_checkout_expired,
+    'checkout.session.async_payment_failed': handle_checkout_payment_failed,
+    # Успешный платёж по подписке
+    'invoice.paid': handle_invoice_paid,
+    # Провал платежа
+    'invoice.payment_failed': handle_invoice_failed,
+    # Отмена подписки
+    'customer.subscription.deleted': handle_subscription_deleted,
+    # Обновление подписки
+    'customer.subscription.updated': handle_subscription_updated
+}
 
 @app.route('/success')
 def payment_success():
@@ -352,6 +435,16 @@ def health_check():
     """Проверка работоспособности сервера"""
     return jsonify({'status': 'ok', 'timestamp': datetime.now().isoformat()})
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики Prometheus"""
+    return metrics.flask_metrics_response(request)
+
+@app.route('/debug/profile', methods=['POST'])
+def profile_endpoint():
+    """Запустить сэмплирующий профайлер (PROFILE_TOKEN)"""
+    return profiling.flask_profile_response(request, 'webhook')
+
 def main():
     """Запуск webhook сервера"""
     # Валидация конфигурации